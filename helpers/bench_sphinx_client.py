@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput and latency benchmark of the searchd clients.
+
+Starts an in-process SearchdEmulator over a synthetic corpus and runs the
+same workload through every client flavour, varying the number of queries
+per request and the number of matches per query:
+
+    python helpers/bench_sphinx_client.py
+    python helpers/bench_sphinx_client.py --docs 20000 --batches 1,32 --results 1000
+    python helpers/bench_sphinx_client.py --server 127.0.0.1:9312 --index submissions
+
+For every combination it prints requests/s, queries/s, p50/p99 request
+latency and the share of client time spent decoding responses. The
+emulator searches in Python, so absolute numbers mostly reflect its cost;
+compare the flavours and the decode share. With --server the workload goes
+to a real searchd instead (its index needs documents with the WORDS below).
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.sphinxapi import SphinxClient, SPH_ATTR_INTEGER, SPH_ATTR_TIMESTAMP, \
+    SPH_MATCH_ANY
+from lib.sphinxasync import AsyncSphinxClient, SphinxReactor
+from lib.sphinxemu import SearchdEmulator, MemoryIndex
+from lib.sphinxpool import PooledSphinxClient, SphinxConnectionPool
+
+
+WORDS = [u'массив', u'сортировка', u'дерево', u'граф', u'поиск', u'список',
+         u'стек', u'очередь', u'хеш', u'строка', u'матрица', u'рекурсия']
+
+
+def build_index(ndocs, seed=1):
+    rnd = random.Random(seed)
+    index = MemoryIndex(attrs=[('lab_id', SPH_ATTR_INTEGER),
+                               ('author_id', SPH_ATTR_INTEGER),
+                               ('created', SPH_ATTR_TIMESTAMP)])
+    for docid in xrange(1, ndocs + 1):
+        text = u' '.join(rnd.choice(WORDS) for i in range(40))
+        index.add(docid, text, lab_id=docid % 40, author_id=docid % 300,
+                  created=1300000000 + docid)
+    return index
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.latencies = []
+        self.decode = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, latency, decode):
+        self.lock.acquire()
+        try:
+            self.latencies.append(latency)
+            self.decode += decode
+        finally:
+            self.lock.release()
+
+    def percentile(self, p):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+
+def timed_decode(client):
+    """
+    Wrap client._ParseSearchResponse to accumulate the time spent in it.
+    """
+    spent = [0.0]
+    parse = client._ParseSearchResponse
+
+    def wrapper(response, nreqs):
+        start = time.time()
+        try:
+            return parse(response, nreqs)
+        finally:
+            spent[0] += time.time() - start
+
+    client._ParseSearchResponse = wrapper
+    return spent
+
+
+def set_server(client, server):
+    if isinstance(server, tuple):
+        client.SetServer(*server)
+    else:
+        client.SetServer(server)
+
+
+def configure(client, server, nresults):
+    set_server(client, server)
+    client.SetMatchMode(SPH_MATCH_ANY)
+    client.SetLimits(0, nresults, max(nresults, 1000))
+
+
+def run_sync(make_client, server, index, batch, nresults, requests, threads):
+    """
+    threads workers, each with its own client, issuing requests of batch
+    queries one after another.
+    """
+    timings = Timings()
+    per_thread = max(1, requests / threads)
+    errors = []
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        client = make_client()
+        configure(client, server, nresults)
+        spent = timed_decode(client)
+        try:
+            for i in xrange(per_thread):
+                for q in range(batch):
+                    client.AddQuery(rnd.choice(WORDS).encode('utf-8'), index)
+                decoded = spent[0]
+                start = time.time()
+                results = client.RunQueries()
+                latency = time.time() - start
+                if results is None:
+                    errors.append(client.GetLastError())
+                    return
+                timings.add(latency, spent[0] - decoded)
+        finally:
+            if client._socket:
+                client.Close()
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if errors:
+        sys.exit('benchmark failed: %s' % errors[0])
+    return time.time() - start, timings
+
+
+class TimedAsyncClient(AsyncSphinxClient):
+    """
+    AsyncSphinxClient accumulating the time its requests spend decoding.
+    Responses are parsed by the request, not through the client.
+    """
+
+    decode = 0.0
+
+    def _Submit(self, packet, client_ver, parse, failed):
+        def timed(parser, response):
+            start = time.time()
+            try:
+                return parse(parser, response)
+            finally:
+                self.decode += time.time() - start
+        return AsyncSphinxClient._Submit(self, packet, client_ver, timed, failed)
+
+
+def run_async(server, index, batch, nresults, requests, threads):
+    """
+    One reactor with threads connections and threads requests in flight.
+    """
+    timings = Timings()
+    reactor = SphinxReactor(max_connections=threads)
+    client = TimedAsyncClient(reactor)
+    configure(client, server, nresults)
+    rnd = random.Random(0)
+
+    start = time.time()
+    inflight = []
+    done = 0
+    try:
+        while done < requests:
+            while len(inflight) < threads and done + len(inflight) < requests:
+                for q in range(batch):
+                    client.AddQuery(rnd.choice(WORDS).encode('utf-8'), index)
+                inflight.append(client.RunQueriesAsync())
+            reactor.poll(1.0)
+            for req in [r for r in inflight if r.done]:
+                inflight.remove(req)
+                if req.value is None:
+                    sys.exit('benchmark failed: %s' % req.error)
+                timings.add(req.elapsed, 0.0)
+                done += 1
+        elapsed = time.time() - start
+    finally:
+        reactor.close()
+    timings.decode = client.decode
+    return elapsed, timings
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--server', help='HOST:PORT or socket path of a real searchd')
+    parser.add_option('--index', default='bench', help='index to query')
+    parser.add_option('--docs', type='int', default=5000, help='emulated corpus size')
+    parser.add_option('--batches', default='1,8,32', help='queries per request')
+    parser.add_option('--results', default='10,100,1000', help='matches per query')
+    parser.add_option('--requests', type='int', default=200, help='requests per run')
+    parser.add_option('--threads', type='int', default=4, help='concurrent clients')
+    parser.add_option('--clients', default='plain,persistent,pooled,async',
+                      help='client flavours to run')
+    options, args = parser.parse_args()
+
+    emulator = None
+    if options.server:
+        server = options.server
+        if ':' in server:
+            host, port = server.rsplit(':', 1)
+            server = (host, int(port))
+    else:
+        emulator = SearchdEmulator({options.index: build_index(options.docs)}).start()
+        server = emulator.address
+
+    pool = None
+    if isinstance(server, tuple):
+        pool = SphinxConnectionPool(server[0], server[1], max_connections=options.threads)
+    else:
+        pool = SphinxConnectionPool(server, None, max_connections=options.threads)
+
+    def persistent():
+        client = SphinxClient()
+        set_server(client, server)
+        client.Open()
+        return client
+
+    def pooled():
+        client = PooledSphinxClient()
+        client.SetPool(pool)
+        return client
+
+    flavours = {'plain': SphinxClient, 'persistent': persistent, 'pooled': pooled}
+    clients = options.clients.split(',')
+
+    print '%-10s %5s %6s %9s %9s %9s %9s %7s' % (
+        'client', 'batch', 'limit', 'req/s', 'query/s', 'p50 ms', 'p99 ms', 'decode')
+    try:
+        for batch in [int(x) for x in options.batches.split(',')]:
+            for nresults in [int(x) for x in options.results.split(',')]:
+                for name in clients:
+                    if name == 'async':
+                        elapsed, timings = run_async(server, options.index, batch, nresults,
+                                                     options.requests, options.threads)
+                    else:
+                        elapsed, timings = run_sync(flavours[name], server, options.index,
+                                                    batch, nresults, options.requests,
+                                                    options.threads)
+                    nreq = len(timings.latencies)
+                    busy = sum(timings.latencies)
+                    print '%-10s %5d %6d %9.1f %9.1f %9.2f %9.2f %6.1f%%' % (
+                        name, batch, nresults, nreq / elapsed, nreq * batch / elapsed,
+                        timings.percentile(0.5) * 1000, timings.percentile(0.99) * 1000,
+                        busy and 100.0 * timings.decode / busy or 0.0)
+    finally:
+        pool.close()
+        if emulator is not None:
+            emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of SphinxClient search response decoding.
+
+Compares SphinxClient._ParseSearchResponse, in the default and columnar
+result modes, against the old slice-and-unpack parser on a large search
+response. By default the response is synthesized (max-matches sized
+results with several attributes); a recorded payload can be used instead:
+
+    python helpers/bench_sphinx_decode.py
+    python helpers/bench_sphinx_decode.py --record host:port index "query" resp.bin
+    python helpers/bench_sphinx_decode.py --response resp.bin
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+from struct import unpack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.sphinxapi import SphinxClient, SEARCHD_OK, SEARCHD_WARNING, \
+    SPH_ATTR_INTEGER, SPH_ATTR_TIMESTAMP, SPH_ATTR_FLOAT, SPH_ATTR_BIGINT, \
+    SPH_ATTR_MULTI
+from lib.sphinxemu import encode_result
+
+
+def synthesize(nreqs, nmatches, mva=False):
+    attrs = [('lab_id', SPH_ATTR_INTEGER), ('project_id', SPH_ATTR_INTEGER),
+             ('author_id', SPH_ATTR_INTEGER), ('created', SPH_ATTR_TIMESTAMP),
+             ('score', SPH_ATTR_FLOAT), ('sha_prefix', SPH_ATTR_BIGINT)]
+    if mva:
+        attrs.append(('tags', SPH_ATTR_MULTI | SPH_ATTR_INTEGER))
+    results = []
+    for r in range(nreqs):
+        matches = []
+        for i in range(nmatches):
+            values = [i % 40, i % 300, i % 120, 1300000000 + i, i / 7.0, i * 7919]
+            if mva:
+                values.append(range(i % 5))
+            matches.append((r * 1000000 + i, 1000 - i % 1000, values))
+        words = [('word%d' % w, 100 + w, 300 + w) for w in range(5)]
+        results.append(encode_result(['title', 'body'], attrs, matches, words,
+                                     total_found=nmatches * 3, time_ms=12))
+    return ''.join(results)
+
+
+def legacy_parse(response, nreqs):
+    """
+    The parser as it was before precompiled structs: a fresh slice and
+    unpack() per field. Kept here as the comparison baseline.
+    """
+    max_ = len(response)
+    p = 0
+    results = []
+    for i in range(0, nreqs, 1):
+        result = {}
+        results.append(result)
+        result['error'] = ''
+        result['warning'] = ''
+        status = unpack('>L', response[p:p+4])[0]
+        p += 4
+        result['status'] = status
+        if status != SEARCHD_OK:
+            length = unpack('>L', response[p:p+4])[0]
+            p += 4
+            message = response[p:p+length]
+            p += length
+            if status == SEARCHD_WARNING:
+                result['warning'] = message
+            else:
+                result['error'] = message
+                continue
+        fields = []
+        attrs = []
+        nfields = unpack('>L', response[p:p+4])[0]
+        p += 4
+        while nfields > 0 and p < max_:
+            nfields -= 1
+            length = unpack('>L', response[p:p+4])[0]
+            p += 4
+            fields.append(response[p:p+length])
+            p += length
+        result['fields'] = fields
+        nattrs = unpack('>L', response[p:p+4])[0]
+        p += 4
+        while nattrs > 0 and p < max_:
+            nattrs -= 1
+            length = unpack('>L', response[p:p+4])[0]
+            p += 4
+            attr = response[p:p+length]
+            p += length
+            type_ = unpack('>L', response[p:p+4])[0]
+            p += 4
+            attrs.append([attr, type_])
+        result['attrs'] = attrs
+        count = unpack('>L', response[p:p+4])[0]
+        p += 4
+        id64 = unpack('>L', response[p:p+4])[0]
+        p += 4
+        result['matches'] = []
+        while count > 0 and p < max_:
+            count -= 1
+            if id64:
+                doc, weight = unpack('>QL', response[p:p+12])
+                p += 12
+            else:
+                doc, weight = unpack('>2L', response[p:p+8])
+                p += 8
+            match = {'id': doc, 'weight': weight, 'attrs': {}}
+            for i in range(len(attrs)):
+                if attrs[i][1] == SPH_ATTR_FLOAT:
+                    match['attrs'][attrs[i][0]] = unpack('>f', response[p:p+4])[0]
+                elif attrs[i][1] == SPH_ATTR_BIGINT:
+                    match['attrs'][attrs[i][0]] = unpack('>q', response[p:p+8])[0]
+                    p += 4
+                elif attrs[i][1] == (SPH_ATTR_MULTI | SPH_ATTR_INTEGER):
+                    match['attrs'][attrs[i][0]] = []
+                    nvals = unpack('>L', response[p:p+4])[0]
+                    p += 4
+                    for n in range(0, nvals, 1):
+                        match['attrs'][attrs[i][0]].append(unpack('>L', response[p:p+4])[0])
+                        p += 4
+                    p -= 4
+                else:
+                    match['attrs'][attrs[i][0]] = unpack('>L', response[p:p+4])[0]
+                p += 4
+            result['matches'].append(match)
+        result['total'], result['total_found'], result['time'], words = unpack('>4L', response[p:p+16])
+        result['time'] = '%.3f' % (result['time'] / 1000.0)
+        p += 16
+        result['words'] = []
+        while words > 0:
+            words -= 1
+            length = unpack('>L', response[p:p+4])[0]
+            p += 4
+            word = response[p:p+length]
+            p += length
+            docs, hits = unpack('>2L', response[p:p+8])
+            p += 8
+            result['words'].append({'word': word, 'docs': docs, 'hits': hits})
+    return results
+
+
+def record(server, index, query, path):
+    """
+    Run a query against a live searchd and save the raw response payload.
+    """
+    captured = []
+
+    class RecordingClient(SphinxClient):
+        def _GetResponse(self, sock, client_ver):
+            response = SphinxClient._GetResponse(self, sock, client_ver)
+            captured.append(response)
+            return response
+
+    host, port = server.rsplit(':', 1)
+    cl = RecordingClient()
+    cl.SetServer(host, int(port))
+    cl.SetLimits(0, 1000, 1000)
+    if cl.Query(query, index) is None:
+        sys.exit('query failed: %s' % cl.GetLastError())
+    f = open(path, 'wb')
+    f.write(captured[0])
+    f.close()
+    print 'saved %d bytes to %s' % (len(captured[0]), path)
+
+
+def best_of(func, repeat, number):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        for j in range(number):
+            func()
+        timings.append((time.time() - start) / number)
+    return min(timings)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--response', help='recorded single-query response payload')
+    parser.add_option('--record', nargs=4, metavar='HOST:PORT INDEX QUERY FILE',
+                      help='record a response payload from a live searchd')
+    parser.add_option('--queries', type='int', default=8, help='multi-query size (synthetic)')
+    parser.add_option('--matches', type='int', default=1000, help='matches per query (synthetic)')
+    parser.add_option('--mva', action='store_true', help='add an MVA attribute (synthetic)')
+    parser.add_option('--repeat', type='int', default=5)
+    parser.add_option('--number', type='int', default=10)
+    options, args = parser.parse_args()
+
+    if options.record:
+        record(*options.record)
+        return
+
+    if options.response:
+        response = open(options.response, 'rb').read()
+        nreqs = 1
+    else:
+        nreqs = options.queries
+        response = synthesize(nreqs, options.matches, options.mva)
+
+    cl = SphinxClient()
+    assert cl._ParseSearchResponse(response, nreqs) == legacy_parse(response, nreqs), \
+        'decoders disagree'
+
+    nmatches = sum(len(r.get('matches', [])) for r in legacy_parse(response, nreqs))
+    print 'response: %d bytes, %d queries, %d matches' % (len(response), nreqs, nmatches)
+    old = best_of(lambda: legacy_parse(response, nreqs), options.repeat, options.number)
+    new = best_of(lambda: cl._ParseSearchResponse(response, nreqs), options.repeat, options.number)
+    columnar = SphinxClient()
+    columnar.SetColumnarResult(True)
+    cols = best_of(lambda: columnar._ParseSearchResponse(response, nreqs), options.repeat, options.number)
+    for name, t in (('slice+unpack', old), ('precompiled', new), ('columnar', cols)):
+        print '%-14s %8.2f ms/response %8.2f us/match' % (name, t * 1000, t * 1e6 / max(nmatches, 1))
+    print 'speedup: %.2fx, columnar %.2fx' % (old / new, old / cols)
+
+
+if __name__ == '__main__':
+    main()
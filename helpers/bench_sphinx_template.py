@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark of query serialization: AddQuery() against a frozen
+SphinxQueryTemplate with the settings of a fingerprint lookup (filters,
+field weights, select list).
+
+    python helpers/bench_sphinx_template.py
+    python helpers/bench_sphinx_template.py --queries 100000 --filters 8
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.sphinxapi import SphinxClient, SPH_MATCH_PHRASE, SPH_RANK_NONE
+
+
+def configure(nfilters):
+    cl = SphinxClient()
+    cl.SetMatchMode(SPH_MATCH_PHRASE)
+    cl.SetRankingMode(SPH_RANK_NONE)
+    cl.SetLimits(0, 50, 1000)
+    cl.SetFieldWeights({'text': 10, 'title': 1})
+    cl.SetSelect('id, lab_id, author_id')
+    for i in range(nfilters):
+        cl.SetFilter('attr%d' % i, range(i, i + 20), exclude=bool(i % 2))
+    cl.SetFilterRange('created', 1300000000, 1400000000)
+    return cl
+
+
+def best_of(func, repeat):
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--queries', type='int', default=10000)
+    parser.add_option('--filters', type='int', default=4, help='values filters to set')
+    parser.add_option('--repeat', type='int', default=5)
+    options, args = parser.parse_args()
+
+    cl = configure(options.filters)
+    phrases = ['shingle number %d of the text' % i for i in range(options.queries)]
+
+    def plain():
+        for phrase in phrases:
+            cl.AddQuery(phrase, 'submissions')
+        cl._reqs = []
+
+    def frozen():
+        template = cl.FreezeQuery()
+        for phrase in phrases:
+            cl.AddFrozenQuery(template, phrase, 'submissions')
+        cl._reqs = []
+
+    cl.AddQuery(phrases[0], 'submissions')
+    cl.AddFrozenQuery(cl.FreezeQuery(), phrases[0], 'submissions')
+    assert cl._reqs[0] == cl._reqs[1], 'serializations differ'
+    cl._reqs = []
+
+    print '%d queries, %d bytes each' % (options.queries, len(cl.FreezeQuery().Build(phrases[0])))
+    old = best_of(plain, options.repeat)
+    new = best_of(frozen, options.repeat)
+    for name, t in (('AddQuery', old), ('template', new)):
+        print '%-10s %8.2f ms %8.2f us/query' % (name, t * 1000, t * 1e6 / options.queries)
+    print 'speedup: %.1fx' % (old / new)
+
+
+if __name__ == '__main__':
+    main()
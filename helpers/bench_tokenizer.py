@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput of the streaming tokenizer in MB/s, on a generated Russian
+text or on given files.
+
+    python helpers/bench_tokenizer.py
+    python helpers/bench_tokenizer.py --size 50 --chunk 262144
+    python helpers/bench_tokenizer.py --encoding cp1251 thesis.txt
+"""
+
+import os
+import random
+import sys
+import time
+from StringIO import StringIO
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.tokenizer import Vocabulary, token_id_chunks, words
+
+
+WORDS = (u'Лабораторная работа посвящена исследованию алгоритмов сортировки; '
+         u'в ней рассмотрены её основные свойства, оценки сложности O(n log n) '
+         u'и результаты 12 экспериментов. Ёмкость памяти — 256 МБ, «быстрая» '
+         u'сортировка оказалась лучше пирамидальной.').split()
+
+
+def generate(megabytes, encoding, seed=1):
+    rnd = random.Random(seed)
+    lines = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        line = (u' '.join(rnd.choice(WORDS) for i in range(12)) + u'\n').encode(encoding)
+        lines.append(line)
+        size += len(line)
+    return ''.join(lines)
+
+
+def run(data, encoding, chunk):
+    vocabulary = Vocabulary()
+    tokens = 0
+    start = time.time()
+    for ids in token_id_chunks(StringIO(data), vocabulary, encoding, chunk):
+        tokens += len(ids)
+    return time.time() - start, tokens, len(vocabulary)
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [file ...]')
+    parser.add_option('--size', type='int', default=20, help='generated text size, MB')
+    parser.add_option('--encoding', default='utf-8')
+    parser.add_option('--chunk', type='int', default=65536, help='bytes read at a time')
+    parser.add_option('--repeat', type='int', default=3)
+    options, args = parser.parse_args()
+
+    if args:
+        inputs = [(path, open(path, 'rb').read()) for path in args]
+    else:
+        inputs = [('generated', generate(options.size, options.encoding))]
+
+    for name, data in inputs:
+        mb = len(data) / 1048576.0
+        elapsed, tokens, vocabulary = min(run(data, options.encoding, options.chunk)
+                                          for i in range(options.repeat))
+        print '%s: %.1f MB, %d tokens, %d distinct' % (name, mb, tokens, vocabulary)
+        print '  streaming  %7.2f s %7.1f MB/s %9.0f tokens/s' % (
+            elapsed, mb / elapsed, tokens / elapsed)
+
+        start = time.time()
+        whole = len(words(data.decode(options.encoding, 'replace')))
+        elapsed = time.time() - start
+        assert whole == tokens, 'streaming and whole-text tokenization differ'
+        print '  whole text %7.2f s %7.1f MB/s (one string, for reference)' % (
+            elapsed, mb / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+"""
+Throughput of winnowing fingerprinting in MB/s, on a generated code
+archive or on the source files under given directories.
+
+    python helpers/bench_winnow.py
+    python helpers/bench_winnow.py --size 50 --k 5 --guarantee 12
+    python helpers/bench_winnow.py ~/labs/2011/
+"""
+
+import os
+import random
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.tokenizer import guess_encoding
+from lib.winnow import Winnower, scan, language, EXTENSIONS
+
+
+LINES = (
+    u'for (int {0} = 0; {0} < {1}; {0}++) {{',
+    u'    {1}[{0}] = {1}[{0}] * 2 + {2};',
+    u'}}',
+    u'if ({0} > {2} && {1} != null) {{ return {0}; }}',
+    u'// пересчитываем {0} для следующего шага',
+    u'double {0} = sqrt({1} * {1} + {2} * 0.5);',
+    u'printf("%d\\n", {0});',
+    u'while ({0}-- > 0) {1} += {2};',
+)
+NAMES = 'i j k n count total result arr data buf x y value tmp'.split()
+
+
+def generate(megabytes, seed=1):
+    rnd = random.Random(seed)
+    files = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        lines = [rnd.choice(LINES).format(*rnd.sample(NAMES, 3)) for i in range(200)]
+        source = u'\n'.join(lines)
+        files.append((source, 'c'))
+        size += len(source.encode('utf-8'))
+    return files
+
+
+def read_tree(paths):
+    files = []
+    for path in paths:
+        for directory, subdirs, names in os.walk(path):
+            for name in names:
+                if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                    data = open(os.path.join(directory, name), 'rb').read()
+                    files.append((data.decode(guess_encoding(data[:65536]), 'replace'),
+                                  language(name)))
+    return files
+
+
+def run(files, winnower):
+    fingerprints = 0
+    tokens = 0
+    start = time.time()
+    for source, lang in files:
+        selected = winnower.fingerprint_source(source, lang)
+        fingerprints += len(selected)
+    elapsed = time.time() - start
+    for source, lang in files:
+        tokens += len(scan(source, lang)[0])
+    return elapsed, tokens, fingerprints
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [directory ...]')
+    parser.add_option('--size', type='int', default=10, help='generated archive size, MB')
+    parser.add_option('--k', type='int', default=5, help='noise threshold, tokens')
+    parser.add_option('--guarantee', type='int', default=12, help='guarantee threshold, tokens')
+    options, args = parser.parse_args()
+
+    files = args and read_tree(args) or generate(options.size)
+    mb = sum(len(source.encode('utf-8')) for source, lang in files) / 1048576.0
+    winnower = Winnower(options.k, options.guarantee)
+    elapsed, tokens, fingerprints = run(files, winnower)
+    print '%d files, %.1f MB, %d tokens' % (len(files), mb, tokens)
+    print 'k=%d guarantee=%d window=%d: %d fingerprints (%.3f per token, expected %.3f)' % (
+        winnower.k, winnower.guarantee, winnower.window, fingerprints,
+        float(fingerprints) / max(tokens, 1), 2.0 / (winnower.window + 1))
+    print '%.2f s, %.1f MB/s, %.0f tokens/s' % (elapsed, mb / elapsed, tokens / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+
+"""
+Content-addressed file store.
+
+Every file is kept once under the sha1 of its bytes, in directories
+sharded by the leading hex digits of the hash so none of them grows too
+large:
+
+    store = BlobStore('/var/lib/antiplag/blobs')
+    sha1, size, created = store.put(request.FILES['report'])
+    # <root>/3f/a2/3fa2...c1; created is False if the bytes were there already
+    data = store.open(sha1).read()
+
+Files are streamed to a temporary file while hashing and renamed into
+place, so readers never see a partial blob and storing the same bytes
+twice concurrently is harmless. Derived data (fingerprints, signatures)
+can be kept next to a blob as named sidecars:
+
+    store.put_sidecar(sha1, 'minhash', signature.tostring())
+    store.get_sidecar(sha1, 'minhash')
+"""
+
+import errno
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+
+CHUNK = 65536
+
+_SHA1 = re.compile(r'^[0-9a-f]{40}$')
+_SIDECAR = re.compile(r'^[0-9A-Za-z_-]+$')
+
+
+class BlobError(Exception):
+    """Bad blob hash or sidecar name"""
+    pass
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class BlobStore(object):
+    """
+    Blobs under root, sharded by depth levels of width hex digits each.
+    """
+
+    def __init__(self, root, depth=2, width=2):
+        assert depth * width < 40
+        self.root = root
+        self.depth = depth
+        self.width = width
+        self._tmp = os.path.join(root, 'tmp')
+
+    def path(self, sha1):
+        if not _SHA1.match(sha1):
+            raise BlobError('not a sha1 hash: %r' % sha1)
+        parts = [sha1[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+        return os.path.join(self.root, *(parts + [sha1]))
+
+    def exists(self, sha1):
+        return os.path.exists(self.path(sha1))
+
+    def put(self, data):
+        """
+        Stores data (a str or a file-like object, read in chunks). Returns
+        (sha1, size, created); created is False if the blob existed.
+        """
+        _makedirs(self._tmp)
+        fd, tmp = tempfile.mkstemp(dir=self._tmp)
+        try:
+            digest = hashlib.sha1()
+            size = 0
+            f = os.fdopen(fd, 'wb')
+            try:
+                for chunk in self._chunks(data):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+
+            sha1 = digest.hexdigest()
+            path = self.path(sha1)
+            if os.path.exists(path):
+                return sha1, size, False
+            _makedirs(os.path.dirname(path))
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+            tmp = None
+            return sha1, size, True
+        finally:
+            if tmp is not None:
+                os.unlink(tmp)
+
+    def open(self, sha1):
+        return open(self.path(sha1), 'rb')
+
+    def read(self, sha1):
+        f = self.open(sha1)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def delete(self, sha1):
+        """
+        Removes the blob and its sidecars. The caller makes sure nothing
+        refers to it any more.
+        """
+        path = self.path(sha1)
+        directory = os.path.dirname(path)
+        for name in os.listdir(directory):
+            if name == sha1 or name.startswith(sha1 + '.'):
+                os.unlink(os.path.join(directory, name))
+
+    def sidecar_path(self, sha1, name):
+        if not _SIDECAR.match(name):
+            raise BlobError('bad sidecar name: %r' % name)
+        return '%s.%s' % (self.path(sha1), name)
+
+    def put_sidecar(self, sha1, name, data):
+        """
+        Stores (or replaces) the sidecar name of blob sha1 atomically.
+        """
+        path = self.sidecar_path(sha1, name)
+        _makedirs(os.path.dirname(path))
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + sha1)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            os.chmod(tmp, 0644)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def get_sidecar(self, sha1, name):
+        """
+        The sidecar's bytes, None if there is none.
+        """
+        try:
+            f = open(self.sidecar_path(sha1, name), 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def _chunks(self, data):
+        if isinstance(data, str):
+            yield data
+            return
+        if hasattr(data, 'chunks'):
+            # Django's File and UploadedFile
+            for chunk in data.chunks(CHUNK):
+                yield chunk
+            return
+        while True:
+            chunk = data.read(CHUNK)
+            if not chunk:
+                break
+            yield chunk
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def get_default_store():
+    """
+    Project-wide BlobStore under settings.BLOB_ROOT.
+    """
+    global _default_store
+    _default_store_lock.acquire()
+    try:
+        if _default_store is None:
+            from django.conf import settings
+            _default_store = BlobStore(getattr(settings, 'BLOB_ROOT', '../blobs/'))
+        return _default_store
+    finally:
+        _default_store_lock.release()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""
+Locality-sensitive hashing of MinHash signatures.
+
+A signature of bands * rows values is cut into bands; each band is hashed
+into a bucket, and two documents become a candidate pair when they share a
+bucket in any band. Pairs with Jaccard similarity s collide with
+probability 1 - (1 - s^rows)^bands, an S-curve whose steep part sits near
+(1/bands)^(1/rows). LSH picks bands and rows for a similarity threshold,
+weighing false positives (extra comparisons) against false negatives
+(missed copies):
+
+    lsh = LSH(num_perm=128, threshold=0.6)
+    lsh.bands, lsh.rows                 # 18, 7
+    for band, bucket in enumerate(lsh.buckets(signature)):
+        ...                             # see LSHBucket in pagesmisc.models
+"""
+
+import hashlib
+import struct
+
+
+def probability(s, bands, rows):
+    """
+    Probability that documents of Jaccard similarity s share a bucket.
+    """
+    return 1.0 - (1.0 - s ** rows) ** bands
+
+
+def _integral(func, a, b, steps=100):
+    # midpoint rule, plenty for these smooth curves
+    width = (b - a) / steps
+    return sum(func(a + (i + 0.5) * width) for i in range(steps)) * width
+
+
+def optimal_params(num_perm, threshold, fp_weight=0.5, fn_weight=0.5):
+    """
+    (bands, rows) with bands * rows <= num_perm minimizing the weighted
+    areas of false positives (below threshold) and false negatives
+    (above it) under the collision curve.
+    """
+    assert 0.0 < threshold < 1.0
+    best, best_error = None, None
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm / bands + 1):
+            fp = _integral(lambda s: probability(s, bands, rows), 0.0, threshold)
+            fn = _integral(lambda s: 1.0 - probability(s, bands, rows), threshold, 1.0)
+            error = fp_weight * fp + fn_weight * fn
+            if best_error is None or error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+class LSH(object):
+    """
+    Banding of num_perm long signatures, into the given bands and rows or
+    into the ones optimal_params() picks for threshold. Buckets depend on
+    rows, so buckets made with other parameters never match.
+    """
+
+    def __init__(self, num_perm=128, threshold=0.5, bands=None, rows=None,
+                 fp_weight=0.5, fn_weight=0.5):
+        if bands is None or rows is None:
+            bands, rows = optimal_params(num_perm, threshold, fp_weight, fn_weight)
+        assert bands * rows <= num_perm, 'bands * rows exceeds the signature length'
+        self.num_perm = num_perm
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = rows
+        self._pack = struct.Struct('<H%dI' % rows).pack
+
+    def probability(self, s):
+        return probability(s, self.bands, self.rows)
+
+    def buckets(self, signature):
+        """
+        Bucket of every band of signature, signed 64-bit integers (SQLite
+        INTEGER, BigIntegerField).
+        """
+        assert len(signature) == self.num_perm, 'signature of another length'
+        rows = self.rows
+        buckets = []
+        for band in range(self.bands):
+            values = signature[band * rows:(band + 1) * rows]
+            digest = hashlib.sha1(self._pack(rows, *[int(v) for v in values])).digest()
+            buckets.append(struct.unpack('<q', digest[:8])[0])
+        return buckets
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from lib.sphinxdelta import get_default_manager, IndexerError
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild',
+            help='Reindex everything into the main index.'),
+        make_option('--merge', action='store_true', dest='merge',
+            help='Merge the delta index into the main one now.'),
+        make_option('--status', action='store_true', dest='status',
+            help='Only show how fresh the indexes are.'),
+    )
+    help = ("Brings the Sphinx delta index up to date and merges it into the main "
+            "index when it is due (run it from cron).")
+
+    def handle_noargs(self, **options):
+        manager = get_default_manager()
+        try:
+            if options.get('rebuild'):
+                manager.rebuild()
+            elif options.get('merge'):
+                manager.merge()
+            elif not options.get('status'):
+                done = manager.update()
+                if int(options.get('verbosity', 1)) > 1:
+                    print 'updated: %s' % (', '.join(done) or 'nothing')
+        except IndexerError, e:
+            raise CommandError(str(e))
+
+        if options.get('status') or int(options.get('verbosity', 1)) > 1:
+            freshness = manager.freshness()
+            print 'indexes: %s' % manager.indexes()
+            for key in sorted(freshness):
+                print '%s: %s' % (key, freshness[key])
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+from optparse import make_option
+import sys
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import models, reset_queries
+
+from lib.sphinxdelta import get_default_manager
+from lib.xmlpipe import XmlPipeWriter
+
+# Sphinx attribute, xmlpipe2 type, model attribute
+ATTRS = (
+    ('lab', 'int', 'lab_id'),
+    ('project', 'int', 'project_id'),
+    ('author', 'int', 'author_id'),
+    ('timestamp', 'timestamp', 'created'),
+)
+
+
+def iter_keyset(queryset, chunk, min_id=None, max_id=None):
+    """
+    Yields the objects of queryset in primary key order, fetching chunk
+    rows per query (pk > last seen), so neither side holds more than a chunk.
+    """
+    queryset = queryset.order_by('pk')
+    if max_id is not None:
+        queryset = queryset.filter(pk__lte=max_id)
+    if min_id is not None:
+        queryset = queryset.filter(pk__gte=min_id)
+    last = None
+    while True:
+        page = queryset
+        if last is not None:
+            page = page.filter(pk__gt=last)
+        rows = list(page[:chunk])
+        for row in rows:
+            yield row
+        if len(rows) < chunk:
+            break
+        last = rows[-1].pk
+        # DEBUG keeps every query in connection.queries
+        reset_queries()
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--model', dest='model',
+            default=getattr(settings, 'SPHINX_SOURCE_MODEL', 'pagesmisc.Submission'),
+            help='Model to index, as app_label.ModelName (SPHINX_SOURCE_MODEL).'),
+        make_option('--text-field', dest='text_field',
+            default=getattr(settings, 'SPHINX_SOURCE_TEXT', 'open_text'),
+            help='Model attribute with the document text, or a method returning it '
+                 'or a file-like object to stream it from (SPHINX_SOURCE_TEXT).'),
+        make_option('--min-id', dest='min_id', type='int',
+            help='Only documents with this ID or above.'),
+        make_option('--max-id', dest='max_id', type='int',
+            help='Only documents with this ID or below.'),
+        make_option('--range', dest='range', choices=('main', 'delta'),
+            help='Only the documents of the main or delta index (see sphinx_index).'),
+        make_option('--chunk', dest='chunk', type='int', default=500,
+            help='Rows fetched per database query.'),
+    )
+    help = ("Writes the submissions as an xmlpipe2 document set to stdout, "
+            "for the xmlpipe_command of a Sphinx source.")
+
+    def handle_noargs(self, **options):
+        model = self.get_model(options['model'])
+        text_field = options['text_field']
+        if options['chunk'] <= 0:
+            raise CommandError('--chunk must be positive')
+
+        min_id, max_id = options['min_id'], options['max_id']
+        if options['range']:
+            min_id, max_id = get_default_manager().source_range(options['range'])
+
+        writer = XmlPipeWriter(sys.stdout, ['content'],
+                               [(name, type) for name, type, attr in ATTRS])
+        writer.start()
+        objects = iter_keyset(model._default_manager.all(), options['chunk'],
+                              min_id, max_id)
+        for obj in objects:
+            content = getattr(obj, text_field)
+            if callable(content):
+                content = content()
+            try:
+                writer.document(obj.pk, {'content': content},
+                                dict((name, getattr(obj, attr, 0))
+                                     for name, type, attr in ATTRS))
+            finally:
+                if hasattr(content, 'close'):
+                    content.close()
+        writer.close()
+
+    def get_model(self, name):
+        try:
+            app_label, model_name = name.split('.')
+        except ValueError:
+            raise CommandError("Model must be given as app_label.ModelName, not '%s'" % name)
+        model = models.get_model(app_label, model_name)
+        if model is None:
+            raise CommandError("Unknown model '%s'" % name)
+        return model
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+"""
+MinHash signatures of submissions.
+
+A signature is num_perm minimums of the document's shingle hashes under
+num_perm random hash functions; the share of positions where two
+signatures agree estimates the Jaccard similarity of the documents'
+shingle sets. With NumPy every chunk of shingles goes through all the
+hash functions in one broadcasted array operation; without it the same
+signatures are computed, slowly, in pure Python.
+
+    sketcher = MinHashSketcher(num_perm=128, shingle=5)
+    ids = token_id_chunks(submission.open(), HashedVocabulary())
+    signature = sketcher.signature(ids)
+    sketcher.save(store, submission.sha1, signature)   # a blob sidecar
+    jaccard(signature, sketcher.load(store, other.sha1))
+
+Token IDs must be stable between processes (HashedVocabulary), or
+signatures stored earlier can't be compared with new ones. Signatures are
+uint32 vectors, stored as little-endian bytes: 512 bytes at 128
+permutations.
+"""
+
+import random
+import sys
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MASK32 = 0xFFFFFFFF
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# odd multiplier of the polynomial shingle hash
+_SHINGLE_BASE = 0x9E3779B97F4A7C15
+
+# shingles hashed through all the permutations at once, bounds the
+# num_perm x _BLOCK intermediate array
+_BLOCK = 4096
+
+
+def jaccard(a, b):
+    """
+    Jaccard similarity estimated from two signatures of the same sketcher.
+    """
+    assert len(a) == len(b)
+    if numpy is not None:
+        return float(numpy.count_nonzero(numpy.asarray(a) == numpy.asarray(b))) / len(a)
+    return float(sum(1 for x, y in zip(a, b) if x == y)) / len(a)
+
+
+class MinHashSketcher(object):
+    """
+    Turns token ID streams into num_perm long MinHash signatures over
+    shingles of shingle consecutive tokens. Sketchers with the same
+    num_perm, shingle and seed produce comparable signatures.
+    """
+
+    def __init__(self, num_perm=128, shingle=5, seed=1):
+        assert num_perm > 0 and shingle > 0
+        self.num_perm = num_perm
+        self.shingle = shingle
+        self.seed = seed
+        # multiply-shift hashing: h(x) = ((a * x + b) mod 2^64) >> 32, a odd
+        rnd = random.Random(seed)
+        self._a = [rnd.getrandbits(64) | 1 for i in range(num_perm)]
+        self._b = [rnd.getrandbits(64) for i in range(num_perm)]
+        if numpy is not None:
+            self._na = numpy.array(self._a, dtype=numpy.uint64).reshape(num_perm, 1)
+            self._nb = numpy.array(self._b, dtype=numpy.uint64).reshape(num_perm, 1)
+
+    def sidecar(self):
+        """
+        Blob sidecar name of this sketcher's signatures.
+        """
+        return 'minhash-%d-%d-%d' % (self.num_perm, self.shingle, self.seed)
+
+    def signature(self, id_chunks):
+        """
+        Signature of the tokens in id_chunks, an iterable of token ID
+        sequences (e.g. token_id_chunks()); shingles span the chunks.
+        Documents shorter than a shingle count as one shingle.
+        """
+        if numpy is not None:
+            return self._signature_numpy(id_chunks)
+        return self._signature_python(id_chunks)
+
+    def to_bytes(self, signature):
+        if numpy is not None:
+            return numpy.asarray(signature, dtype='<u4').tostring()
+        signature = array('I', signature)
+        if sys.byteorder == 'big':
+            signature.byteswap()
+        return signature.tostring()
+
+    def from_bytes(self, data):
+        assert len(data) == 4 * self.num_perm, 'signature of another sketcher'
+        if numpy is not None:
+            return numpy.fromstring(data, dtype='<u4').astype(numpy.uint32)
+        signature = array('I', data)
+        if sys.byteorder == 'big':
+            signature.byteswap()
+        return signature
+
+    def save(self, store, sha1, signature):
+        """
+        Keeps signature next to blob sha1 in store (a BlobStore).
+        """
+        store.put_sidecar(sha1, self.sidecar(), self.to_bytes(signature))
+
+    def load(self, store, sha1):
+        """
+        The signature saved for blob sha1, None if there is none.
+        """
+        data = store.get_sidecar(sha1, self.sidecar())
+        if data is None:
+            return None
+        return self.from_bytes(data)
+
+    def _signature_numpy(self, id_chunks):
+        n = self.shingle
+        mins = numpy.empty(self.num_perm, dtype=numpy.uint64)
+        mins.fill(MASK32)
+        tail = numpy.zeros(0, dtype=numpy.uint64)
+        seen = 0
+        for ids in id_chunks:
+            ids = numpy.concatenate((tail, numpy.asarray(ids, dtype=numpy.uint64)))
+            seen += len(ids) - len(tail)
+            if len(ids) >= n:
+                self._update_numpy(mins, self._shingles_numpy(ids))
+            tail = ids[max(0, len(ids) - n + 1):]
+        if 0 < seen < n:
+            self._update_numpy(mins, self._shingles_numpy(tail, len(tail)))
+        return mins.astype(numpy.uint32)
+
+    def _shingles_numpy(self, ids, n=None):
+        n = n or self.shingle
+        count = len(ids) - n + 1
+        # uint64 arithmetic wraps around, which is the mod 2^64 wanted
+        hashes = ids[:count].copy()
+        base = numpy.uint64(_SHINGLE_BASE)
+        for j in range(1, n):
+            hashes *= base
+            hashes += ids[j:j + count]
+        return hashes >> numpy.uint64(32)
+
+    def _update_numpy(self, mins, shingles):
+        shift = numpy.uint64(32)
+        for i in range(0, len(shingles), _BLOCK):
+            x = shingles[i:i + _BLOCK].reshape(1, -1)
+            # (num_perm, 1) against (1, block): every permutation at once
+            hashed = (self._na * x + self._nb) >> shift
+            numpy.minimum(mins, hashed.min(axis=1), mins)
+
+    def _signature_python(self, id_chunks):
+        n = self.shingle
+        mins = [MASK32] * self.num_perm
+        perms = zip(self._a, self._b)
+        window = []
+        for ids in id_chunks:
+            for wid in ids:
+                window.append(wid)
+                if len(window) > n:
+                    del window[0]
+                if len(window) == n:
+                    self._update_python(mins, perms, self._shingle_python(window))
+        if 0 < len(window) < n:
+            self._update_python(mins, perms, self._shingle_python(window))
+        return array('I', mins)
+
+    def _shingle_python(self, window):
+        h = window[0]
+        for wid in window[1:]:
+            h = (h * _SHINGLE_BASE + wid) & MASK64
+        return h >> 32
+
+    def _update_python(self, mins, perms, x):
+        for i, (a, b) in enumerate(perms):
+            h = ((a * x + b) & MASK64) >> 32
+            if h < mins[i]:
+                mins[i] = h
@@ -0,0 +1 @@
+# lib has no models; this module lets manage.py test find lib/tests.py
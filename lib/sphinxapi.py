@@ -15,9 +15,12 @@
 
 import sys
 import select
+from array import array
 import socket
 import re
+import time
 from struct import *
+from itertools import izip
 
 
 # known searchd commands
@@ -95,6 +98,64 @@ SPH_GROUPBY_ATTR		= 4
 SPH_GROUPBY_ATTRPAIR	= 5
 
 
+# bodies shorter than this are sent in one piece with their command header
+_SEND_COALESCE	= 16384
+
+# precompiled decoders for search responses
+_UINT32			= Struct('>L')
+_UINT32x2		= Struct('>2L')
+_UINT32x4		= Struct('>4L')
+_MATCH_PLANS	= {}
+
+# array typecodes of columnar results; 64-bit values fall back to lists where long is 32-bit
+_COLUMN_U64		= array('L').itemsize>=8 and 'L' or None
+_COLUMN_I64		= array('l').itemsize>=8 and 'l' or None
+
+
+def _MatchPlan ( attrs, id64 ):
+	"""
+	INTERNAL FUNCTION, DO NOT CALL. Compiles (and caches) match row decoder for given schema.
+	Returns a list of steps; each step is either a (Struct, names) run of fixed-size values,
+	or (None, name) for a MVA attribute. First step always starts with document ID and weight.
+	"""
+	key = ( id64, tuple([ tuple(attr) for attr in attrs ]) )
+	plan = _MATCH_PLANS.get(key)
+	if plan is not None:
+		return plan
+
+	plan = []
+	codes = [ id64 and 'QL' or '2L' ]
+	names = []
+	for name, type_ in attrs:
+		if type_ == (SPH_ATTR_MULTI | SPH_ATTR_INTEGER):
+			if codes:
+				plan.append ( ( Struct('>'+''.join(codes)), names ) )
+			plan.append ( ( None, name ) )
+			codes, names = [], []
+			continue
+		if type_ == SPH_ATTR_FLOAT:
+			codes.append('f')
+		elif type_ == SPH_ATTR_BIGINT:
+			codes.append('q')
+		else:
+			codes.append('L')
+		names.append(name)
+	if codes:
+		plan.append ( ( Struct('>'+''.join(codes)), names ) )
+
+	_MATCH_PLANS[key] = plan
+	return plan
+
+
+def _MatchCount (result):
+	"""
+	Number of matches in a result set, row or columnar.
+	"""
+	if 'columns' in result:
+		return len(result['columns']['id'])
+	return len(result.get('matches', ()))
+
+
 class SphinxClient:
 	def __init__ (self):
 		"""
@@ -125,6 +186,8 @@ class SphinxClient:
 		self._indexweights	= {}							# per-index weights
 		self._ranker		= SPH_RANK_PROXIMITY_BM25		# ranking mode
 		self._maxquerytime	= 0								# max query time, milliseconds (default is 0, do not limit)
+		self._timeout		= 0								# client-side call timeout, seconds (default is 0, do not limit)
+		self._deadline		= None							# time.time() the command in progress must finish by
 		self._fieldweights	= {}							# per-field-name weights
 		self._overrides		= {}							# per-query attribute values overrides
 		self._select		= '*'							# select-list (attributes or expressions, with optional aliases)
@@ -133,6 +196,11 @@ class SphinxClient:
 		self._warning		= ''							# last warning message
 		self._reqs			= []							# requests array for multi-query
 
+		self._stats			= None							# stats collector (default is None, do not collect)
+		self._columnar		= False							# return columns instead of match hashes
+		self._health		= None							# endpoint health monitor (default is None, always connect)
+		self._call			= None							# stats record of the command in progress
+
 	def __del__ (self):
 		if self._socket:
 			self._socket.close()
@@ -152,6 +220,41 @@ class SphinxClient:
 		return self._warning
 
 
+	def SetTimeout (self, timeout):
+		"""
+		Set client-side timeout of every call, in seconds; covers connecting, sending the
+		request and reading the response. 0 means 'do not limit'.
+		"""
+		assert(isinstance(timeout, (int, long, float)) and timeout>=0)
+		self._timeout = timeout
+
+
+	def SetColumnarResult (self, columnar):
+		"""
+		Return search results as columns: result['columns'] maps 'id', 'weight' and every
+		attribute name to an array.array of values in match order (MVA attributes to a list
+		of arrays), and result['words'] is a {'word', 'docs', 'hits'} table of columns.
+		No 'matches' are built. Arrays support the buffer protocol, numpy.frombuffer() wraps
+		them without copying.
+		"""
+		self._columnar = bool(columnar)
+
+
+	def SetHealthMonitor (self, monitor):
+		"""
+		Set endpoint health monitor (see lib.sphinxhealth.HealthMonitor), or None. Connects to
+		a server whose circuit is open fail at once, and every connect outcome is reported.
+		"""
+		self._health = monitor
+
+
+	def SetStatsCollector (self, collector):
+		"""
+		Set per-call stats collector (see lib.sphinxstats.StatsCollector), or None to stop collecting.
+		"""
+		self._stats = collector
+
+
 	def SetServer (self, host, port = None):
 		"""
 		Set searchd server host and port.
@@ -185,6 +288,23 @@ class SphinxClient:
 			self._socket.close()
 			self._socket = None
 
+		if self._health is None:
+			return self._NewConnection()
+
+		endpoint = self._path or ( self._host, self._port )
+		if not self._health.allow(endpoint):
+			self._error = 'connection to %s skipped (circuit open)' % ( self._path or '%s;%s' % endpoint )
+			return
+		sock = self._NewConnection()
+		self._health.record(endpoint, sock is not None, self._error)
+		return sock
+
+
+	def _NewConnection (self):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Connects to searchd server and exchanges versions.
+		"""
+		sock = None
 		try:
 			if self._path:
 				af = socket.AF_UNIX
@@ -195,6 +315,7 @@ class SphinxClient:
 				addr = ( self._host, self._port )
 				desc = '%s;%s' % addr
 			sock = socket.socket ( af, socket.SOCK_STREAM )
+			self._SetSocketTimeout ( sock )
 			sock.connect ( addr )
 		except socket.error, msg:
 			if sock:
@@ -202,35 +323,176 @@ class SphinxClient:
 			self._error = 'connection to %s failed (%s)' % ( desc, msg )
 			return
 
-		v = unpack('>L', sock.recv(4))
+		if af == socket.AF_INET:
+			# requests are written with as few sends as possible, don't let Nagle hold them back
+			sock.setsockopt ( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+
+		try:
+			v = self._Recv(sock, 4)
+		except socket.timeout:
+			sock.close()
+			self._error = 'timed out reading searchd protocol version from %s' % desc
+			return
+		if len(v)<4:
+			sock.close()
+			self._error = 'failed to read searchd protocol version from %s' % desc
+			return
+		v = unpack('>L', v)[0]
 		if v<1:
 			sock.close()
 			self._error = 'expected searchd protocol version, got %s' % v
 			return
 
 		# all ok, send my version
-		sock.send(pack('>L', 1))
+		sock.sendall(pack('>L', 1))
 		return sock
 
 
-	def _GetResponse (self, sock, client_ver):
+	def _Begin (self, command):
 		"""
-		INTERNAL METHOD, DO NOT CALL. Gets and checks response packet from searchd server.
+		INTERNAL METHOD, DO NOT CALL. Starts a command: sets its deadline and stats record.
+		"""
+		self._deadline = self._timeout and time.time()+self._timeout or None
+		if self._stats is not None:
+			self._call = self._stats.begin(command)
+
+
+	def _Mark (self, phase):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Charges time since the last mark to given phase.
+		"""
+		if self._call is not None:
+			self._call.mark(phase)
+
+
+	def _End (self, results=None):
 		"""
-		(status, ver, length) = unpack('>2HL', sock.recv(8))
-		response = ''
-		left = length
-		while left>0:
-			chunk = sock.recv(left)
-			if chunk:
-				response += chunk
-				left -= len(chunk)
+		INTERNAL METHOD, DO NOT CALL. Finishes stats record of the current command.
+		Pass the number of results once the response was parsed; without it the call failed.
+		"""
+		if self._deadline is not None and self._socket:
+			# persistent or pooled connection, don't leave the deadline on it
+			self._socket.settimeout(None)
+		self._deadline = None
+		call, self._call = self._call, None
+		if call is None:
+			return
+		if results is not None:
+			call.mark('decode')
+			call.results = results
+		else:
+			call.error = self._error
+		self._stats.end(call)
+
+
+	def _Send (self, sock, header, body):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Sends command header and body to searchd server.
+		Large bodies are written right after the header instead of being copied into one string.
+		Returns False if the call timed out.
+		"""
+		try:
+			self._SetSocketTimeout(sock)
+			if len(body)<_SEND_COALESCE:
+				sock.sendall(header+body)
 			else:
-				break
+				sock.sendall(header)
+				sock.sendall(body)
+		except socket.timeout:
+			self._Abort(sock)
+			self._error = 'timed out sending request to searchd'
+			return False
+		if self._call is not None:
+			self._call.bytes_out += len(header)+len(body)
+			self._call.mark('send')
+		return True
+
+
+	def _Recv (self, sock, size):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Reads exactly 'size' bytes into a preallocated buffer.
+		Returns a shorter string if the connection was closed early.
+		"""
+		buf = bytearray(size)
+		view = memoryview(buf)
+		read = 0
+		while read<size:
+			self._SetSocketTimeout(sock)
+			got = sock.recv_into(view[read:], size-read)
+			if not got:
+				return view[:read].tobytes()
+			read += got
+		return str(buf)
+
+
+	def _SetSocketTimeout (self, sock):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Limits the next blocking socket operation to the time
+		left until the call deadline; raises socket.timeout if it has already passed.
+		"""
+		if self._deadline is None:
+			return
+		remaining = self._deadline - time.time()
+		if remaining<=0:
+			raise socket.timeout('timed out')
+		sock.settimeout(remaining)
+
+
+	def _Abort (self, sock):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Closes a socket left in the middle of a command.
+		"""
+		if self._socket is sock:
+			self._socket = None
+		sock.close()
+
+
+	def _RecvResponse (self, sock):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Reads raw response packet from searchd server.
+		Returns (status, ver, length, response) tuple; response may be short on IO failure,
+		None if not even the header could be read.
+		"""
+		call = self._call
+		header = self._Recv(sock, 8)
+		if call is not None:
+			call.mark('wait')
+		if len(header)<8:
+			response = None
+		else:
+			(status, ver, length) = unpack('>2HL', header)
+			response = status, ver, length, self._Recv(sock, length)
+			if call is not None:
+				call.bytes_in += 8+len(response[3])
+				call.mark('recv')
 
 		if not self._socket:
 			sock.close()
 
+		return response
+
+
+	def _GetResponse (self, sock, client_ver):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Gets and checks response packet from searchd server.
+		"""
+		try:
+			response = self._RecvResponse(sock)
+		except socket.timeout:
+			self._Abort(sock)
+			self._error = 'timed out reading searchd response'
+			return None
+		if response is None:
+			self._error = 'failed to read searchd response header'
+			return None
+		(status, ver, length, response) = response
+		return self._CheckResponse(status, ver, length, response, client_ver)
+
+
+	def _CheckResponse (self, status, ver, length, response, client_ver):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Checks raw response packet, returns its payload or None.
+		"""
 		# check response
 		read = len(response)
 		if not response or read!=length:
@@ -474,6 +736,7 @@ class SphinxClient:
 		assert(len(self._reqs)==0)
 		self.AddQuery(query,index,comment)
 		results = self.RunQueries()
+		self._reqs = [] # a failed query stays queued in RunQueries(), drop it
 
 		if not results or len(results)==0:
 			return None
@@ -489,23 +752,49 @@ class SphinxClient:
 		Add query to batch.
 		"""
 		# build request
-		req = [pack('>5L', self._offset, self._limit, self._mode, self._ranker, self._sort)]
-		req.append(pack('>L', len(self._sortby)))
-		req.append(self._sortby)
+		head, weights, body, tail = self._QueryParts()
 
 		if isinstance(query,unicode):
 			query = query.encode('utf-8')
 		assert(isinstance(query,str))
 
-		req.append(pack('>L', len(query)))
-		req.append(query)
+		req = ''.join ( ( head, pack('>L', len(query)), query, weights,
+			pack('>L', len(index)), index, body, pack('>L',len(comment)), comment, tail ) )
+
+		self._reqs.append(req)
+		return
+
+
+	def FreezeQuery (self):
+		"""
+		Serialize current query settings into a SphinxQueryTemplate.
+		Settings changed afterwards do not affect the template.
+		"""
+		return SphinxQueryTemplate(self._QueryParts())
+
+
+	def AddFrozenQuery (self, template, query, index='*', comment=''):
+		"""
+		Add query built from a SphinxQueryTemplate to batch.
+		Same as AddQuery() with the settings the template was frozen with.
+		"""
+		self._reqs.append(template.Build(query, index, comment))
 
-		req.append(pack('>L', len(self._weights)))
+
+	def _QueryParts (self):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Serializes query settings.
+		Returns the parts of a query request that surround the query text,
+		index and comment: (head, weights, body, tail) tuple.
+		"""
+		head = pack('>5L', self._offset, self._limit, self._mode, self._ranker, self._sort) \
+			+ pack('>L', len(self._sortby)) + self._sortby
+
+		weights = [pack('>L', len(self._weights))]
 		for w in self._weights:
-			req.append(pack('>L', w))
-		req.append(pack('>L', len(index)))
-		req.append(index)
-		req.append(pack('>L',1)) # id64 range marker
+			weights.append(pack('>L', w))
+
+		req = [pack('>L',1)] # id64 range marker
 		req.append(pack('>Q', self._min_id))
 		req.append(pack('>Q', self._max_id))
 		
@@ -558,32 +847,25 @@ class SphinxClient:
 		for field,weight in self._fieldweights.items():
 			req.append ( pack ('>L',len(field)) + field + pack ('>L',weight) )
 
-		# comment
-		req.append ( pack('>L',len(comment)) + comment )
-
 		# attribute overrides
-		req.append ( pack('>L', len(self._overrides)) )
+		tail = [pack('>L', len(self._overrides))]
 		for v in self._overrides.values():
-			req.extend ( ( pack('>L', len(v['name'])), v['name'] ) )
-			req.append ( pack('>LL', v['type'], len(v['values'])) )
+			tail.extend ( ( pack('>L', len(v['name'])), v['name'] ) )
+			tail.append ( pack('>LL', v['type'], len(v['values'])) )
 			for id, value in v['values'].iteritems():
-				req.append ( pack('>Q', id) )
+				tail.append ( pack('>Q', id) )
 				if v['type'] == SPH_ATTR_FLOAT:
-					req.append ( pack('>f', value) )
+					tail.append ( pack('>f', value) )
 				elif v['type'] == SPH_ATTR_BIGINT:
-					req.append ( pack('>q', value) )
+					tail.append ( pack('>q', value) )
 				else:
-					req.append ( pack('>l', value) )
+					tail.append ( pack('>l', value) )
 
 		# select-list
-		req.append ( pack('>L', len(self._select)) )
-		req.append ( self._select )
+		tail.append ( pack('>L', len(self._select)) )
+		tail.append ( self._select )
 
-		# send query, get response
-		req = ''.join(req)
-
-		self._reqs.append(req)
-		return
+		return head, ''.join(weights), ''.join(req), ''.join(tail)
 
 
 	def RunQueries (self):
@@ -595,22 +877,45 @@ class SphinxClient:
 			self._error = 'no queries defined, issue AddQuery() first'
 			return None
 
+		self._Begin('search')
 		sock = self._Connect()
 		if not sock:
+			self._End()
 			return None
+		self._Mark('connect')
 
-		req = ''.join(self._reqs)
-		length = len(req)+4
-		req = pack('>HHLL', SEARCHD_COMMAND_SEARCH, VER_COMMAND_SEARCH, length, len(self._reqs))+req
-		sock.send(req)
+		header, req = self._SearchRequest(self._reqs)
+		if not self._Send(sock, header, req):
+			self._End()
+			return None
 
 		response = self._GetResponse(sock, VER_COMMAND_SEARCH)
 		if not response:
+			self._End()
 			return None
 
-		nreqs = len(self._reqs)
+		results = self._ParseSearchResponse(response, len(self._reqs))
+		self._reqs = []
+		self._End(sum([_MatchCount(r) for r in results]))
+		return results
+
+
+	def _SearchRequest (self, reqs):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Wraps queries added with AddQuery() into a search command.
+		Returns (header, body) tuple.
+		"""
+		req = ''.join(reqs)
+		length = len(req)+4
+		return pack('>HHLL', SEARCHD_COMMAND_SEARCH, VER_COMMAND_SEARCH, length, len(reqs)), req
+
 
-		# parse response
+	def _ParseSearchResponse (self, response, nreqs):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Parses search response payload into an array of result set hashes.
+		Numbers are decoded in place with precompiled structs, a whole match row per call where the schema allows.
+		"""
+		u32 = _UINT32.unpack_from
 		max_ = len(response)
 		p = 0
 
@@ -621,11 +926,11 @@ class SphinxClient:
 
 			result['error'] = ''
 			result['warning'] = ''
-			status = unpack('>L', response[p:p+4])[0]
+			status = u32(response, p)[0]
 			p += 4
 			result['status'] = status
 			if status != SEARCHD_OK:
-				length = unpack('>L', response[p:p+4])[0]
+				length = u32(response, p)[0]
 				p += 4
 				message = response[p:p+length]
 				p += length
@@ -640,70 +945,73 @@ class SphinxClient:
 			fields = []
 			attrs = []
 
-			nfields = unpack('>L', response[p:p+4])[0]
+			nfields = u32(response, p)[0]
 			p += 4
 			while nfields>0 and p<max_:
 				nfields -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = u32(response, p)[0]
 				p += 4
 				fields.append(response[p:p+length])
 				p += length
 
 			result['fields'] = fields
 
-			nattrs = unpack('>L', response[p:p+4])[0]
+			nattrs = u32(response, p)[0]
 			p += 4
 			while nattrs>0 and p<max_:
 				nattrs -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = u32(response, p)[0]
 				p += 4
 				attr = response[p:p+length]
 				p += length
-				type_ = unpack('>L', response[p:p+4])[0]
+				type_ = u32(response, p)[0]
 				p += 4
 				attrs.append([attr,type_])
 
 			result['attrs'] = attrs
 
 			# read match count
-			count = unpack('>L', response[p:p+4])[0]
-			p += 4
-			id64 = unpack('>L', response[p:p+4])[0]
-			p += 4
-		
+			count, id64 = _UINT32x2.unpack_from(response, p)
+			p += 8
+
 			# read matches
-			result['matches'] = []
-			while count>0 and p<max_:
-				count -= 1
-				if id64:
-					doc, weight = unpack('>QL', response[p:p+12])
-					p += 12
-				else:
-					doc, weight = unpack('>2L', response[p:p+8])
-					p += 8
-
-				match = { 'id':doc, 'weight':weight, 'attrs':{} }
-				for i in range(len(attrs)):
-					if attrs[i][1] == SPH_ATTR_FLOAT:
-						match['attrs'][attrs[i][0]] = unpack('>f', response[p:p+4])[0]
-					elif attrs[i][1] == SPH_ATTR_BIGINT:
-						match['attrs'][attrs[i][0]] = unpack('>q', response[p:p+8])[0]
-						p += 4
-					elif attrs[i][1] == (SPH_ATTR_MULTI | SPH_ATTR_INTEGER):
-						match['attrs'][attrs[i][0]] = []
-						nvals = unpack('>L', response[p:p+4])[0]
-						p += 4
-						for n in range(0,nvals,1):
-							match['attrs'][attrs[i][0]].append(unpack('>L', response[p:p+4])[0])
+			plan = _MatchPlan(attrs, id64)
+			if self._columnar:
+				p = self._ParseColumns(result, response, p, count, plan, attrs, id64)
+				continue
+
+			result['matches'] = matches = []
+			row, names = plan[0]
+			unpack_row = row.unpack_from
+			size = row.size
+
+			if len(plan)==1:
+				# fixed-size rows, one unpack per match
+				while count>0 and p<max_:
+					count -= 1
+					values = unpack_row(response, p)
+					p += size
+					matches.append ( { 'id':values[0], 'weight':values[1], 'attrs':dict(izip(names, values[2:])) } )
+			else:
+				rest = plan[1:]
+				while count>0 and p<max_:
+					count -= 1
+					values = unpack_row(response, p)
+					p += size
+					match = { 'id':values[0], 'weight':values[1], 'attrs':dict(izip(names, values[2:])) }
+					for step, stepnames in rest:
+						if step is None:
+							# MVA, counted list of uint32 values
+							nvals = u32(response, p)[0]
 							p += 4
-						p -= 4
-					else:
-						match['attrs'][attrs[i][0]] = unpack('>L', response[p:p+4])[0]
-					p += 4
-
-				result['matches'].append ( match )
+							match['attrs'][stepnames] = list(unpack_from('>%dL' % nvals, response, p))
+							p += 4*nvals
+						else:
+							match['attrs'].update(izip(stepnames, step.unpack_from(response, p)))
+							p += step.size
+					matches.append ( match )
 
-			result['total'], result['total_found'], result['time'], words = unpack('>4L', response[p:p+16])
+			result['total'], result['total_found'], result['time'], words = _UINT32x4.unpack_from(response, p)
 
 			result['time'] = '%.3f' % (result['time']/1000.0)
 			p += 16
@@ -711,23 +1019,136 @@ class SphinxClient:
 			result['words'] = []
 			while words>0:
 				words -= 1
-				length = unpack('>L', response[p:p+4])[0]
+				length = u32(response, p)[0]
 				p += 4
 				word = response[p:p+length]
 				p += length
-				docs, hits = unpack('>2L', response[p:p+8])
+				docs, hits = _UINT32x2.unpack_from(response, p)
 				p += 8
 
 				result['words'].append({'word':word, 'docs':docs, 'hits':hits})
-		
-		self._reqs = []
+
 		return results
+
+
+	def _ParseColumns (self, result, response, p, count, plan, attrs, id64):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Decodes matches and word stats of one result set
+		starting at offset p into columns (see SetColumnarResult). Returns the offset past them.
+		"""
+		u32 = _UINT32.unpack_from
+		types = dict([ (name, type_) for name, type_ in attrs ])
+
+		def column ( name, values ):
+			if name=='@id':
+				code = id64 and _COLUMN_U64 or 'I'
+			elif name=='@weight':
+				code = 'I'
+			elif types[name]==SPH_ATTR_FLOAT:
+				code = 'f'
+			elif types[name]==SPH_ATTR_BIGINT:
+				code = _COLUMN_I64
+			else:
+				code = 'I'
+			if code is None:
+				return list(values)
+			return array(code, values)
+
+		row, names = plan[0]
+		names = [ '@id', '@weight' ] + names
+		if len(plan)==1:
+			# fixed-size rows: all matches in one unpack, then every column is a slice
+			width = len(names)
+			codes = row.format[1:]
+			values = unpack_from('>'+codes*count, response, p)
+			p += row.size*count
+			columns = dict([ (name, column(name, values[k::width])) for k, name in enumerate(names) ])
+		else:
+			steps = [ ( row, names ) ] + plan[1:]
+			lists = {}
+			for step, stepnames in steps:
+				if step is None:
+					lists[stepnames] = []
+				else:
+					for name in stepnames:
+						lists[name] = []
+			for n in xrange(count):
+				for step, stepnames in steps:
+					if step is None:
+						nvals = u32(response, p)[0]
+						p += 4
+						lists[stepnames].append ( array('I', unpack_from('>%dL' % nvals, response, p)) )
+						p += 4*nvals
+					else:
+						for name, value in izip(stepnames, step.unpack_from(response, p)):
+							lists[name].append(value)
+						p += step.size
+			columns = {}
+			for name, values in lists.items():
+				if name!='@id' and name!='@weight' and types[name]==(SPH_ATTR_MULTI | SPH_ATTR_INTEGER):
+					columns[name] = values
+				else:
+					columns[name] = column(name, values)
+
+		columns['id'] = columns.pop('@id')
+		columns['weight'] = columns.pop('@weight')
+		result['columns'] = columns
+
+		result['total'], result['total_found'], result['time'], nwords = _UINT32x4.unpack_from(response, p)
+		result['time'] = '%.3f' % (result['time']/1000.0)
+		p += 16
+
+		words = []
+		stats = []
+		for n in xrange(nwords):
+			length = u32(response, p)[0]
+			p += 4
+			words.append(response[p:p+length])
+			p += length
+			stats.extend(_UINT32x2.unpack_from(response, p))
+			p += 8
+		result['words'] = { 'word':words, 'docs':array('I', stats[0::2]), 'hits':array('I', stats[1::2]) }
+		return p
 	
 
 	def BuildExcerpts (self, docs, index, words, opts=None):
 		"""
 		Connect to searchd server and generate exceprts from given documents.
 		"""
+		header, req = self._ExcerptsRequest(docs, index, words, opts)
+		return self._RunExcerpts(header, req, len(docs))
+
+
+	def _RunExcerpts (self, header, req, ndocs):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Sends a built excerpts command for ndocs documents, returns the excerpts.
+		"""
+		self._Begin('excerpt')
+		sock = self._Connect()
+
+		if not sock:
+			self._End()
+			return None
+		self._Mark('connect')
+
+		if not self._Send(sock, header, req):
+			self._End()
+			return []
+
+		response = self._GetResponse(sock, VER_COMMAND_EXCERPT )
+		if not response:
+			self._End()
+			return []
+
+		excerpts = self._ParseExcerptsResponse(response, ndocs)
+		self._End(len(excerpts))
+		return excerpts
+
+
+	def _ExcerptsRequest (self, docs, index, words, opts=None):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Builds excerpts command, returns (header, body) tuple.
+		"""
 		if not opts:
 			opts = {}
 		if isinstance(words,unicode):
@@ -738,11 +1159,6 @@ class SphinxClient:
 		assert(isinstance(words, str))
 		assert(isinstance(opts, dict))
 
-		sock = self._Connect()
-
-		if not sock:
-			return None
-
 		# fixup options
 		opts.setdefault('before_match', '<b>')
 		opts.setdefault('after_match', '</b>')
@@ -794,23 +1210,20 @@ class SphinxClient:
 
 		req = ''.join(req)
 
-		# send query, get response
-		length = len(req)
-
 		# add header
-		req = pack('>2HL', SEARCHD_COMMAND_EXCERPT, VER_COMMAND_EXCERPT, length)+req
-		wrote = sock.send(req)
+		length = len(req)
+		return pack('>2HL', SEARCHD_COMMAND_EXCERPT, VER_COMMAND_EXCERPT, length), req
 
-		response = self._GetResponse(sock, VER_COMMAND_EXCERPT )
-		if not response:
-			return []
 
-		# parse response
+	def _ParseExcerptsResponse (self, response, ndocs):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Parses excerpts response payload into a list of strings.
+		"""
 		pos = 0
 		res = []
 		rlen = len(response)
 
-		for i in range(len(docs)):
+		for i in range(ndocs):
 			length = unpack('>L', response[pos:pos+4])[0]
 			pos += 4
 
@@ -835,6 +1248,34 @@ class SphinxClient:
 		Example:
 			res = cl.UpdateAttributes ( 'test1', [ 'group_id', 'date_added' ], { 2:[123,1000000000], 4:[456,1234567890] } )
 		"""
+		header, req = self._UpdateRequest ( index, attrs, values )
+
+		# connect, send query, get response
+		self._Begin ( 'update' )
+		sock = self._Connect()
+		if not sock:
+			self._End()
+			return None
+		self._Mark ( 'connect' )
+
+		if not self._Send ( sock, header, req ):
+			self._End()
+			return -1
+
+		response = self._GetResponse ( sock, VER_COMMAND_UPDATE )
+		if not response:
+			self._End()
+			return -1
+
+		updated = self._ParseUpdateResponse ( response )
+		self._End ( updated )
+		return updated
+
+
+	def _UpdateRequest ( self, index, attrs, values ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Builds update command, returns (header, body) tuple.
+		"""
 		assert ( isinstance ( index, str ) )
 		assert ( isinstance ( attrs, list ) )
 		assert ( isinstance ( values, dict ) )
@@ -860,21 +1301,15 @@ class SphinxClient:
 			for val in entry:
 				req.append ( pack('>L',val) )
 
-		# connect, send query, get response
-		sock = self._Connect()
-		if not sock:
-			return None
-
 		req = ''.join(req)
 		length = len(req)
-		req = pack ( '>2HL', SEARCHD_COMMAND_UPDATE, VER_COMMAND_UPDATE, length ) + req
-		wrote = sock.send ( req )
+		return pack ( '>2HL', SEARCHD_COMMAND_UPDATE, VER_COMMAND_UPDATE, length ), req
 
-		response = self._GetResponse ( sock, VER_COMMAND_UPDATE )
-		if not response:
-			return -1
 
-		# parse response
+	def _ParseUpdateResponse ( self, response ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Parses update response payload into updated documents count.
+		"""
 		updated = unpack ( '>L', response[0:4] )[0]
 		return updated
 
@@ -884,6 +1319,40 @@ class SphinxClient:
 		Connect to searchd server, and generate keywords list for a given query.
 		Returns None on failure, or a list of keywords on success.
 		"""
+		header, req = self._KeywordsRequest ( query, index, hits )
+		return self._RunKeywords ( header, req, hits )
+
+
+	def _RunKeywords ( self, header, req, hits ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Sends a built keywords command, returns the keywords list or None.
+		"""
+		# connect, send query, get response
+		self._Begin ( 'keywords' )
+		sock = self._Connect()
+		if not sock:
+			self._End()
+			return None
+		self._Mark ( 'connect' )
+
+		if not self._Send ( sock, header, req ):
+			self._End()
+			return None
+
+		response = self._GetResponse ( sock, VER_COMMAND_KEYWORDS )
+		if not response:
+			self._End()
+			return None
+
+		keywords = self._ParseKeywordsResponse ( response, hits )
+		self._End ( len(keywords or ()) )
+		return keywords
+
+
+	def _KeywordsRequest ( self, query, index, hits ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Builds keywords command, returns (header, body) tuple.
+		"""
 		assert ( isinstance ( query, str ) )
 		assert ( isinstance ( index, str ) )
 		assert ( isinstance ( hits, int ) )
@@ -893,21 +1362,15 @@ class SphinxClient:
 		req.append ( pack ( '>L', len(index) ) + index )
 		req.append ( pack ( '>L', hits ) )
 
-		# connect, send query, get response
-		sock = self._Connect()
-		if not sock:
-			return None
-
 		req = ''.join(req)
 		length = len(req)
-		req = pack ( '>2HL', SEARCHD_COMMAND_KEYWORDS, VER_COMMAND_KEYWORDS, length ) + req
-		wrote = sock.send ( req )
+		return pack ( '>2HL', SEARCHD_COMMAND_KEYWORDS, VER_COMMAND_KEYWORDS, length ), req
 
-		response = self._GetResponse ( sock, VER_COMMAND_KEYWORDS )
-		if not response:
-			return None
 
-		# parse response
+	def _ParseKeywordsResponse ( self, response, hits ):
+		"""
+		INTERNAL METHOD, DO NOT CALL. Parses keywords response payload into a list of keywords.
+		"""
 		res = []
 
 		nwords = unpack ( '>L', response[0:4] )[0]
@@ -953,7 +1416,7 @@ class SphinxClient:
 
 		# command, command version = 0, body length = 4, body = 1
 		request = pack ( '>hhII', SEARCHD_COMMAND_PERSIST, 0, 4, 1 )
-		server.send ( request )
+		server.sendall ( request )
 		
 		self._socket = server
 
@@ -967,6 +1430,32 @@ class SphinxClient:
 	def EscapeString(self, string):
 		return re.sub(r"([=\(\)|\-!@~\"&/\\\^\$\=])", r"\\\1", string)
 
+
+class SphinxQueryTemplate:
+	"""
+	Query settings serialized once by SphinxClient.FreezeQuery().
+	Build() only adds the query text, index and comment, which makes
+	adding many queries of the same shape much cheaper than AddQuery().
+	"""
+
+	def __init__ (self, parts):
+		self._head, self._weights, self._body, self._tail = parts
+
+
+	def Build (self, query, index='*', comment=''):
+		"""
+		Serialize a query with the template settings; the result is what
+		AddQuery() would append to the batch.
+		"""
+		if isinstance(query,unicode):
+			query = query.encode('utf-8')
+		assert(isinstance(query,str))
+		u32 = _UINT32.pack
+		return ''.join ( ( self._head, u32(len(query)), query, self._weights,
+			u32(len(index)), index, self._body, u32(len(comment)), comment, self._tail ) )
+
+
 #
 # $Id: sphinxapi.py 2055 2009-11-06 23:09:58Z shodan $
 #
+
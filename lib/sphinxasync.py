@@ -0,0 +1,611 @@
+# -*- coding: utf-8 -*-
+
+"""
+Non-blocking searchd client that keeps many requests in flight at once.
+
+There is no asyncio on our Python, so instead of coroutines the *Async()
+methods of AsyncSphinxClient return SphinxRequest handles, and a select()
+based SphinxReactor drives the sockets of all submitted requests together.
+A view that needs 20 independent searches submits them all and then waits,
+finishing in about the time of the slowest one:
+
+    reactor = SphinxReactor(max_connections=4)
+    cl = AsyncSphinxClient(reactor)
+    pending = []
+    for text in shingles:
+        cl.AddQuery(text, 'submissions')
+        pending.append(cl.RunQueriesAsync())
+    results = gather(pending, timeout=5.0)
+
+Request packets and responses are built and parsed by SphinxClient itself,
+so AddQuery/SetFilter/etc. behave exactly as in the blocking client.
+"""
+
+import errno
+import os
+import select
+import socket
+import time
+from struct import pack, unpack
+
+from lib.sphinxapi import SphinxClient, SEARCHD_COMMAND_PERSIST, SEARCHD_ERROR, \
+    VER_COMMAND_SEARCH, VER_COMMAND_EXCERPT, VER_COMMAND_KEYWORDS, \
+    VER_COMMAND_UPDATE, _SEND_COALESCE
+
+
+_CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+_WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN)
+
+
+class SphinxRequest(object):
+    """
+    Handle of a single searchd command submitted to a SphinxReactor.
+
+    result() drives the reactor until the request completes and returns
+    what the matching blocking SphinxClient method would have returned;
+    error and warning hold the same messages GetLastError() and
+    GetLastWarning() would.
+    """
+
+    def __init__(self, endpoint, packet, client_ver, parse, failed=None, client=None):
+        self.endpoint = endpoint
+        self.header, self.body = packet
+        self.client_ver = client_ver
+        self.done = False
+        self.value = failed
+        self.error = ''
+        self.warning = ''
+        self.status = None      # searchd response status, None if no response came
+
+        # timings, time.time() values
+        self.submitted = None
+        self.sent = None
+        self.finished = None
+
+        self._parse = parse
+        self._failed = failed
+        self._client = client
+        self._reactor = None
+        self._attempts = 0
+        self._callbacks = []
+
+    def __repr__(self):
+        state = self.done and (self.error and 'failed' or 'done') or 'pending'
+        return '<SphinxRequest %s %s>' % (self.endpoint, state)
+
+    def add_done_callback(self, func):
+        """
+        Call func(request) once the request completes (immediately if it has).
+        """
+        if self.done:
+            func(self)
+        else:
+            self._callbacks.append(func)
+
+    def result(self, timeout=None):
+        """
+        Wait for the request to complete, up to timeout seconds.
+        A request that does not complete in time is cancelled.
+        """
+        if not self.done and self._reactor is not None:
+            self._reactor.wait([self], timeout)
+        if not self.done:
+            self.cancel('request timed out')
+        if self._client is not None:
+            self._client._error = self.error
+            self._client._warning = self.warning
+        return self.value
+
+    def cancel(self, error='request cancelled'):
+        if self.done:
+            return
+        if self._reactor is not None:
+            self._reactor._cancel(self)
+        self._fail(error)
+
+    @property
+    def elapsed(self):
+        if self.submitted is None or self.finished is None:
+            return None
+        return self.finished - self.submitted
+
+    def _complete(self, status, ver, length, response):
+        self.status = status
+        parser = SphinxClient()
+        payload = parser._CheckResponse(status, ver, length, response, self.client_ver)
+        if payload:
+            value = self._parse(parser, payload)
+        else:
+            value = self._failed
+        self._set(value, parser._error, parser._warning)
+
+    def _fail(self, error):
+        self._set(self._failed, error, '')
+
+    def _set(self, value, error, warning):
+        if self.done:
+            return
+        self.done = True
+        self.value = value
+        self.error = error
+        self.warning = warning
+        self.finished = time.time()
+        callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
+
+
+class _Connection(object):
+    """
+    Non-blocking socket to searchd plus its read/write state.
+    """
+
+    def __init__(self, endpoint, persistent):
+        self.endpoint = endpoint
+        self.persistent = persistent
+        self.request = None
+        self.reused = False
+
+        if isinstance(endpoint, tuple):
+            af = socket.AF_INET
+        else:
+            af = socket.AF_UNIX
+        self.sock = socket.socket(af, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        if af == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        err = self.sock.connect_ex(endpoint)
+        if err and err not in _CONNECT_IN_PROGRESS:
+            self.sock.close()
+            raise socket.error(err, os.strerror(err))
+        self.connecting = True
+        self.handshaken = False
+
+        self._out = []          # buffers to send, first one from _outpos on
+        self._outpos = 0
+        self._pre = ''          # version and header bytes read so far
+        self._header = None
+        self._body = None       # preallocated from header length
+        self._read = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def start(self, request):
+        self.request = request
+        header = request.header
+        if not self.handshaken:
+            # send our version, switch to persistent mode and send the
+            # command right away; server version is checked on read
+            hello = pack('>L', 1)
+            if self.persistent:
+                hello += pack('>hhII', SEARCHD_COMMAND_PERSIST, 0, 4, 1)
+            header = hello + header
+        if len(request.body) < _SEND_COALESCE:
+            self._out = [header + request.body]
+        else:
+            self._out = [header, request.body]
+        self._outpos = 0
+
+    def wants_write(self):
+        return self.connecting or bool(self._out)
+
+    def wants_read(self):
+        return self.request is not None and not self.connecting
+
+    def on_writable(self):
+        if self.connecting:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            self.connecting = False
+        while self._out:
+            chunk = self._out[0]
+            try:
+                sent = self.sock.send(buffer(chunk, self._outpos))
+            except socket.error, e:
+                if e.args[0] in _WOULD_BLOCK:
+                    return
+                raise
+            self._outpos += sent
+            if self._outpos < len(chunk):
+                return
+            self._out.pop(0)
+            self._outpos = 0
+            if not self._out:
+                self.request.sent = time.time()
+
+    def on_readable(self):
+        """
+        Read what is available; returns (status, ver, length, response)
+        once the whole response packet is in, None otherwise. The body is
+        read straight into a buffer preallocated from the header length.
+        """
+        try:
+            if self._header is None:
+                return self._read_header()
+            return self._read_body()
+        except socket.error, e:
+            if e.args[0] in _WOULD_BLOCK:
+                return None
+            raise
+
+    def _read_header(self):
+        size = self.handshaken and 8 or 12
+        chunk = self.sock.recv(size - len(self._pre))
+        if not chunk:
+            raise socket.error(errno.ECONNRESET, 'connection closed by searchd')
+        self._pre += chunk
+        if len(self._pre) < size:
+            return None
+
+        if not self.handshaken:
+            v = unpack('>L', self._pre[:4])[0]
+            if v < 1:
+                raise socket.error(errno.EPROTO, 'expected searchd protocol version, got %s' % v)
+            self.handshaken = True
+            self._pre = self._pre[4:]
+
+        self._header = unpack('>2HL', self._pre)
+        self._pre = ''
+        self._body = bytearray(self._header[2])
+        self._read = 0
+        if self._header[2]:
+            return None
+        return self._read_body()
+
+    def _read_body(self):
+        status, ver, length = self._header
+        if self._read < length:
+            got = self.sock.recv_into(memoryview(self._body)[self._read:], length - self._read)
+            if not got:
+                raise socket.error(errno.ECONNRESET, 'connection closed by searchd')
+            self._read += got
+            if self._read < length:
+                return None
+        response = str(self._body)
+        self._header = None
+        self._body = None
+        return status, ver, length, response
+
+    def is_alive(self):
+        try:
+            sr, _, sx = select.select([self.sock], [], [self.sock], 0)
+        except (select.error, socket.error):
+            return False
+        return not sr and not sx
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class SphinxReactor(object):
+    """
+    Drives SphinxRequests over non-blocking connections with select().
+
+    At most max_connections sockets are used per searchd endpoint, extra
+    requests wait in a FIFO queue. With persistent=True connections switch
+    to persistent mode and are reused by later requests (including across
+    run() calls) until close().
+    """
+
+    def __init__(self, max_connections=4, persistent=True):
+        assert max_connections > 0
+        self.max_connections = max_connections
+        self.persistent = persistent
+
+        self._queued = {}       # endpoint -> [request, ...]
+        self._idle = {}         # endpoint -> [connection, ...]
+        self._active = {}       # request -> connection
+        self._counts = {}       # endpoint -> open connections
+
+    def submit(self, request):
+        assert request._reactor is None, 'request submitted twice'
+        request._reactor = self
+        request.submitted = time.time()
+        self._queued.setdefault(request.endpoint, []).append(request)
+        self._dispatch(request.endpoint)
+        return request
+
+    def pending(self):
+        """
+        Number of submitted requests that have not completed yet.
+        """
+        return len(self._active) + sum(len(q) for q in self._queued.values())
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout seconds for socket events and process them.
+        Returns the number of requests completed during the call.
+        """
+        conns = self._active.values()
+        if not conns:
+            return 0
+        readers = [c for c in conns if c.wants_read()]
+        writers = [c for c in conns if c.wants_write()]
+        try:
+            sr, sw, _ = select.select(readers, writers, [], timeout)
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return 0
+            raise
+
+        completed = 0
+        for conn in sw:
+            try:
+                conn.on_writable()
+            except socket.error, e:
+                completed += self._broken(conn, e)
+        for conn in sr:
+            if conn.request is None:
+                continue
+            try:
+                packet = conn.on_readable()
+            except socket.error, e:
+                completed += self._broken(conn, e)
+                continue
+            if packet is not None:
+                self._finished(conn, packet)
+                completed += 1
+        return completed
+
+    def wait(self, requests, timeout=None):
+        """
+        Drive the reactor until all given requests complete or timeout
+        seconds pass. Returns True if all of them completed.
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        while True:
+            if all(r.done for r in requests):
+                return True
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            if not self._active:
+                # nothing can make progress, e.g. request never submitted here
+                return all(r.done for r in requests)
+            self.poll(remaining)
+
+    def run(self, timeout=None):
+        """
+        Drive the reactor until every submitted request completes.
+        """
+        deadline = timeout is not None and time.time() + timeout or None
+        while self._active:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+            self.poll(remaining)
+        return True
+
+    def close(self):
+        """
+        Cancel whatever is in flight and close all connections.
+        """
+        for queue in self._queued.values():
+            for request in list(queue):
+                request.cancel('reactor closed')
+        for request in self._active.keys():
+            request.cancel('reactor closed')
+        for conns in self._idle.values():
+            for conn in conns:
+                conn.close()
+        self._idle = {}
+        self._counts = {}
+
+    def _dispatch(self, endpoint):
+        queue = self._queued.get(endpoint)
+        idle = self._idle.setdefault(endpoint, [])
+        while queue:
+            conn = None
+            while idle and conn is None:
+                conn = idle.pop()
+                if not conn.is_alive():
+                    self._drop(conn)
+                    conn = None
+            if conn is None:
+                if self._counts.get(endpoint, 0) >= self.max_connections:
+                    return
+                try:
+                    conn = _Connection(endpoint, self.persistent)
+                except socket.error, e:
+                    queue.pop(0)._fail('connection to %s failed (%s)' % (_describe(endpoint), e))
+                    continue
+                self._counts[endpoint] = self._counts.get(endpoint, 0) + 1
+            request = queue.pop(0)
+            request._attempts += 1
+            conn.start(request)
+            self._active[request] = conn
+
+    def _finished(self, conn, packet):
+        request = conn.request
+        conn.request = None
+        del self._active[request]
+        if self.persistent:
+            conn.reused = True
+            self._idle.setdefault(conn.endpoint, []).append(conn)
+        else:
+            self._drop(conn)
+        request._complete(*packet)
+        self._dispatch(conn.endpoint)
+
+    def _broken(self, conn, error):
+        """
+        Drop a failed connection; returns True if its request failed too.
+        """
+        request, conn.request = conn.request, None
+        del self._active[request]
+        self._drop(conn)
+        failed = not (conn.reused and request._attempts < 2)
+        if failed:
+            request._fail('connection to %s failed (%s)' % (_describe(conn.endpoint), error))
+        else:
+            # an idle persistent connection may have been closed by searchd
+            # while we were not looking; try once more on a fresh one
+            self._queued.setdefault(conn.endpoint, []).insert(0, request)
+        self._dispatch(conn.endpoint)
+        return failed
+
+    def _cancel(self, request):
+        queue = self._queued.get(request.endpoint, [])
+        if request in queue:
+            queue.remove(request)
+            return
+        conn = self._active.pop(request, None)
+        if conn is not None:
+            # the response is still coming, the socket can't be reused
+            conn.request = None
+            self._drop(conn)
+            self._dispatch(conn.endpoint)
+
+    def _drop(self, conn):
+        self._counts[conn.endpoint] = self._counts.get(conn.endpoint, 1) - 1
+        conn.close()
+
+
+def parse_endpoint(server):
+    """
+    Reactor endpoint of a server given as a (host, port) pair, a
+    'host:port' string or a unix socket path.
+    """
+    if isinstance(server, tuple):
+        return server
+    if server.startswith('unix://'):
+        return server[7:]
+    if server.startswith('/'):
+        return server
+    host, port = server.rsplit(':', 1)
+    return (host, int(port))
+
+
+def _describe(endpoint):
+    if isinstance(endpoint, tuple):
+        return '%s;%s' % endpoint
+    return endpoint
+
+
+def gather(requests, timeout=None):
+    """
+    Wait for all requests (they may belong to different reactors) and
+    return their results in order. Requests not done by the timeout are
+    cancelled and yield their failure value.
+    """
+    deadline = timeout is not None and time.time() + timeout or None
+    reactors = []
+    for request in requests:
+        if request._reactor is not None and request._reactor not in reactors:
+            reactors.append(request._reactor)
+    while not all(r.done for r in requests):
+        progress = False
+        for reactor in reactors:
+            if reactor._active:
+                progress = True
+                if deadline is None:
+                    remaining = len(reactors) > 1 and 0.01 or None
+                else:
+                    remaining = max(0, deadline - time.time())
+                    if len(reactors) > 1:
+                        remaining = min(remaining, 0.01)
+                reactor.poll(remaining)
+        if not progress or (deadline is not None and time.time() >= deadline):
+            break
+    return [r.result(0) for r in requests]
+
+
+class AsyncSphinxClient(SphinxClient):
+    """
+    SphinxClient with non-blocking RunQueriesAsync(), BuildExcerptsAsync(),
+    BuildKeywordsAsync() and UpdateAttributesAsync() variants that submit
+    the command to a SphinxReactor and return a SphinxRequest.
+
+    Queries added with AddQuery() go out as one multi-query request on
+    RunQueriesAsync(), so call it after every AddQuery() to run the
+    queries concurrently instead. The blocking methods are inherited
+    unchanged.
+    """
+
+    def __init__(self, reactor=None):
+        SphinxClient.__init__(self)
+        if reactor is None:
+            reactor = SphinxReactor()
+        self._reactor = reactor
+
+    def GetReactor(self):
+        return self._reactor
+
+    def _Endpoint(self):
+        if self._path:
+            return self._path
+        return (self._host, self._port)
+
+    def _Submit(self, packet, client_ver, parse, failed):
+        request = SphinxRequest(self._Endpoint(), packet, client_ver, parse,
+                                failed=failed, client=self)
+        return self._reactor.submit(request)
+
+    def RunQueriesAsync(self):
+        """
+        Submit queries batch. Returns None if there is nothing to run.
+        """
+        if len(self._reqs)==0:
+            self._error = 'no queries defined, issue AddQuery() first'
+            return None
+        nreqs = len(self._reqs)
+        packet = self._SearchRequest(self._reqs)
+        self._reqs = []
+        columnar = self._columnar
+
+        def parse(parser, response):
+            parser.SetColumnarResult(columnar)
+            return parser._ParseSearchResponse(response, nreqs)
+        return self._Submit(packet, VER_COMMAND_SEARCH, parse, None)
+
+    def QueryAsync(self, query, index='*', comment=''):
+        """
+        Submit a single query; result() is a result set hash like Query()
+        returns, or None on failure.
+        """
+        assert(len(self._reqs)==0)
+        self.AddQuery(query, index, comment)
+        nreqs = len(self._reqs)
+        packet = self._SearchRequest(self._reqs)
+        self._reqs = []
+        columnar = self._columnar
+
+        def parse(parser, response):
+            parser.SetColumnarResult(columnar)
+            results = parser._ParseSearchResponse(response, nreqs)
+            if not results:
+                return None
+            parser._error = results[0]['error']
+            parser._warning = results[0]['warning']
+            if results[0]['status'] == SEARCHD_ERROR:
+                return None
+            return results[0]
+        return self._Submit(packet, VER_COMMAND_SEARCH, parse, None)
+
+    def BuildExcerptsAsync(self, docs, index, words, opts=None):
+        packet = self._ExcerptsRequest(docs, index, words, opts)
+        ndocs = len(docs)
+        return self._Submit(packet, VER_COMMAND_EXCERPT,
+                            lambda parser, response: parser._ParseExcerptsResponse(response, ndocs),
+                            [])
+
+    def BuildKeywordsAsync(self, query, index, hits):
+        packet = self._KeywordsRequest(query, index, hits)
+        return self._Submit(packet, VER_COMMAND_KEYWORDS,
+                            lambda parser, response: parser._ParseKeywordsResponse(response, hits),
+                            None)
+
+    def UpdateAttributesAsync(self, index, attrs, values):
+        packet = self._UpdateRequest(index, attrs, values)
+        return self._Submit(packet, VER_COMMAND_UPDATE,
+                            lambda parser, response: parser._ParseUpdateResponse(response),
+                            -1)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batched fingerprint lookups over a single persistent searchd connection.
+
+FingerprintBatcher packs phrase queries into multi-query requests that stay
+under searchd limits, keeps a couple of requests in flight on the
+connection, and yields (phrase, matches) pairs as soon as each response is
+decoded:
+
+    cl = SphinxClient()
+    cl.SetMatchMode(SPH_MATCH_PHRASE)
+    cl.SetLimits(0, 50)
+    batcher = FingerprintBatcher(cl, 'submissions')
+    for phrase, matches in batcher.lookup(shingles):
+        ...
+
+N phrases cost about N/max_queries round trips instead of N.
+"""
+
+import socket
+from collections import deque
+from struct import pack
+
+from lib.sphinxapi import SEARCHD_COMMAND_PERSIST, SEARCHD_ERROR, VER_COMMAND_SEARCH
+
+
+# searchd refuses multi-queries with more than 32 queries
+MAX_QUERIES = 32
+
+
+class BatchError(Exception):
+    """Request could not be sent or its response could not be read"""
+    pass
+
+
+class SphinxPipeline(object):
+    """
+    Persistent connection taken from a SphinxClient that accepts the next
+    command before the previous response has been read.
+
+    Responses come back in send order. Writes block, so keep every request
+    well below the socket buffer size (tens of KB, not MBs): searchd does
+    not read the next command while it writes a response, and a pipelined
+    request that does not fit into the kernel buffers would deadlock.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._sock = None
+        self._owned = False     # connection was opened by the pipeline
+        self._inflight = deque()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def open(self):
+        client = self._client
+        if client._socket:
+            # connection opened with client.Open(), leave it to its owner
+            self._sock = client._socket
+            return
+        sock = client._Connect()
+        if not sock:
+            raise BatchError(client.GetLastError())
+        try:
+            # command, command version = 0, body length = 4, body = 1
+            sock.sendall(pack('>hhII', SEARCHD_COMMAND_PERSIST, 0, 4, 1))
+        except socket.error, e:
+            sock.close()
+            raise BatchError('failed to open persistent connection: %s' % e)
+        self._sock = sock
+        self._owned = True
+        # keeps _GetResponse from closing the socket after every response
+        client._socket = sock
+
+    def send(self, header, body, client_ver):
+        """
+        Write a request without waiting for its response. Raises
+        BatchError if the connection broke or the write timed out.
+        """
+        if self._sock is None:
+            self.open()
+        try:
+            sent = self._client._Send(self._sock, header, body)
+        except socket.error, e:
+            # ECONNRESET, EPIPE: searchd dropped the connection
+            self.close(broken=True)
+            raise BatchError('failed to send request to searchd: %s' % e)
+        if not sent:
+            self.close(broken=True)
+            raise BatchError(self._client.GetLastError())
+        self._inflight.append(client_ver)
+
+    def pending(self):
+        return len(self._inflight)
+
+    def receive(self):
+        """
+        Read the oldest outstanding response. Returns its payload, or None
+        with the error left in client.GetLastError() when searchd answered
+        with an error. Raises BatchError if the connection broke.
+        """
+        client_ver = self._inflight.popleft()
+        try:
+            response = self._client._RecvResponse(self._sock)
+        except socket.error, e:
+            self.close(broken=True)
+            raise BatchError('failed to read searchd response: %s' % e)
+        if response is None or len(response[3]) != response[2]:
+            self.close(broken=True)
+            raise BatchError('failed to read searchd response')
+        return self._client._CheckResponse(*(response + (client_ver,)))
+
+    def close(self, broken=False):
+        """
+        Release the connection. A connection with unread responses is
+        always closed rather than reused.
+        """
+        sock, self._sock = self._sock, None
+        if sock is None or not self._owned:
+            return
+        broken = broken or bool(self._inflight)
+        self._inflight.clear()
+        client = self._client
+        release = getattr(client, '_Release', None)
+        if release is not None:
+            # leased from a connection pool, give it back
+            client._lease_ok = not broken
+            release()
+        else:
+            client._socket = None
+            sock.close()
+        self._owned = False
+
+
+class FingerprintBatcher(object):
+    """
+    Looks up phrases with multi-query requests built by client.AddQuery().
+
+    Every query is built with the client's current settings (match mode,
+    limits, filters); query(phrase) turns a phrase into query text and
+    defaults to the phrase itself. A request holds at most max_queries
+    queries and max_request_bytes bytes (a single larger query is sent
+    alone), and up to depth requests are in flight at once.
+    """
+
+    def __init__(self, client, index='*', max_queries=MAX_QUERIES,
+                 max_request_bytes=65536, depth=2, query=None):
+        assert 0 < max_queries <= MAX_QUERIES
+        assert depth > 0
+        self.client = client
+        self.index = index
+        self.max_queries = max_queries
+        self.max_request_bytes = max_request_bytes
+        self.depth = depth
+        self.query = query or (lambda phrase: phrase)
+
+        self.requests = 0       # multi-query requests sent
+        self.errors = []        # (phrase, message) for failed queries
+
+    def lookup(self, phrases):
+        """
+        Generate (phrase, matches) pairs in input order. Queries that
+        searchd rejected yield an empty match list and are recorded in
+        errors. Raises BatchError if the connection fails.
+        """
+        client = self.client
+        assert len(client._reqs) == 0, 'client has queries added with AddQuery()'
+
+        pending = deque()
+        pipeline = SphinxPipeline(client)
+        try:
+            for batch, reqs in self._batches(phrases):
+                header, body = client._SearchRequest(reqs)
+                pipeline.send(header, body, VER_COMMAND_SEARCH)
+                pending.append(batch)
+                self.requests += 1
+                if len(pending) >= self.depth:
+                    for pair in self._decode(pipeline, pending.popleft()):
+                        yield pair
+            while pending:
+                for pair in self._decode(pipeline, pending.popleft()):
+                    yield pair
+        finally:
+            pipeline.close()
+
+    def _batches(self, phrases):
+        template = self.client.FreezeQuery()
+        batch, reqs, size = [], [], 0
+        for phrase in phrases:
+            req = template.Build(self.query(phrase), self.index)
+            if batch and (len(batch) >= self.max_queries or
+                          size + len(req) > self.max_request_bytes):
+                yield batch, reqs
+                batch, reqs, size = [], [], 0
+            batch.append(phrase)
+            reqs.append(req)
+            size += len(req)
+        if batch:
+            yield batch, reqs
+
+    def _decode(self, pipeline, batch):
+        client = self.client
+        response = pipeline.receive()
+        if response is None:
+            # whole request rejected, e.g. unknown index
+            error = client.GetLastError()
+            for phrase in batch:
+                self.errors.append((phrase, error))
+                yield phrase, []
+            return
+        results = client._ParseSearchResponse(response, len(batch))
+        for phrase, result in zip(batch, results):
+            if result['status'] == SEARCHD_ERROR:
+                self.errors.append((phrase, result['error']))
+                yield phrase, []
+            else:
+                yield phrase, result['matches']
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+
+"""
+Result cache in front of SphinxClient.Query/RunQueries.
+
+Shingle and keyword queries repeat across submissions of the same lab, so
+CachedSphinxClient keeps decoded result sets keyed on the server and the
+exact serialized query built by AddQuery(). Any difference in settings
+(limits, filters, weights...) gives a different key. Entries expire after a
+TTL, the least recently used ones are evicted past max_entries, and
+UpdateAttributes() drops all entries of the updated indexes.
+
+    cl = CachedSphinxClient()
+    res = cl.Query('some text', 'submissions')     # searchd
+    res = cl.Query('some text', 'submissions')     # cache
+
+Cached result sets are shared between callers and must not be modified.
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+from struct import unpack_from
+
+from lib.sphinxapi import SphinxClient, SEARCHD_ERROR
+
+
+class LRUCache(object):
+    """
+    Thread-safe mapping with size-bounded LRU eviction and per-entry TTL.
+    get() returns None for missing and expired keys.
+    """
+
+    def __init__(self, max_entries=10000, ttl=None):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._data = OrderedDict()      # key -> (value, expires_at), oldest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires is not None and expires <= time.time():
+                self.expirations += 1
+                self.misses += 1
+                self._forget(key)
+                return None
+            # re-insert as most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        expires = ttl is not None and time.time() + ttl or None
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            self._remember(key, value)
+            while len(self._data) > self.max_entries:
+                old, _ = self._data.popitem(last=False)
+                self._forget(old)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            if self._data.pop(key, None) is not None:
+                self._forget(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            for key in self._data.keys():
+                self._forget(key)
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'entries': len(self._data),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations}
+
+    def _remember(self, key, value):
+        # hook for subclasses keeping secondary indexes, called under lock
+        pass
+
+    def _forget(self, key):
+        # hook for subclasses keeping secondary indexes, called under lock
+        pass
+
+
+_INDEX_SEPARATORS = re.compile(r'[\s,;]+')
+
+
+def split_indexes(index):
+    """
+    Index names from a searchd index list ('main delta', 'main,delta', '*').
+    """
+    return [name for name in _INDEX_SEPARATORS.split(index) if name]
+
+
+def request_index(req):
+    """
+    Index list of a query serialized by SphinxClient.AddQuery().
+    """
+    # offset, limit, mode, ranker, sort; then sort-by, query, weights, index
+    p = 20
+    p += 4 + unpack_from('>L', req, p)[0]
+    p += 4 + unpack_from('>L', req, p)[0]
+    p += 4 + 4 * unpack_from('>L', req, p)[0]
+    length = unpack_from('>L', req, p)[0]
+    return req[p+4:p+4+length]
+
+
+class SphinxResultCache(LRUCache):
+    """
+    LRUCache of result sets that knows which indexes every entry came
+    from, so entries can be invalidated per index. Entries queried
+    against '*' are dropped on any invalidation.
+    """
+
+    def __init__(self, max_entries=10000, ttl=300):
+        LRUCache.__init__(self, max_entries, ttl)
+        self.invalidations = 0
+        self._by_index = {}     # index name -> set of keys
+
+    def invalidate_index(self, index):
+        """
+        Drop entries of all indexes in the given index list.
+        """
+        self._lock.acquire()
+        try:
+            keys = set()
+            for name in split_indexes(index) + ['*']:
+                keys.update(self._by_index.get(name, ()))
+            for key in keys:
+                if self._data.pop(key, None) is not None:
+                    self._forget(key)
+                    self.invalidations += 1
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        stats = LRUCache.stats(self)
+        stats['invalidations'] = self.invalidations
+        return stats
+
+    def _remember(self, key, value):
+        for name in split_indexes(request_index(key[1])):
+            self._by_index.setdefault(name, set()).add(key)
+
+    def _forget(self, key):
+        for name in split_indexes(request_index(key[1])):
+            keys = self._by_index.get(name)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_index[name]
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Process-wide result cache used by CachedSphinxClient by default.
+    """
+    global _default_cache
+    _default_cache_lock.acquire()
+    try:
+        if _default_cache is None:
+            _default_cache = SphinxResultCache()
+        return _default_cache
+    finally:
+        _default_cache_lock.release()
+
+
+class CachedSphinxClient(SphinxClient):
+    """
+    SphinxClient answering repeated queries from a SphinxResultCache.
+    Only the queries of a batch that missed the cache go to searchd;
+    failed queries are not cached. A plain LRUCache works too, but is
+    cleared whole where a SphinxResultCache drops a single index.
+    """
+
+    def __init__(self, cache=None):
+        SphinxClient.__init__(self)
+        if cache is None:
+            cache = get_default_cache()
+        self._cache = cache
+
+    def GetCache(self):
+        return self._cache
+
+    def _CacheKey(self, req):
+        # row and columnar results of the same query are not interchangeable
+        if self._path:
+            return (self._path, req, self._columnar)
+        return ('%s:%s' % (self._host, self._port), req, self._columnar)
+
+    def RunQueries(self):
+        if len(self._reqs)==0:
+            self._error = 'no queries defined, issue AddQuery() first'
+            return None
+
+        reqs = self._reqs
+        keys = [self._CacheKey(req) for req in reqs]
+        results = [self._cache.get(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            self._error = ''
+            self._warning = ''
+            self._reqs = []
+            return results
+
+        self._reqs = [reqs[i] for i in missing]
+        fresh = SphinxClient.RunQueries(self)
+        if fresh is None:
+            # keep the whole batch queued, as SphinxClient does on failure
+            self._reqs = reqs
+            return None
+
+        for i, result in zip(missing, fresh):
+            results[i] = result
+            if result['status'] != SEARCHD_ERROR:
+                self._cache.set(keys[i], result)
+        self._reqs = []
+        return results
+
+    def UpdateAttributes(self, index, attrs, values):
+        try:
+            return SphinxClient.UpdateAttributes(self, index, attrs, values)
+        finally:
+            # even a failed update may have been applied to some indexes
+            self.InvalidateIndex(index)
+
+    def InvalidateIndex(self, index):
+        """
+        Drop cached results of the given indexes, e.g. after they were
+        rebuilt or updated by other means.
+        """
+        invalidate = getattr(self._cache, 'invalidate_index', None)
+        if invalidate is None:
+            # no per-index bookkeeping, drop everything
+            self._cache.clear()
+        else:
+            invalidate(index)
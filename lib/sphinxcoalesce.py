@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+Coalescing of identical concurrent searchd requests.
+
+When a whole class submits the same lab at once, many workers run
+byte-identical searches at the same moment. CoalescingSphinxClient lets
+the first of them (the leader) go to searchd while the others wait for its
+answer, so N identical concurrent requests cost one round trip:
+
+    flight = SingleFlight()         # share between the threads' clients
+    cl = CoalescingSphinxClient(flight)
+    res = cl.Query('some text', 'submissions')
+    print flight.coalesced
+
+Only requests in flight at the same time are merged, nothing is kept
+afterwards (see CachedSphinxClient for that). Results are shared between
+the callers and must not be modified.
+"""
+
+import sys
+import threading
+
+from lib.sphinxapi import SphinxClient
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Runs at most one func per key at a time; callers arriving while it
+    runs wait and get the same return value (or exception).
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.calls = 0          # funcs actually run
+        self.coalesced = 0      # calls answered by another caller's run
+
+    def do(self, key, func):
+        """
+        Returns (value, shared); shared is True if another caller ran func.
+        """
+        self._lock.acquire()
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            self._lock.release()
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.value, True
+        call = self._calls[key] = _Call()
+        self.calls += 1
+        self._lock.release()
+
+        try:
+            call.value = func()
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            self._lock.acquire()
+            try:
+                del self._calls[key]
+            finally:
+                self._lock.release()
+            call.done.set()
+        return call.value, False
+
+    def stats(self):
+        return {'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls)}
+
+
+_default_flight = SingleFlight()
+
+
+def get_default_flight():
+    """
+    Process-wide SingleFlight used by CoalescingSphinxClient by default.
+    """
+    return _default_flight
+
+
+class CoalescingSphinxClient(SphinxClient):
+    """
+    SphinxClient that merges RunQueries(), BuildExcerpts() and
+    BuildKeywords() calls identical to one already in flight on the same
+    server into it. Requests are compared by their serialized bytes.
+    UpdateAttributes() is never coalesced.
+    """
+
+    def __init__(self, flight=None):
+        SphinxClient.__init__(self)
+        if flight is None:
+            flight = get_default_flight()
+        self._flight = flight
+
+    def GetFlight(self):
+        return self._flight
+
+    def _Coalesce(self, key, method, *args):
+        """
+        INTERNAL METHOD, DO NOT CALL. Runs method through the flight,
+        carrying its error and warning over to the waiting clients.
+        """
+        def run():
+            value = method(self, *args)
+            return value, self._error, self._warning
+        server = self._path or (self._host, self._port)
+        (value, error, warning), shared = self._flight.do((server,) + key, run)
+        if shared:
+            self._error = error
+            self._warning = warning
+        return value
+
+    def RunQueries(self):
+        if len(self._reqs)==0:
+            self._error = 'no queries defined, issue AddQuery() first'
+            return None
+        key = ('search', self._columnar) + tuple(self._reqs)
+        results = self._Coalesce(key, SphinxClient.RunQueries)
+        if results is not None:
+            self._reqs = []
+        return results
+
+    # the request is built once, for the key and for the leader to send
+
+    def BuildExcerpts(self, docs, index, words, opts=None):
+        header, body = self._ExcerptsRequest(docs, index, words, dict(opts or {}))
+        return self._Coalesce(('excerpt', body), SphinxClient._RunExcerpts,
+                              header, body, len(docs))
+
+    def BuildKeywords(self, query, index, hits):
+        header, body = self._KeywordsRequest(query, index, hits)
+        return self._Coalesce(('keywords', body), SphinxClient._RunKeywords,
+                              header, body, hits)
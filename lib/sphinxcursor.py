@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming cursor over result sets larger than max_matches.
+
+Offset paging can't go past max_matches and makes searchd match and sort
+everything before the offset again for every page. SphinxCursor walks the
+result set in document ID order instead: every chunk is a fresh query for
+the next `chunk` matches with IDs above the last one seen (keyset
+pagination with SetIDRange), so memory stays bounded by one chunk on both
+ends no matter how many matches there are:
+
+    cl = SphinxClient()
+    cl.SetFilter('lab_id', [lab_id])
+    cursor = SphinxCursor(cl, 'some text', 'submissions', chunk=1000)
+    for match in cursor:
+        writer.writerow([match['id'], match['weight']])
+
+Filters, match mode, ranker and the rest of the client settings apply to
+every chunk; sorting, limits, the ID range and the result mode (rows) are
+the cursor's own and the client's values are restored after each chunk,
+so the client may run other queries between chunks. The index must not
+change while a cursor walks it, or matches may be skipped or repeated.
+"""
+
+from lib.sphinxapi import SPH_SORT_EXTENDED
+
+
+MAX_DOCID = (1 << 64) - 1
+
+
+class CursorError(Exception):
+    """Chunk query failed"""
+    pass
+
+
+class SphinxCursor(object):
+    """
+    Iterates over all matches of query in ascending document ID order,
+    fetching chunk matches per searchd query. chunks() yields the match
+    lists as they arrive. total_found is known after the first chunk.
+    Raises CursorError when a query fails.
+    """
+
+    def __init__(self, client, query, index='*', chunk=1000, comment=''):
+        assert chunk > 0
+        self.client = client
+        self.query = query
+        self.index = index
+        self.chunk = chunk
+        self.comment = comment
+
+        self.total_found = None
+        self.fetched = 0        # matches yielded so far
+        self.queries = 0        # chunk queries run so far
+        self.last_id = None     # ID of the last match yielded
+
+    def __iter__(self):
+        for matches in self.chunks():
+            for match in matches:
+                yield match
+
+    def chunks(self):
+        client = self.client
+        min_id = client._min_id
+        max_id = client._max_id or MAX_DOCID
+        if self.last_id is not None:
+            min_id = self.last_id + 1
+        while min_id <= max_id:
+            result = self._fetch(min_id, max_id)
+            matches = result['matches']
+            if self.total_found is None:
+                self.total_found = result['total_found']
+            if not matches:
+                return
+            self.fetched += len(matches)
+            self.last_id = matches[-1]['id']
+            yield matches
+            if len(matches) < self.chunk:
+                return
+            min_id = self.last_id + 1
+
+    def _fetch(self, min_id, max_id):
+        client = self.client
+        saved = (client._offset, client._limit, client._maxmatches, client._cutoff,
+                 client._sort, client._sortby, client._min_id, client._max_id,
+                 client._columnar)
+        try:
+            # chunks are match lists, whatever the caller's result mode
+            client.SetColumnarResult(False)
+            client.SetSortMode(SPH_SORT_EXTENDED, '@id asc')
+            client.SetIDRange(min_id, max_id)
+            client.SetLimits(0, self.chunk, self.chunk, 0)
+            result = client.Query(self.query, self.index, self.comment)
+        finally:
+            (client._offset, client._limit, client._maxmatches, client._cutoff,
+             client._sort, client._sortby, client._min_id, client._max_id,
+             client._columnar) = saved
+        self.queries += 1
+        if result is None:
+            raise CursorError(client.GetLastError())
+        return result
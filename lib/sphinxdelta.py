@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Main+delta lifecycle of the submissions index.
+
+Rebuilding the whole index for every batch of new submissions takes longer
+and longer as the corpus grows. DeltaIndexManager keeps two indexes of the
+same source instead: main holds documents up to a high-water mark, delta
+everything above it. New documents only cost a delta rebuild; once the
+delta grows past merge_docs documents or merge_every seconds, it is merged
+into main with `indexer --merge` and the mark moves up:
+
+    manager = DeltaIndexManager('/var/lib/antiplag/sphinx.json', max_id,
+                                config='/etc/sphinx/antiplag.conf')
+    manager.update()                # delta rebuild, merge when it is time
+    res = cl.Query('some text', manager.indexes())
+    print manager.freshness()
+
+max_id is a callable returning the highest document ID in the source. The
+sources of both indexes have to index the IDs source_range() gives, e.g.
+with `xmlpipe_command = python manage.py sphinx_xmlpipe --range delta`.
+State is kept in a JSON file, written atomically; runs are serialized with
+a lock file.
+"""
+
+import fcntl
+import json
+import os
+import subprocess
+import threading
+import time
+
+
+class IndexerError(Exception):
+    """indexer failed"""
+    pass
+
+
+class DeltaIndexManager(object):
+    """
+    Builds and merges main and delta indexes with the indexer binary,
+    tracking the IDs each of them holds in state_path.
+    """
+
+    def __init__(self, state_path, max_id, main='submissions', delta='submissions_delta',
+                 config=None, indexer='indexer', merge_docs=50000, merge_every=86400):
+        self.state_path = state_path
+        self.max_id = max_id
+        self.main = main
+        self.delta = delta
+        self.config = config
+        self.indexer = indexer
+        self.merge_docs = merge_docs
+        self.merge_every = merge_every
+
+    def indexes(self):
+        """
+        Index list for SphinxClient.Query()/AddQuery() covering both indexes.
+        """
+        return '%s %s' % (self.main, self.delta)
+
+    def state(self):
+        """
+        main_max_id: the high-water mark, delta_max_id: last ID in delta,
+        *_target: last ID the running (or failed) build of each index
+        takes, *_built: when each index was last built, merged: last merge.
+        """
+        state = {'main_max_id': 0, 'delta_max_id': 0,
+                 'main_target': 0, 'delta_target': 0,
+                 'main_built': None, 'delta_built': None, 'merged': None}
+        try:
+            f = open(self.state_path)
+        except IOError:
+            return state
+        try:
+            state.update(json.load(f))
+        finally:
+            f.close()
+        return state
+
+    def source_range(self, index):
+        """
+        (min_id, max_id) the source of index ('main' or 'delta') should
+        index now.
+        """
+        state = self.state()
+        if index == 'main':
+            return 1, state['main_target']
+        assert index == 'delta', 'unknown index %r' % index
+        return state['main_max_id'] + 1, max(state['delta_target'], state['main_max_id'])
+
+    def freshness(self):
+        """
+        How stale searches are: documents in the source not in any index
+        yet and lag, the seconds since the last build if there are any
+        (searches see the source as of then).
+        """
+        state = self.state()
+        pending = max(0, self.max_id() - max(state['main_max_id'], state['delta_max_id']))
+        lag = 0
+        last = state['delta_built'] or state['main_built']
+        if pending and last is not None:
+            lag = time.time() - last
+        return {'indexed_up_to': max(state['main_max_id'], state['delta_max_id']),
+                'pending': pending,
+                'lag': lag,
+                'delta_docs': max(0, state['delta_max_id'] - state['main_max_id']),
+                'delta_built': state['delta_built'],
+                'merged': state['merged']}
+
+    def update(self):
+        """
+        Rebuilds the delta if there are new documents, then merges it into
+        main if it is large or old enough; the first update builds main
+        instead. Returns what was done.
+        """
+        lock = self._lock()
+        try:
+            done = []
+            state = self.state()
+            if state['main_built'] is None:
+                # nothing to merge into yet
+                self._rebuild(state)
+                return ['rebuild']
+            if self.max_id() > state['delta_max_id']:
+                self._build_delta(state)
+                done.append('delta')
+            if self._merge_due(state):
+                self._merge(state)
+                done.append('merge')
+            return done
+        finally:
+            lock.close()
+
+    def merge(self):
+        lock = self._lock()
+        try:
+            self._merge(self.state())
+        finally:
+            lock.close()
+
+    def rebuild(self):
+        """
+        Reindexes everything into main and empties the delta.
+        """
+        lock = self._lock()
+        try:
+            self._rebuild(self.state())
+        finally:
+            lock.close()
+
+    def _rebuild(self, state):
+        target = self.max_id()
+        state['main_target'] = target
+        self._save(state)
+        self._run('--rotate', self.main)
+        state['main_max_id'] = state['delta_max_id'] = target
+        state['main_built'] = state['merged'] = time.time()
+        self._save(state)
+        self._build_delta(state)
+
+    def _merge_due(self, state):
+        if state['main_built'] is None:
+            return False
+        delta_docs = state['delta_max_id'] - state['main_max_id']
+        if delta_docs <= 0:
+            return False
+        if delta_docs >= self.merge_docs:
+            return True
+        last = state['merged'] or state['main_built'] or 0
+        return time.time() - last >= self.merge_every
+
+    def _build_delta(self, state):
+        target = self.max_id()
+        state['delta_target'] = target
+        self._save(state)
+        self._run('--rotate', self.delta)
+        state['delta_max_id'] = max(target, state['main_max_id'])
+        state['delta_built'] = time.time()
+        self._save(state)
+
+    def _merge(self, state):
+        if state['delta_max_id'] <= state['main_max_id']:
+            return
+        self._run('--rotate', '--merge', self.main, self.delta)
+        state['main_max_id'] = state['main_target'] = state['delta_max_id']
+        state['merged'] = time.time()
+        self._save(state)
+        # the merged documents would be found twice otherwise
+        self._build_delta(state)
+
+    def _run(self, *args):
+        command = [self.indexer]
+        if self.config:
+            command += ['--config', self.config]
+        command += list(args)
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+        except OSError, e:
+            raise IndexerError('%s: %s' % (self.indexer, e))
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise IndexerError('%s exited with %d: %s' % (
+                ' '.join(command), process.returncode, output[-2000:].strip()))
+        return output
+
+    def _lock(self):
+        f = open(self.state_path + '.lock', 'a')
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _save(self, state):
+        tmp = '%s.%d.tmp' % (self.state_path, os.getpid())
+        f = open(tmp, 'w')
+        try:
+            json.dump(state, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.state_path)
+
+
+_default_manager = None
+_default_manager_lock = threading.Lock()
+
+
+def get_default_manager():
+    """
+    DeltaIndexManager of the project's submissions index, configured by
+    the SPHINX_* settings, over the SPHINX_SOURCE_MODEL table.
+    """
+    global _default_manager
+    _default_manager_lock.acquire()
+    try:
+        if _default_manager is None:
+            from django.conf import settings
+            from django.db import models
+            from django.db.models import Max
+
+            def max_id():
+                name = getattr(settings, 'SPHINX_SOURCE_MODEL', 'pagesmisc.Submission')
+                model = models.get_model(*name.split('.'))
+                return model._default_manager.aggregate(max_id=Max('pk'))['max_id'] or 0
+
+            _default_manager = DeltaIndexManager(
+                getattr(settings, 'SPHINX_STATE_FILE', 'sphinx-state.json'), max_id,
+                main=getattr(settings, 'SPHINX_MAIN_INDEX', 'submissions'),
+                delta=getattr(settings, 'SPHINX_DELTA_INDEX', 'submissions_delta'),
+                config=getattr(settings, 'SPHINX_CONFIG', None),
+                indexer=getattr(settings, 'SPHINX_INDEXER', 'indexer'),
+                merge_docs=getattr(settings, 'SPHINX_MERGE_DOCS', 50000),
+                merge_every=getattr(settings, 'SPHINX_MERGE_EVERY', 86400))
+        return _default_manager
+    finally:
+        _default_manager_lock.release()
@@ -0,0 +1,569 @@
+# -*- coding: utf-8 -*-
+
+"""
+In-process searchd protocol emulator for tests and benchmarks.
+
+SearchdEmulator speaks the searchd handshake and the SEARCH, EXCERPT,
+KEYWORDS, UPDATE and PERSIST commands (the versions lib.sphinxapi sends)
+over TCP or unix sockets, backed by MemoryIndex corpora:
+
+    index = MemoryIndex(attrs=[('lab_id', SPH_ATTR_INTEGER)])
+    index.add(1, u'текст первой работы', lab_id=3)
+    server = SearchdEmulator({'submissions': index}).start()
+    cl = SphinxClient()
+    cl.SetServer(*server.address)
+    ...
+    server.stop()
+
+Matching is deliberately simple: lowercased word tokens, ALL/ANY/PHRASE
+semantics (extended modes treat a quoted query as a phrase and anything
+else as ALL), weight is the number of query term occurrences. ID range,
+values/range filters, limits, max-matches and the relevance/attribute/
+'@id asc'-style extended sort orders are honoured; grouping, overrides,
+geo anchors and select lists are accepted and ignored.
+"""
+
+import os
+import re
+import socket
+import SocketServer
+import threading
+import time
+from struct import pack, unpack, unpack_from
+
+from lib.sphinxapi import SEARCHD_COMMAND_SEARCH, SEARCHD_COMMAND_EXCERPT, \
+    SEARCHD_COMMAND_UPDATE, SEARCHD_COMMAND_KEYWORDS, SEARCHD_COMMAND_PERSIST, \
+    SEARCHD_OK, SEARCHD_ERROR, \
+    SPH_MATCH_ANY, SPH_MATCH_PHRASE, SPH_MATCH_BOOLEAN, SPH_MATCH_EXTENDED, \
+    SPH_MATCH_FULLSCAN, SPH_MATCH_EXTENDED2, SPH_RANK_NONE, \
+    SPH_SORT_ATTR_DESC, SPH_SORT_ATTR_ASC, SPH_SORT_EXTENDED, \
+    SPH_FILTER_VALUES, SPH_FILTER_RANGE, SPH_FILTER_FLOATRANGE, \
+    SPH_ATTR_INTEGER, SPH_ATTR_FLOAT, SPH_ATTR_BIGINT, SPH_ATTR_MULTI
+
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """
+    Lowercased word tokens of a utf-8 or unicode string, as utf-8 strings.
+    """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8', 'replace')
+    return [w.encode('utf-8') for w in _WORD.findall(text.lower())]
+
+
+class MemoryIndex(object):
+    """
+    Documents with full-text fields and typed attributes, held in memory.
+    """
+
+    def __init__(self, fields=('body',), attrs=()):
+        self.fields = list(fields)
+        self.attrs = list(attrs)        # [(name, SPH_ATTR_* type), ...]
+        self.docs = {}                  # id -> (tokens, attr values dict)
+        self.lock = threading.Lock()
+
+    def add(self, docid, text, **attrs):
+        """
+        Add a document; text is a string (first field) or a field dict.
+        Missing attributes default to 0 (empty list for MVA).
+        """
+        if not isinstance(text, dict):
+            text = {self.fields[0]: text}
+        tokens = []
+        for field in self.fields:
+            tokens.extend(tokenize(text.get(field, '')))
+        values = {}
+        for name, type_ in self.attrs:
+            default = type_ & SPH_ATTR_MULTI and [] or 0
+            values[name] = attrs.get(name, default)
+        self.docs[docid] = (tokens, values)
+
+    def __len__(self):
+        return len(self.docs)
+
+
+# response encoding
+
+def _string(s):
+    return pack('>L', len(s)) + s
+
+
+def encode_result(fields, attrs, matches, words, total=None, total_found=None,
+                  time_ms=0, id64=1):
+    """
+    Encode one search result the way searchd does (command v.1.16).
+    matches are (id, weight, [attr values]) in schema order, words are
+    (word, docs, hits) tuples. total and total_found default to the
+    number of matches.
+    """
+    out = [pack('>L', SEARCHD_OK), pack('>L', len(fields))]
+    out.extend(_string(f) for f in fields)
+    out.append(pack('>L', len(attrs)))
+    for name, type_ in attrs:
+        out.append(_string(name) + pack('>L', type_))
+    out.append(pack('>2L', len(matches), id64))
+    for doc, weight, values in matches:
+        out.append(id64 and pack('>QL', doc, weight) or pack('>2L', doc, weight))
+        for (name, type_), value in zip(attrs, values):
+            if type_ == (SPH_ATTR_MULTI | SPH_ATTR_INTEGER):
+                out.append(pack('>L%dL' % len(value), len(value), *value))
+            elif type_ == SPH_ATTR_FLOAT:
+                out.append(pack('>f', value))
+            elif type_ == SPH_ATTR_BIGINT:
+                out.append(pack('>q', value))
+            else:
+                out.append(pack('>L', value))
+    if total is None:
+        total = len(matches)
+    if total_found is None:
+        total_found = total
+    out.append(pack('>4L', total, total_found, time_ms, len(words)))
+    for word, docs, hits in words:
+        out.append(_string(word) + pack('>2L', docs, hits))
+    return ''.join(out)
+
+
+def encode_error(message):
+    return pack('>L', SEARCHD_ERROR) + _string(message)
+
+
+# request decoding
+
+class _Reader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.p = 0
+
+    def _get(self, fmt, size):
+        value = unpack_from(fmt, self.data, self.p)
+        self.p += size
+        return value
+
+    def u32(self):
+        return self._get('>L', 4)[0]
+
+    def u64(self):
+        return self._get('>Q', 8)[0]
+
+    def i64(self):
+        return self._get('>q', 8)[0]
+
+    def i32(self):
+        return self._get('>l', 4)[0]
+
+    def f32(self):
+        return self._get('>f', 4)[0]
+
+    def string(self):
+        length = self.u32()
+        value = self.data[self.p:self.p+length]
+        self.p += length
+        return value
+
+
+def parse_query(r):
+    """
+    Decode one query serialized by SphinxClient.AddQuery() into a dict.
+    """
+    q = {}
+    q['offset'], q['limit'], q['mode'], q['ranker'], q['sort'] = [r.u32() for i in range(5)]
+    q['sortby'] = r.string()
+    q['query'] = r.string()
+    q['weights'] = [r.u32() for i in range(r.u32())]
+    q['index'] = r.string()
+    if r.u32():
+        q['min_id'], q['max_id'] = r.u64(), r.u64()
+    else:
+        q['min_id'], q['max_id'] = r.u32(), r.u32()
+    q['filters'] = filters = []
+    for i in range(r.u32()):
+        f = {'attr': r.string(), 'type': r.u32()}
+        if f['type'] == SPH_FILTER_VALUES:
+            f['values'] = [r.i64() for j in range(r.u32())]
+        elif f['type'] == SPH_FILTER_RANGE:
+            f['min'], f['max'] = r.i64(), r.i64()
+        elif f['type'] == SPH_FILTER_FLOATRANGE:
+            f['min'], f['max'] = r.f32(), r.f32()
+        f['exclude'] = r.u32()
+        filters.append(f)
+    q['groupfunc'] = r.u32()
+    q['groupby'] = r.string()
+    q['maxmatches'] = r.u32()
+    q['groupsort'] = r.string()
+    q['cutoff'], q['retrycount'], q['retrydelay'] = r.u32(), r.u32(), r.u32()
+    q['groupdistinct'] = r.string()
+    if r.u32():
+        q['anchor'] = (r.string(), r.string(), r.f32(), r.f32())
+    q['indexweights'] = dict((r.string(), r.u32()) for i in range(r.u32()))
+    q['maxquerytime'] = r.u32()
+    q['fieldweights'] = dict((r.string(), r.u32()) for i in range(r.u32()))
+    q['comment'] = r.string()
+    q['overrides'] = overrides = {}
+    for i in range(r.u32()):
+        name, type_, count = r.string(), r.u32(), r.u32()
+        values = {}
+        for j in range(count):
+            docid = r.u64()
+            if type_ == SPH_ATTR_FLOAT:
+                values[docid] = r.f32()
+            elif type_ == SPH_ATTR_BIGINT:
+                values[docid] = r.i64()
+            else:
+                values[docid] = r.i32()
+        overrides[name] = values
+    q['select'] = r.string()
+    return q
+
+
+# searching
+
+_PHRASE = re.compile(r'^\s*"(.*)"\s*$')
+
+
+def _query_terms(q):
+    text = q['query']
+    phrase = q['mode'] == SPH_MATCH_PHRASE
+    if q['mode'] in (SPH_MATCH_BOOLEAN, SPH_MATCH_EXTENDED, SPH_MATCH_EXTENDED2):
+        m = _PHRASE.match(text)
+        if m:
+            text, phrase = m.group(1), True
+    return tokenize(text), phrase
+
+
+def _count_phrase(tokens, terms):
+    n = len(terms)
+    return sum(1 for i in xrange(len(tokens) - n + 1) if tokens[i:i+n] == terms)
+
+
+def _passes(values, f):
+    value = values.get(f['attr'])
+    if value is None:
+        ok = False
+    elif f['type'] == SPH_FILTER_VALUES:
+        if isinstance(value, list):
+            ok = bool(set(value) & set(f['values']))
+        else:
+            ok = value in f['values']
+    else:
+        ok = f['min'] <= value <= f['max']
+    return ok != bool(f['exclude'])
+
+
+def _sort_key(q):
+    sort, sortby = q['sort'], q['sortby']
+    if sort == SPH_SORT_ATTR_DESC:
+        clauses = [(sortby, True), ('@weight', True)]
+    elif sort == SPH_SORT_ATTR_ASC:
+        clauses = [(sortby, False), ('@weight', True)]
+    elif sort == SPH_SORT_EXTENDED:
+        clauses = []
+        for clause in sortby.split(','):
+            parts = clause.split()
+            if parts:
+                desc = len(parts) > 1 and parts[1].lower() == 'desc'
+                clauses.append((parts[0], desc))
+    else:
+        clauses = [('@weight', True)]
+    clauses.append(('@id', False))
+
+    def key(match):
+        docid, weight, values = match
+        out = []
+        for name, desc in clauses:
+            if name == '@id':
+                value = docid
+            elif name in ('@weight', '@rank', '@relevance'):
+                value = weight
+            else:
+                value = values.get(name, 0)
+            out.append(desc and -value or value)
+        return out
+    return key
+
+
+class _Searcher(object):
+
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def resolve(self, index):
+        names = [n for n in re.split(r'[\s,;]+', index) if n]
+        if names == ['*']:
+            names = sorted(self.indexes.keys())
+        for name in names:
+            if name not in self.indexes:
+                raise KeyError(name)
+        return [self.indexes[name] for name in names]
+
+    def search(self, q):
+        try:
+            indexes = self.resolve(q['index'])
+        except KeyError, e:
+            return encode_error('unknown local index \'%s\' in search request' % e.args[0])
+        if not indexes:
+            return encode_error('no enabled local indexes to search')
+
+        start = time.time()
+        terms, phrase = _query_terms(q)
+        fullscan = q['mode'] == SPH_MATCH_FULLSCAN or not terms
+        max_id = q['max_id'] or (1 << 64) - 1
+
+        found = {}
+        stats = dict((t, [0, 0]) for t in terms)
+        for index in indexes:
+            index.lock.acquire()
+            try:
+                docs = index.docs.items()
+            finally:
+                index.lock.release()
+            for docid, (tokens, values) in docs:
+                if not q['min_id'] <= docid <= max_id:
+                    continue
+                counts = [tokens.count(t) for t in terms]
+                for t, c in zip(terms, counts):
+                    if c:
+                        stats[t][0] += 1
+                        stats[t][1] += c
+                if fullscan:
+                    weight = 1
+                elif phrase:
+                    weight = _count_phrase(tokens, terms)
+                elif q['mode'] == SPH_MATCH_ANY:
+                    weight = sum(counts)
+                else:
+                    weight = all(counts) and sum(counts) or 0
+                if not weight:
+                    continue
+                if q['ranker'] == SPH_RANK_NONE:
+                    weight = 1
+                values = dict(values)
+                values['@id'] = docid
+                if all(_passes(values, f) for f in q['filters']):
+                    # later indexes in the list override earlier ones
+                    found[docid] = (docid, weight, values)
+
+        matches = sorted(found.values(), key=_sort_key(q))
+        total = min(len(matches), q['maxmatches'])
+        page = matches[:total][q['offset']:q['offset']+q['limit']]
+
+        attrs = indexes[0].attrs
+        rows = [(match_id, match_weight, [match_values[name] for name, type_ in attrs])
+                for match_id, match_weight, match_values in page]
+        words = [(t, stats[t][0], stats[t][1]) for t in terms]
+        elapsed = int((time.time() - start) * 1000)
+        return encode_result(indexes[0].fields, attrs, rows, words, total=total,
+                             total_found=len(matches), time_ms=elapsed)
+
+    def keywords(self, query, index, hits):
+        try:
+            indexes = self.resolve(index)
+        except KeyError, e:
+            raise ValueError('unknown local index \'%s\' in search request' % e.args[0])
+        out = []
+        terms = tokenize(query)
+        out.append(pack('>L', len(terms)))
+        for term in terms:
+            out.append(_string(term) + _string(term))
+            if hits:
+                docs = hits_ = 0
+                for idx in indexes:
+                    for tokens, values in idx.docs.values():
+                        c = tokens.count(term)
+                        docs += c > 0
+                        hits_ += c
+                out.append(pack('>2L', docs, hits_))
+        return ''.join(out)
+
+    def update(self, index, attrs, values):
+        try:
+            indexes = self.resolve(index)
+        except KeyError, e:
+            raise ValueError('unknown local index \'%s\' in update request' % e.args[0])
+        updated = 0
+        for idx in indexes:
+            names = [name for name, type_ in idx.attrs]
+            for attr in attrs:
+                if attr not in names:
+                    raise ValueError('index \'%s\': attribute \'%s\' not found' % (index, attr))
+            idx.lock.acquire()
+            try:
+                for docid, entry in values:
+                    doc = idx.docs.get(docid)
+                    if doc is not None:
+                        doc[1].update(zip(attrs, entry))
+                        updated += 1
+            finally:
+                idx.lock.release()
+        return updated
+
+
+def excerpt(doc, words, opts):
+    """
+    Highlight every occurrence of any of the words in doc.
+    """
+    udoc = doc.decode('utf-8', 'replace')
+    terms = set(w.decode('utf-8') for w in tokenize(words))
+
+    def mark(m):
+        if m.group(0).lower() in terms:
+            return opts['before'] + m.group(0) + opts['after']
+        return m.group(0)
+    text = _WORD.sub(mark, udoc)
+    if opts['limit'] and len(text) > opts['limit']:
+        text = text[:opts['limit']] + opts['separator']
+    return text.encode('utf-8')
+
+
+# server
+
+class _Handler(SocketServer.BaseRequestHandler):
+
+    def _recv(self, size):
+        data = []
+        left = size
+        while left > 0:
+            chunk = self.request.recv(left)
+            if not chunk:
+                raise EOFError
+            data.append(chunk)
+            left -= len(chunk)
+        return ''.join(data)
+
+    def handle(self):
+        server = self.server
+        sock = self.request
+        server.emulator._connections[sock] = threading.current_thread()
+        try:
+            sock.sendall(pack('>L', 1))
+            self._recv(4)
+            persistent = False
+            while True:
+                cmd, ver, length = unpack('>2HL', self._recv(8))
+                body = self._recv(length)
+                server.emulator.requests += 1
+                if cmd == SEARCHD_COMMAND_PERSIST:
+                    persistent = bool(unpack('>L', body)[0])
+                    continue
+                status, reply = server.emulator.dispatch(cmd, body)
+                if server.emulator.delay:
+                    time.sleep(server.emulator.delay)
+                sock.sendall(pack('>2HL', status, ver, len(reply)) + reply)
+                if not persistent:
+                    return
+        except (EOFError, socket.error):
+            return
+        finally:
+            server.emulator._connections.pop(sock, None)
+
+
+class _TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class SearchdEmulator(object):
+    """
+    Threaded searchd emulator over a dict of MemoryIndex objects.
+
+    address is ('host', port) for TCP (port 0 picks a free one) or a
+    filesystem path for a unix socket; after start() it holds the actual
+    address, ready for SphinxClient.SetServer(*address) (or SetServer(path)).
+    delay seconds are slept before every response.
+    """
+
+    def __init__(self, indexes, address=('127.0.0.1', 0), delay=0):
+        self.indexes = indexes
+        self.address = address
+        self.delay = delay
+        self.requests = 0
+        self._searcher = _Searcher(indexes)
+        self._server = None
+        self._thread = None
+        self._connections = {}    # socket -> handler thread
+
+    def start(self):
+        if isinstance(self.address, tuple):
+            server = _TCPServer(self.address, _Handler)
+            self.address = server.server_address[:2]
+        else:
+            if os.path.exists(self.address):
+                os.unlink(self.address)
+            server = _UnixServer(self.address, _Handler)
+        server.emulator = self
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is None:
+            return
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        # wake up handlers blocked on persistent connections
+        handlers = self._connections.items()
+        for sock, thread in handlers:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        for sock, thread in handlers:
+            thread.join(1.0)
+        if not isinstance(self.address, tuple) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.stop()
+
+    def dispatch(self, cmd, body):
+        """
+        Run one command; returns (status, response payload).
+        """
+        r = _Reader(body)
+        try:
+            if cmd == SEARCHD_COMMAND_SEARCH:
+                results = [self._searcher.search(parse_query(r)) for i in range(r.u32())]
+                return SEARCHD_OK, ''.join(results)
+            if cmd == SEARCHD_COMMAND_EXCERPT:
+                return SEARCHD_OK, self._excerpts(r)
+            if cmd == SEARCHD_COMMAND_KEYWORDS:
+                query, index, hits = r.string(), r.string(), r.u32()
+                return SEARCHD_OK, self._searcher.keywords(query, index, hits)
+            if cmd == SEARCHD_COMMAND_UPDATE:
+                return SEARCHD_OK, pack('>L', self._update(r))
+        except ValueError, e:
+            return SEARCHD_ERROR, _string(str(e))
+        return SEARCHD_ERROR, _string('unknown command (code=%d)' % cmd)
+
+    def _excerpts(self, r):
+        _, _ = r.u32(), r.u32()        # mode, flags
+        index = r.string()
+        if index not in self.indexes:
+            raise ValueError('unknown local index \'%s\' in search request' % index)
+        words = r.string()
+        opts = {'before': r.string().decode('utf-8'),
+                'after': r.string().decode('utf-8'),
+                'separator': r.string().decode('utf-8'),
+                'limit': r.u32(),
+                'around': r.u32()}
+        docs = [r.string() for i in range(r.u32())]
+        return ''.join(_string(excerpt(doc, words, opts)) for doc in docs)
+
+    def _update(self, r):
+        index = r.string()
+        attrs = [r.string() for i in range(r.u32())]
+        values = [(r.u64(), [r.u32() for a in attrs]) for i in range(r.u32())]
+        return self._searcher.update(index, attrs, values)
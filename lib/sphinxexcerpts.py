@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+"""
+Batched, concurrent and cached BuildExcerpts for report highlighting.
+
+A plagiarism report highlights the matched words in dozens of documents,
+and every reload used to rebuild all of them with one blocking request.
+ExcerptBuilder splits the documents into bounded EXCERPT requests, runs
+them concurrently over the persistent connections of a SphinxReactor and
+remembers every excerpt, so a re-opened report is rendered from memory:
+
+    builder = ExcerptBuilder()
+    builder.client.SetServer('localhost', 9312)
+    excerpts = builder.build(texts, 'submissions', 'matched words',
+                             {'limit': 400, 'around': 10})
+
+Excerpts are cached by (sha1 of the document, server, index, words,
+options) in an LRUCache shared by default between all builders of the
+process. Words are keyed as given: their order and repeats can change
+what searchd highlights.
+"""
+
+import threading
+from hashlib import sha1
+
+from lib.sphinxasync import AsyncSphinxClient, SphinxReactor, gather
+from lib.sphinxcache import LRUCache
+
+
+# defaults SphinxClient._ExcerptsRequest() fills in, so that an explicit
+# default and a missing option share cache entries
+_DEFAULT_OPTS = {'before_match': '<b>',
+                 'after_match': '</b>',
+                 'chunk_separator': ' ... ',
+                 'limit': 256,
+                 'around': 5}
+
+
+class ExcerptError(Exception):
+    """Excerpts request failed"""
+    pass
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Process-wide excerpt cache used by ExcerptBuilder by default.
+    """
+    global _default_cache
+    _default_cache_lock.acquire()
+    try:
+        if _default_cache is None:
+            _default_cache = LRUCache(max_entries=20000, ttl=3600)
+        return _default_cache
+    finally:
+        _default_cache_lock.release()
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+class ExcerptBuilder(object):
+    """
+    Builds excerpts through client (an AsyncSphinxClient, created with a
+    4-connection reactor if not given). A request holds at most max_docs
+    documents and max_bytes bytes of text (a larger document is sent
+    alone); all requests of a build() call are in flight together, limited
+    by the reactor's max_connections per server.
+    """
+
+    def __init__(self, client=None, cache=None, max_docs=20,
+                 max_bytes=256 * 1024, timeout=30.0):
+        assert max_docs > 0 and max_bytes > 0
+        if client is None:
+            client = AsyncSphinxClient(SphinxReactor(max_connections=4))
+        if cache is None:
+            cache = get_default_cache()
+        self.client = client
+        self.cache = cache
+        self.max_docs = max_docs
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        self.requests = 0       # EXCERPT requests sent
+
+    def build(self, docs, index, words, opts=None):
+        """
+        Return the excerpts of docs in order, like BuildExcerpts() does.
+        Raises ExcerptError if searchd fails for any of them.
+        """
+        index = _utf8(index)
+        words = _utf8(words)
+        opts = dict(_DEFAULT_OPTS, **(opts or {}))
+        docs = [_utf8(doc) for doc in docs]
+
+        context = (self.client._Endpoint(), index, words, tuple(sorted(opts.items())))
+        keys = [(sha1(doc).digest(), context) for doc in docs]
+        excerpts = [self.cache.get(key) for key in keys]
+        missing = [i for i, excerpt in enumerate(excerpts) if excerpt is None]
+        if not missing:
+            return excerpts
+
+        requests = []
+        for chunk in self._chunks(docs, missing):
+            request = self.client.BuildExcerptsAsync([docs[i] for i in chunk],
+                                                     index, words, dict(opts))
+            requests.append((chunk, request))
+            self.requests += 1
+
+        results = gather([pending for chunk, pending in requests], self.timeout)
+        errors = []
+        for (chunk, request), result in zip(requests, results):
+            if len(result) != len(chunk):
+                errors.append(request.error or 'incomplete excerpts response')
+                continue
+            for i, excerpt in zip(chunk, result):
+                excerpts[i] = excerpt
+                self.cache.set(keys[i], excerpt)
+        if errors:
+            raise ExcerptError('; '.join(errors))
+        return excerpts
+
+    def _chunks(self, docs, positions):
+        chunk, size = [], 0
+        for i in positions:
+            if chunk and (len(chunk) >= self.max_docs or
+                          size + len(docs[i]) > self.max_bytes):
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(i)
+            size += len(docs[i])
+        if chunk:
+            yield chunk
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+
+"""
+Health checks and circuit breakers for searchd endpoints.
+
+Without them every call to a searchd that is down pays the full connect
+timeout before failing. A HealthMonitor keeps a CircuitBreaker per
+endpoint, fed by the outcome of client connects and by a background
+thread that does the searchd handshake with every endpoint periodically:
+
+  closed     calls go through; failure_threshold consecutive failures
+             open the circuit
+  open       calls fail at once ("circuit open"); after reset_timeout
+             the circuit goes half-open
+  half-open  probes and calls go through as trials; success_threshold
+             successes close the circuit, a failure opens it again
+
+    monitor = HealthMonitor(interval=5.0)
+    monitor.watch([('search1', 9312), ('search2', 9312)])
+    monitor.start()
+
+    cl = SphinxClient()
+    cl.SetHealthMonitor(monitor)            # fail fast while open
+    rcl = ReplicatedSphinxClient()
+    rcl.SetHealthMonitor(monitor)           # skip replicas while open
+
+    pprint(monitor.states())
+"""
+
+import threading
+import time
+
+from lib.sphinxapi import SphinxClient
+from lib.sphinxasync import parse_endpoint, _describe
+
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """
+    Three-state breaker of one endpoint. Not thread-safe by itself,
+    HealthMonitor serializes access.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=10.0, success_threshold=1):
+        assert failure_threshold > 0 and success_threshold > 0
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.success_threshold = success_threshold
+
+        self.state = CLOSED
+        self.failures = 0           # consecutive failures
+        self.successes = 0          # consecutive successes while half-open
+        self.opened_at = None
+        self.last_error = ''
+        self.last_change = time.time()
+
+    def ready(self):
+        """
+        True if allow() would let a call through; changes nothing.
+        """
+        return self.state != OPEN or time.time() - self.opened_at >= self.reset_timeout
+
+    def allow(self):
+        if self.state == OPEN:
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self._set(HALF_OPEN)
+        return True
+
+    def success(self):
+        self.failures = 0
+        if self.state == HALF_OPEN:
+            self.successes += 1
+            if self.successes >= self.success_threshold:
+                self._set(CLOSED)
+        elif self.state == OPEN:
+            # a probe got through before the reset timeout
+            self._set(HALF_OPEN)
+            self.successes = 1
+            if self.successes >= self.success_threshold:
+                self._set(CLOSED)
+
+    def failure(self, error=''):
+        self.last_error = error
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and
+                                       self.failures >= self.failure_threshold):
+            self._set(OPEN)
+            self.opened_at = time.time()
+        elif self.state == OPEN:
+            self.opened_at = time.time()
+
+    def snapshot(self):
+        return {'state': self.state,
+                'failures': self.failures,
+                'opened_at': self.opened_at,
+                'last_error': self.last_error,
+                'last_change': self.last_change}
+
+    def _set(self, state):
+        self.state = state
+        self.successes = 0
+        self.last_change = time.time()
+
+
+class HealthMonitor(object):
+    """
+    Circuit breakers of searchd endpoints plus an optional background
+    prober. Endpoints are (host, port) pairs or unix socket paths, as
+    parse_endpoint() returns them; unknown endpoints are added on first
+    use. Probes do the version handshake with a timeout seconds deadline.
+    """
+
+    def __init__(self, interval=5.0, timeout=1.0, failure_threshold=3,
+                 reset_timeout=10.0, success_threshold=1):
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.success_threshold = success_threshold
+
+        self.probes = 0
+        self.rejected = 0           # calls failed fast
+
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def watch(self, servers):
+        for server in servers:
+            self._breaker(parse_endpoint(server))
+
+    def allow(self, endpoint):
+        """
+        True if a call to endpoint may go ahead; an open circuit past its
+        reset timeout goes half-open for it.
+        """
+        self._lock.acquire()
+        try:
+            allowed = self._breaker(endpoint).allow()
+            if not allowed:
+                self.rejected += 1
+            return allowed
+        finally:
+            self._lock.release()
+
+    def ready(self, endpoint):
+        """
+        True if a call to endpoint would be allowed now. Unlike allow(),
+        leaves the circuit as it is.
+        """
+        self._lock.acquire()
+        try:
+            return self._breaker(endpoint).ready()
+        finally:
+            self._lock.release()
+
+    def record(self, endpoint, ok, error=''):
+        """
+        Feed the outcome of a call (or probe) to endpoint's breaker.
+        """
+        self._lock.acquire()
+        try:
+            breaker = self._breaker(endpoint)
+            if ok:
+                breaker.success()
+            else:
+                breaker.failure(error)
+        finally:
+            self._lock.release()
+
+    def state(self, endpoint):
+        self._lock.acquire()
+        try:
+            return self._breaker(endpoint).state
+        finally:
+            self._lock.release()
+
+    def states(self):
+        """
+        {endpoint description: breaker snapshot} of all known endpoints.
+        """
+        self._lock.acquire()
+        try:
+            return dict((_describe(endpoint), breaker.snapshot())
+                        for endpoint, breaker in self._breakers.items())
+        finally:
+            self._lock.release()
+
+    def available(self, endpoints):
+        """
+        The endpoints a call may go to now, in the given order. Only
+        checks; call allow() on the endpoint the call goes to.
+        """
+        return [endpoint for endpoint in endpoints if self.ready(endpoint)]
+
+    def probe(self, endpoint):
+        """
+        Handshake with endpoint and record the outcome. Returns True if
+        it answered. Open circuits are only probed once they are due for
+        a half-open trial.
+        """
+        if not self._allow(endpoint):
+            return False
+        client = SphinxClient()
+        if isinstance(endpoint, tuple):
+            client.SetServer(*endpoint)
+        else:
+            client.SetServer(endpoint)
+        client.SetTimeout(self.timeout)
+        client._Begin('handshake')
+        sock = client._Connect()
+        client._End()
+        self.probes += 1
+        if sock:
+            sock.close()
+        self.record(endpoint, bool(sock), client.GetLastError())
+        return bool(sock)
+
+    def probe_all(self):
+        self._lock.acquire()
+        endpoints = self._breakers.keys()
+        self._lock.release()
+        for endpoint in endpoints:
+            self.probe(endpoint)
+
+    def start(self):
+        """
+        Start probing all known endpoints every interval seconds in a
+        daemon thread.
+        """
+        if self._thread is not None:
+            return self
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sphinx-health')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.probe_all()
+            self._stop.wait(self.interval)
+
+    def _allow(self, endpoint):
+        self._lock.acquire()
+        try:
+            return self._breaker(endpoint).allow()
+        finally:
+            self._lock.release()
+
+    def _breaker(self, endpoint):
+        # caller holds the lock
+        breaker = self._breakers.get(endpoint)
+        if breaker is None:
+            breaker = self._breakers[endpoint] = CircuitBreaker(
+                self.failure_threshold, self.reset_timeout, self.success_threshold)
+        return breaker
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pruning of high-frequency shingles before they are searched.
+
+Shingles made of assignment boilerplate or common phrases match almost
+every submission: searching them costs searchd time and floods the
+candidate lists with noise. ShinglePlanner looks up the document
+frequency of every word with BuildKeywords(hits=1), a few hundred words
+per request, caches the statistics per server and index, and estimates a shingle's
+frequency as that of its rarest word (an upper bound of the phrase
+frequency). Shingles above max_docs are dropped, or kept with a lower
+weight:
+
+    planner = ShinglePlanner(cl, 'submissions', max_docs=500)
+    plan = planner.plan(shingles)
+    for shingle, matches in FingerprintBatcher(cl, 'submissions').lookup(plan.shingles()):
+        ...
+    print planner.stats()        # queries saved so far, cache hits...
+"""
+
+import re
+import threading
+
+from lib.sphinxcache import LRUCache
+
+
+_WORD = re.compile(r'\w+', re.UNICODE)
+
+
+def _words(shingle):
+    if isinstance(shingle, str):
+        shingle = shingle.decode('utf-8')
+    return [w.encode('utf-8') for w in _WORD.findall(shingle.lower())]
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache():
+    """
+    Process-wide keyword statistics cache used by ShinglePlanner by default.
+    """
+    global _default_cache
+    _default_cache_lock.acquire()
+    try:
+        if _default_cache is None:
+            _default_cache = LRUCache(max_entries=200000, ttl=3600)
+        return _default_cache
+    finally:
+        _default_cache_lock.release()
+
+
+class QueryPlan(object):
+    """
+    Outcome of ShinglePlanner.plan(): kept is a list of (shingle, weight,
+    docs) in input order, dropped a list of (shingle, docs).
+    """
+
+    def __init__(self):
+        self.kept = []
+        self.dropped = []
+
+    def shingles(self):
+        return [shingle for shingle, weight, docs in self.kept]
+
+    def weights(self):
+        return dict((shingle, weight) for shingle, weight, docs in self.kept)
+
+
+class ShinglePlanner(object):
+    """
+    Decides which shingles are worth searching in index.
+
+    A shingle whose rarest word is in more than max_docs documents is
+    dropped; with downweight=True it is kept with weight max_docs/docs
+    instead (1.0 for the others). Word statistics are fetched through
+    client.BuildKeywords() with at most batch_words words per request and
+    cached in cache (an LRUCache, process-wide by default) for an hour.
+    """
+
+    def __init__(self, client, index, max_docs, downweight=False,
+                 batch_words=200, cache=None):
+        assert max_docs > 0 and batch_words > 0
+        if cache is None:
+            cache = get_default_cache()
+        self.client = client
+        self.index = index
+        self.max_docs = max_docs
+        self.downweight = downweight
+        self.batch_words = batch_words
+        self.cache = cache
+
+        self.planned = 0            # shingles seen by plan()
+        self.saved = 0              # queries dropped
+        self.downweighted = 0
+        self.keyword_requests = 0   # BuildKeywords calls
+        self.errors = []            # BuildKeywords errors
+
+    def plan(self, shingles):
+        shingles = list(shingles)
+        words = [_words(shingle) for shingle in shingles]
+        stats = self.word_docs(set(w for ws in words for w in ws))
+
+        plan = QueryPlan()
+        for shingle, ws in zip(shingles, words):
+            self.planned += 1
+            known = [stats[w] for w in ws if stats.get(w) is not None]
+            docs = known and min(known) or 0
+            if docs <= self.max_docs:
+                plan.kept.append((shingle, 1.0, docs))
+            elif self.downweight:
+                self.downweighted += 1
+                plan.kept.append((shingle, float(self.max_docs) / docs, docs))
+            else:
+                self.saved += 1
+                plan.dropped.append((shingle, docs))
+        return plan
+
+    def word_docs(self, words):
+        """
+        {word: number of documents containing it} for the given utf-8
+        words; None for words searchd could not report on.
+        """
+        stats = {}
+        missing = []
+        context = self._context()
+        for word in words:
+            docs = self.cache.get((context, word))
+            if docs is None:
+                missing.append(word)
+            else:
+                stats[word] = docs
+        for i in range(0, len(missing), self.batch_words):
+            batch = missing[i:i + self.batch_words]
+            stats.update(self._fetch(batch))
+        return stats
+
+    def stats(self):
+        return {'planned': self.planned,
+                'saved': self.saved,
+                'downweighted': self.downweighted,
+                'keyword_requests': self.keyword_requests,
+                'errors': len(self.errors),
+                'cache': self.cache.stats()}
+
+    def _context(self):
+        # other servers may hold other documents under the same index name
+        client = self.client
+        return (client._path or (client._host, client._port), self.index)
+
+    def _fetch(self, batch):
+        context = self._context()
+        self.keyword_requests += 1
+        keywords = self.client.BuildKeywords(' '.join(batch), self.index, 1)
+        if keywords is None:
+            self.errors.append(self.client.GetLastError())
+            return dict.fromkeys(batch)
+        if len(keywords) == len(batch):
+            # one keyword per word, in order
+            pairs = zip(batch, keywords)
+        else:
+            # the index tokenizes differently (blended chars, stopwords...)
+            by_token = dict((kw['tokenized'], kw) for kw in keywords)
+            pairs = [(word, by_token.get(word)) for word in batch]
+        stats = {}
+        for word, kw in pairs:
+            if kw is None:
+                stats[word] = None
+                continue
+            stats[word] = kw['docs']
+            self.cache.set((context, word), kw['docs'])
+        return stats
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+"""
+Thread-safe pool of persistent searchd connections.
+
+Every SphinxClient call normally opens a fresh socket and repeats the
+version handshake. PooledSphinxClient leases connections that were switched
+to persistent mode (SEARCHD_COMMAND_PERSIST) from a SphinxConnectionPool
+instead, and hands them back once the response has been read.
+
+Pools are shared per searchd endpoint, clients are not: create a client per
+request (or per thread) as usual, they all lease from the same pool.
+
+    cl = PooledSphinxClient()
+    cl.SetServer('localhost', 9312)
+    res = cl.Query('some text', 'submissions')
+"""
+
+import select
+import socket
+import threading
+import time
+from struct import pack
+
+from lib.sphinxapi import SphinxClient, SEARCHD_COMMAND_PERSIST
+
+
+class PoolError(Exception):
+    """Connection could not be leased from the pool"""
+    pass
+
+
+class SphinxConnectionPool(object):
+    """
+    Bounded set of persistent connections to one searchd endpoint.
+
+    At most max_connections sockets are open at once (idle and leased
+    together); acquire() blocks up to timeout seconds for a free slot.
+    Idle sockets are checked on borrow and dropped if the server closed
+    them or they sat unused longer than max_idle seconds (searchd drops
+    persistent clients after its own client_timeout).
+    """
+
+    def __init__(self, host='localhost', port=9312, max_connections=8,
+                 timeout=5.0, max_idle=240.0):
+        assert max_connections > 0
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_idle = max_idle
+
+        self._idle = []     # (sock, released_at), most recently used last
+        self._size = 0      # open connections, idle and leased
+        self._cond = threading.Condition(threading.Lock())
+
+    def __repr__(self):
+        return '<SphinxConnectionPool %s:%s %d/%d>' % (
+            self.host, self.port, self._size, self.max_connections)
+
+    def acquire(self, timeout=None):
+        """
+        Lease a persistent connection, opening a new one if the cap allows.
+        Raises PoolError when no connection frees up in time and
+        socket.error/PoolError when a new connection can not be set up.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+
+        self._cond.acquire()
+        try:
+            while True:
+                while self._idle:
+                    sock, since = self._idle.pop()
+                    if self._is_alive(sock, since):
+                        return sock
+                    self._drop(sock)
+                if self._size < self.max_connections:
+                    # reserve a slot, connect outside of the lock
+                    self._size += 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolError('no free connection to %s:%s within %.1fs'
+                                    % (self.host, self.port, timeout))
+                self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+
+        try:
+            return self._open()
+        except:
+            self._cond.acquire()
+            try:
+                self._size -= 1
+                self._cond.notify()
+            finally:
+                self._cond.release()
+            raise
+
+    def release(self, sock, reusable=True):
+        """
+        Return a leased connection. Connections that were left in an unknown
+        state (failed or partial reads) must be released with reusable=False.
+        """
+        self._cond.acquire()
+        try:
+            if reusable:
+                self._idle.append((sock, time.time()))
+            else:
+                self._drop(sock)
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """
+        Close all idle connections. Leased ones are closed on release.
+        """
+        self._cond.acquire()
+        try:
+            while self._idle:
+                self._drop(self._idle.pop()[0])
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def stats(self):
+        self._cond.acquire()
+        try:
+            return {'open': self._size,
+                    'idle': len(self._idle),
+                    'leased': self._size - len(self._idle),
+                    'max': self.max_connections}
+        finally:
+            self._cond.release()
+
+    def _open(self):
+        client = SphinxClient()
+        client.SetServer(self.host, self.port)
+        sock = client._Connect()
+        if not sock:
+            raise PoolError(client.GetLastError())
+        # command, command version = 0, body length = 4, body = 1
+        sock.sendall(pack('>hhII', SEARCHD_COMMAND_PERSIST, 0, 4, 1))
+        return sock
+
+    def _is_alive(self, sock, since):
+        if time.time() - since > self.max_idle:
+            return False
+        # an idle persistent socket must have nothing to read;
+        # readable means EOF (server hung up) or stray data
+        try:
+            sr, _, sx = select.select([sock], [], [sock], 0)
+        except (select.error, socket.error):
+            return False
+        return not sr and not sx
+
+    def _drop(self, sock):
+        # caller holds the lock
+        self._size -= 1
+        try:
+            sock.close()
+        except socket.error:
+            pass
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host='localhost', port=9312, **kwargs):
+    """
+    Get the process-wide pool for given searchd endpoint, creating it with
+    kwargs (see SphinxConnectionPool) on first use.
+    """
+    if host.startswith('unix://'):
+        host = host[7:]
+    if host.startswith('/'):
+        port = None
+    key = (host, port)
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = SphinxConnectionPool(host, port, **kwargs)
+        return pool
+    finally:
+        _pools_lock.release()
+
+
+class PooledSphinxClient(SphinxClient):
+    """
+    SphinxClient that leases persistent connections from a shared pool.
+    Open() and Close() are not needed (pooled connections are always
+    persistent) and only set an error.
+    """
+
+    def __init__(self, pool=None):
+        SphinxClient.__init__(self)
+        self._pool = pool
+        self._lease = None          # (pool, sock) while a call is running
+        self._lease_ok = False      # whole response was read from the lease
+
+    def __del__(self):
+        self._Release()
+
+    def SetServer(self, host, port=None):
+        SphinxClient.SetServer(self, host, port)
+        self._pool = None
+
+    def SetPool(self, pool):
+        """
+        Use given pool instead of the shared one for the configured server.
+        """
+        assert isinstance(pool, SphinxConnectionPool)
+        self._pool = pool
+
+    def GetPool(self):
+        if self._pool is None:
+            if self._path:
+                self._pool = get_pool(self._path)
+            else:
+                self._pool = get_pool(self._host, self._port)
+        return self._pool
+
+    def _Connect(self):
+        self._Release()
+        pool = self.GetPool()
+        endpoint = pool.port is None and pool.host or (pool.host, pool.port)
+        if self._health is not None and not self._health.allow(endpoint):
+            self._error = 'connection to %s:%s skipped (circuit open)' % (pool.host, pool.port)
+            return None
+        timeout = None
+        if self._deadline is not None:
+            timeout = max(0, min(pool.timeout, self._deadline - time.time()))
+        try:
+            sock = pool.acquire(timeout)
+        except (PoolError, socket.error), e:
+            self._error = 'connection to %s:%s failed (%s)' % (pool.host, pool.port, e)
+            if self._health is not None:
+                self._health.record(endpoint, False, self._error)
+            return None
+        if self._health is not None:
+            self._health.record(endpoint, True)
+        self._lease = (pool, sock)
+        self._lease_ok = False
+        # keeps _RecvResponse from closing the leased socket
+        self._socket = sock
+        return sock
+
+    def _RecvResponse(self, sock):
+        self._lease_ok = False
+        response = SphinxClient._RecvResponse(self, sock)
+        self._lease_ok = response is not None and len(response[3]) == response[2]
+        return response
+
+    def _Release(self):
+        lease, self._lease = self._lease, None
+        if lease is None:
+            return
+        self._socket = None
+        pool, sock = lease
+        pool.release(sock, self._lease_ok)
+
+    def RunQueries(self):
+        try:
+            return SphinxClient.RunQueries(self)
+        finally:
+            self._Release()
+
+    def BuildExcerpts(self, docs, index, words, opts=None):
+        try:
+            return SphinxClient.BuildExcerpts(self, docs, index, words, opts)
+        finally:
+            self._Release()
+
+    def UpdateAttributes(self, index, attrs, values):
+        try:
+            return SphinxClient.UpdateAttributes(self, index, attrs, values)
+        finally:
+            self._Release()
+
+    def BuildKeywords(self, query, index, hits):
+        try:
+            return SphinxClient.BuildKeywords(self, query, index, hits)
+        finally:
+            self._Release()
+
+    def Open(self):
+        self._error = 'pooled connections are always persistent'
+
+    def Close(self):
+        self._error = 'pooled connections are always persistent'
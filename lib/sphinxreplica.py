@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Failover and hedged requests over searchd replicas.
+
+ReplicatedSphinxClient serves every read (RunQueries/Query, BuildExcerpts,
+BuildKeywords) from one of several replicas of the same indexes:
+
+  * a replica that can't be reached, drops the connection or answers
+    SEARCHD_RETRY is retried on the next replica after a backoff,
+    up to SetFailover(retries) times;
+  * with SetHedging(delay), a request still unanswered after delay
+    seconds is duplicated to the next replica and whichever answers
+    first wins, so one stalled replica costs delay, not a timeout;
+  * SetTimeout() bounds the whole call, retries and backoff included;
+  * with SetHealthMonitor(monitor), replicas whose circuit is open are
+    skipped, and every outcome is fed back to the monitor.
+
+    cl = ReplicatedSphinxClient()
+    cl.SetReplicas([('search1', 9312), ('search2', 9312)])
+    cl.SetTimeout(3.0)
+    cl.SetHedging(0.2)
+    res = cl.Query('some text', 'submissions')
+
+searchd errors (unknown index, bad query) are answers, not failures, and
+are returned as is. UpdateAttributes() goes to every replica.
+"""
+
+import random
+import time
+
+from lib.sphinxapi import SphinxClient, SEARCHD_RETRY, \
+    VER_COMMAND_SEARCH, VER_COMMAND_EXCERPT, VER_COMMAND_KEYWORDS, VER_COMMAND_UPDATE
+from lib.sphinxasync import SphinxReactor, SphinxRequest, gather, parse_endpoint, _describe
+
+
+def _failure(request):
+    if request.status is None:
+        # connection errors name the server already
+        return request.error
+    return '%s: %s' % (_describe(request.endpoint), request.error or 'retry requested')
+
+
+class ReplicatedSphinxClient(SphinxClient):
+    """
+    SphinxClient over a list of replicas given to SetReplicas(). Reads
+    start on the replicas in turn; retries, hedges, hedge_wins count
+    what the failover did so far.
+    """
+
+    def __init__(self, reactor=None):
+        SphinxClient.__init__(self)
+        if reactor is None:
+            reactor = SphinxReactor(max_connections=2)
+        self._reactor = reactor
+        self._replicas = []
+        self._next = 0
+        self._retries = 2
+        self._backoff = 0.05
+        self._max_backoff = 1.0
+        self._hedge_delay = None
+
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def GetReactor(self):
+        return self._reactor
+
+    def SetReplicas(self, servers):
+        """
+        Set searchd replicas: a list of (host, port) pairs, 'host:port'
+        strings or unix socket paths.
+        """
+        assert len(servers) > 0
+        self._replicas = [parse_endpoint(server) for server in servers]
+        self._next = 0
+
+    def GetReplicas(self):
+        return list(self._replicas)
+
+    def SetFailover(self, retries, backoff=0.05, max_backoff=1.0):
+        """
+        Retry a failed read up to retries times on the next replicas,
+        sleeping backoff seconds (doubled every time, up to max_backoff,
+        with jitter) in between.
+        """
+        assert retries >= 0 and backoff >= 0 and max_backoff >= backoff
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+
+    def SetHedging(self, delay):
+        """
+        Duplicate reads unanswered after delay seconds to another replica.
+        None turns hedging off.
+        """
+        assert delay is None or delay >= 0
+        self._hedge_delay = delay
+
+    def SetHealthMonitor(self, monitor):
+        """
+        Skip replicas whose circuit in monitor (a HealthMonitor) is open,
+        and report connection failures and answers to it. None turns it off.
+        """
+        self._health = monitor
+
+    def RunQueries(self):
+        if len(self._reqs)==0:
+            self._error = 'no queries defined, issue AddQuery() first'
+            return None
+        nreqs = len(self._reqs)
+        results = self._Read(self._SearchRequest(self._reqs), VER_COMMAND_SEARCH,
+                             lambda parser, response: parser._ParseSearchResponse(response, nreqs),
+                             None)
+        if results is not None:
+            self._reqs = []
+        return results
+
+    def BuildExcerpts(self, docs, index, words, opts=None):
+        ndocs = len(docs)
+        return self._Read(self._ExcerptsRequest(docs, index, words, opts), VER_COMMAND_EXCERPT,
+                          lambda parser, response: parser._ParseExcerptsResponse(response, ndocs),
+                          [])
+
+    def BuildKeywords(self, query, index, hits):
+        return self._Read(self._KeywordsRequest(query, index, hits), VER_COMMAND_KEYWORDS,
+                          lambda parser, response: parser._ParseKeywordsResponse(response, hits),
+                          None)
+
+    def UpdateAttributes(self, index, attrs, values):
+        """
+        Apply the update on every replica. Returns the number of documents
+        updated on the first replica, or -1 if any replica failed.
+        """
+        assert self._replicas, 'no replicas defined, issue SetReplicas() first'
+        packet = self._UpdateRequest(index, attrs, values)
+        parse = lambda parser, response: parser._ParseUpdateResponse(response)
+        requests = [self._reactor.submit(SphinxRequest(endpoint, packet, VER_COMMAND_UPDATE,
+                                                       parse, failed=-1))
+                    for endpoint in self._replicas]
+        results = gather(requests, self._timeout or None)
+        errors = [_failure(r) for r in requests if r.value == -1]
+        self._error = '; '.join(errors)
+        self._warning = ''
+        if errors:
+            return -1
+        return results[0]
+
+    def _Read(self, packet, client_ver, parse, failed):
+        """
+        INTERNAL METHOD, DO NOT CALL. Runs a read command with failover
+        and hedging, returns its parsed result or failed.
+        """
+        assert self._replicas, 'no replicas defined, issue SetReplicas() first'
+        start = self._next
+        self._next = (self._next + 1) % len(self._replicas)
+        replicas = self._replicas[start:] + self._replicas[:start]
+        if self._health is not None:
+            replicas = self._health.available(replicas)
+            if not replicas:
+                self._error = 'no replica available (all circuits open)'
+                return failed
+        deadline = self._timeout and time.time() + self._timeout or None
+        backoff = self._backoff
+        errors = []
+        used = 0        # replicas tried so far, hedges included
+
+        for attempt in range(self._retries + 1):
+            if attempt:
+                self.retries += 1
+                pause = backoff * (0.5 + random.random() / 2)
+                if deadline is not None:
+                    pause = min(pause, deadline - time.time())
+                if pause > 0:
+                    time.sleep(pause)
+                backoff = min(backoff * 2, self._max_backoff)
+
+            endpoint, used = self._Choose(replicas, used)
+            if endpoint is None:
+                errors.append('no replica available (all circuits open)')
+                break
+            primary = self._Issue(endpoint, packet, client_ver, parse, failed)
+            inflight = [primary]
+            hedge_at = None
+            if self._hedge_delay is not None and len(replicas) > 1:
+                hedge_at = time.time() + self._hedge_delay
+
+            while inflight:
+                for request in [r for r in inflight if r.done]:
+                    inflight.remove(request)
+                    self._Report(request)
+                    if request.status is not None and request.status != SEARCHD_RETRY:
+                        # an answer, even an error one, wins
+                        for other in inflight:
+                            other.cancel('answered by another replica')
+                        if request is not primary:
+                            self.hedge_wins += 1
+                        self._error = request.error
+                        self._warning = request.warning
+                        return request.value
+                    errors.append(_failure(request))
+                if not inflight:
+                    break
+
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    for request in inflight:
+                        request.cancel('timed out')
+                        self._Report(request)
+                    errors.append('timed out after %.1fs' % self._timeout)
+                    self._error = '; '.join(errors)
+                    return failed
+                if hedge_at is not None and now >= hedge_at:
+                    hedge_at = None
+                    endpoint, used = self._Choose(replicas, used)
+                    if endpoint is not None:
+                        self.hedges += 1
+                        inflight.append(self._Issue(endpoint, packet, client_ver,
+                                                    parse, failed))
+                        continue
+
+                wait = None
+                for limit in (deadline, hedge_at):
+                    if limit is not None and (wait is None or limit - now < wait):
+                        wait = limit - now
+                self._reactor.poll(wait)
+
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        self._error = '; '.join(errors)
+        return failed
+
+    def _Choose(self, replicas, used):
+        """
+        INTERNAL METHOD, DO NOT CALL. The next replica from position used
+        whose circuit lets the call through, and the new position; None
+        if no circuit does. Only the chosen circuit goes half-open.
+        """
+        for i in range(len(replicas)):
+            endpoint = replicas[(used + i) % len(replicas)]
+            if self._health is None or self._health.allow(endpoint):
+                return endpoint, used + i + 1
+        return None, used + len(replicas)
+
+    def _Report(self, request):
+        # a replica that answered is up, even with an error or a retry
+        if self._health is not None:
+            self._health.record(request.endpoint, request.status is not None,
+                                _failure(request))
+
+    def _Issue(self, endpoint, packet, client_ver, parse, failed):
+        return self._reactor.submit(SphinxRequest(endpoint, packet, client_ver,
+                                                  parse, failed=failed))
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+"""
+Scatter-gather searches over a corpus split between several searchd
+instances (one per academic year).
+
+ShardedSphinxClient sends every multi-query request to all shards at once
+through a SphinxReactor and merges the per-shard result sets, so callers
+see one result set per query as if there was a single index:
+
+    cl = ShardedSphinxClient()
+    cl.SetServers([('search1', 9312), ('search2', 9312), '/var/run/searchd.sock'])
+    cl.SetLimits(20, 20)
+    res = cl.Query('some text', 'submissions')
+    for shard in res['shards']:
+        print shard['server'], shard['time'], shard['error']
+
+A shard that fails or answers with an error only loses its own matches:
+the query status becomes SEARCHD_WARNING with the shard errors in
+'warning', and res['shards'] tells which shard failed and why. Only when
+every shard fails does the query fail.
+
+Document IDs must be unique across shards.
+"""
+
+from lib.sphinxapi import SphinxClient, SEARCHD_OK, SEARCHD_ERROR, \
+    SEARCHD_WARNING, SPH_SORT_ATTR_DESC, SPH_SORT_ATTR_ASC, VER_COMMAND_SEARCH
+from lib.sphinxasync import SphinxReactor, SphinxRequest, parse_endpoint, _describe
+
+
+def _merge_key(sort, sortby):
+    """
+    Sort key reproducing the per-shard order for the merge. Attribute
+    sorts are honoured; every other mode is merged by weight.
+    """
+    if sort == SPH_SORT_ATTR_DESC:
+        return lambda m: (-m['attrs'].get(sortby, 0), -m['weight'], m['id'])
+    if sort == SPH_SORT_ATTR_ASC:
+        return lambda m: (m['attrs'].get(sortby, 0), -m['weight'], m['id'])
+    return lambda m: (-m['weight'], m['id'])
+
+
+class ShardedSphinxClient(SphinxClient):
+    """
+    SphinxClient that runs every query against all servers given to
+    SetServers() in parallel and merges the results.
+
+    Each shard is asked for the first offset+limit matches, the merged
+    list is sorted and cut to the requested offset/limit window;
+    total and total_found are summed over the shards. Every result set
+    gets a 'shards' list of per-shard reports: server, time (seconds,
+    round trip of the whole request), error, warning, total_found.
+    """
+
+    def __init__(self, reactor=None):
+        SphinxClient.__init__(self)
+        if reactor is None:
+            reactor = SphinxReactor()
+        self._reactor = reactor
+        self._shards = []           # endpoints, (host, port) or socket path
+        self._shard_timeout = None  # seconds to wait for the slowest shard
+        self._windows = []          # (offset, limit, sort, sortby) per AddQuery
+
+    def GetReactor(self):
+        return self._reactor
+
+    def SetServers(self, servers):
+        """
+        Set searchd shards: a list of (host, port) pairs, 'host:port'
+        strings or unix socket paths.
+        """
+        assert len(servers) > 0
+        self._shards = [parse_endpoint(server) for server in servers]
+
+    def GetServers(self):
+        return list(self._shards)
+
+    def SetShardTimeout(self, timeout):
+        """
+        Give up on shards that did not answer within timeout seconds;
+        they are reported as failed. None waits indefinitely.
+        """
+        assert timeout is None or timeout > 0
+        self._shard_timeout = timeout
+
+    def Query(self, query, index='*', comment=''):
+        try:
+            return SphinxClient.Query(self, query, index, comment)
+        finally:
+            # Query() drops a failed query from _reqs, drop its window too
+            self._windows = []
+
+    def AddQuery(self, query, index='*', comment=''):
+        self._Windowed(SphinxClient.AddQuery, query, index, comment)
+        self._windows.append((self._offset, self._limit, self._sort, self._sortby))
+
+    def FreezeQuery(self):
+        template = self._Windowed(SphinxClient.FreezeQuery)
+        template.window = (self._offset, self._limit, self._sort, self._sortby)
+        return template
+
+    def AddFrozenQuery(self, template, query, index='*', comment=''):
+        assert hasattr(template, 'window'), 'template not frozen by a ShardedSphinxClient'
+        SphinxClient.AddFrozenQuery(self, template, query, index, comment)
+        self._windows.append(template.window)
+
+    def _Windowed(self, method, *args):
+        # shards can't skip the offset themselves: which matches fall
+        # before it is only known after the merge
+        offset, limit, maxmatches = self._offset, self._limit, self._maxmatches
+        window = offset + limit
+        self._offset = 0
+        self._limit = window
+        self._maxmatches = max(maxmatches, window)
+        try:
+            return method(self, *args)
+        finally:
+            self._offset, self._limit, self._maxmatches = offset, limit, maxmatches
+
+    def RunQueries(self):
+        """
+        Run queries batch on all shards.
+        Returns None if no shard could run it; or an array of merged
+        result set hashes.
+        """
+        if len(self._reqs)==0:
+            self._error = 'no queries defined, issue AddQuery() first'
+            return None
+        if not self._shards:
+            self._error = 'no shards defined, issue SetServers() first'
+            return None
+
+        nreqs = len(self._reqs)
+        packet = self._SearchRequest(self._reqs)
+        parse = lambda parser, response: parser._ParseSearchResponse(response, nreqs)
+        requests = []
+        for endpoint in self._shards:
+            request = SphinxRequest(endpoint, packet, VER_COMMAND_SEARCH, parse)
+            requests.append(self._reactor.submit(request))
+
+        self._reactor.wait(requests, self._shard_timeout)
+        for request in requests:
+            if not request.done:
+                request.cancel('shard timed out')
+
+        if all(request.value is None for request in requests):
+            self._error = '; '.join('%s: %s' % (_describe(r.endpoint), r.error)
+                                    for r in requests)
+            return None
+
+        results = [self._Merge(requests, i) for i in range(nreqs)]
+        self._error = ''
+        self._warning = ''
+        self._reqs = []
+        self._windows = []
+        return results
+
+    def _Merge(self, requests, n):
+        """
+        INTERNAL METHOD, DO NOT CALL. Merges result set n of every shard.
+        """
+        offset, limit, sort, sortby = self._windows[n]
+        shards = []
+        parts = []
+        for request in requests:
+            report = {'server': _describe(request.endpoint),
+                      'time': request.elapsed,
+                      'error': request.error,
+                      'warning': request.warning,
+                      'total_found': 0}
+            shards.append(report)
+            if request.value is None:
+                continue
+            part = request.value[n]
+            report['error'] = part['error']
+            report['warning'] = part['warning']
+            if part['status'] == SEARCHD_ERROR:
+                continue
+            report['total_found'] = part['total_found']
+            parts.append(part)
+
+        errors = ['%s: %s' % (r['server'], r['error']) for r in shards if r['error']]
+        warnings = ['%s: %s' % (r['server'], r['warning']) for r in shards if r['warning']]
+        if not parts:
+            return {'status': SEARCHD_ERROR, 'error': '; '.join(errors),
+                    'warning': '', 'shards': shards}
+
+        matches = []
+        for part in parts:
+            matches.extend(part['matches'])
+        matches.sort(key=_merge_key(sort, sortby))
+
+        words = []
+        for word in parts[0]['words']:
+            words.append({'word': word['word'], 'docs': 0, 'hits': 0})
+        for part in parts:
+            for total, word in zip(words, part['words']):
+                total['docs'] += word['docs']
+                total['hits'] += word['hits']
+
+        result = {'status': errors and SEARCHD_WARNING or SEARCHD_OK,
+                  'error': '',
+                  'warning': '; '.join(errors + warnings),
+                  'fields': parts[0]['fields'],
+                  'attrs': parts[0]['attrs'],
+                  'matches': matches[offset:offset+limit],
+                  'total': sum(part['total'] for part in parts),
+                  'total_found': sum(part['total_found'] for part in parts),
+                  'time': '%.3f' % max(float(part['time']) for part in parts),
+                  'words': words,
+                  'shards': shards}
+        return result
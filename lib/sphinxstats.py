@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-call instrumentation of SphinxClient.
+
+A StatsCollector set with SphinxClient.SetStatsCollector() gets a
+SphinxCall record for every search/excerpt/keywords/update command the
+client runs, with the time spent in each phase:
+
+    connect   connecting and the version handshake (or leasing a pooled
+              connection)
+    send      writing the request
+    wait      waiting for searchd to start answering
+    recv      reading the response body
+    decode    parsing the response
+
+plus bytes sent and received and the number of results (matches,
+excerpts, keywords or updated documents). Calls are aggregated per command
+into log2 histograms; dump() returns them as a dict, and hooks receive
+every finished call for feeding external metrics:
+
+    stats = StatsCollector()
+    stats.add_hook(lambda call: statsd.timing('sphinx.' + call.command, call.total))
+    cl = SphinxClient()
+    cl.SetStatsCollector(stats)
+    ...
+    pprint(stats.dump())
+
+A collector may be shared by any number of clients and threads.
+"""
+
+import threading
+import time
+
+
+PHASES = ('connect', 'send', 'wait', 'recv', 'decode')
+
+
+class Histogram(object):
+    """
+    Counts of values in power-of-two buckets: bucket n holds values in
+    [2**(n-1), 2**n), bucket 0 holds values below 1.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        bucket = int(value) >= 1 and int(value).bit_length() or 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket holding the p-th (0..1) value.
+        """
+        if not self.count:
+            return None
+        rank = p * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(1 << bucket, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.count and float(self.sum) / self.count or None,
+                'p50': self.percentile(0.5),
+                'p99': self.percentile(0.99),
+                # keyed by bucket upper bound
+                'buckets': dict(((1 << b), n) for b, n in self.buckets.iteritems())}
+
+
+class SphinxCall(object):
+    """
+    One client command in progress. phases maps phase names to seconds;
+    total is set once the call has finished.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.start = self._last = time.time()
+        self.phases = {}
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.results = None
+        self.error = ''
+        self.total = None
+
+    def mark(self, phase):
+        """
+        Charge the time since the previous mark (or the start) to phase.
+        """
+        now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def finish(self):
+        self.total = time.time() - self.start
+
+
+class StatsCollector(object):
+    """
+    Aggregates finished SphinxCalls per command. Times go into the
+    histograms in microseconds, sizes in bytes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.reset()
+
+    def begin(self, command):
+        return SphinxCall(command)
+
+    def end(self, call):
+        call.finish()
+        self._lock.acquire()
+        try:
+            stats = self._commands.get(call.command)
+            if stats is None:
+                stats = self._commands[call.command] = {'calls': 0, 'errors': 0, 'histograms': {}}
+            stats['calls'] += 1
+            if call.error:
+                stats['errors'] += 1
+            histograms = stats['histograms']
+            values = [('total', call.total * 1e6),
+                      ('bytes_out', call.bytes_out),
+                      ('bytes_in', call.bytes_in)]
+            for phase, seconds in call.phases.iteritems():
+                values.append((phase, seconds * 1e6))
+            if call.results is not None:
+                values.append(('results', call.results))
+            for name, value in values:
+                histogram = histograms.get(name)
+                if histogram is None:
+                    histogram = histograms[name] = Histogram()
+                histogram.add(value)
+        finally:
+            self._lock.release()
+        for hook in self._hooks:
+            hook(call)
+
+    def add_hook(self, func):
+        """
+        Call func(call) with every finished SphinxCall.
+        """
+        self._hooks.append(func)
+
+    def remove_hook(self, func):
+        self._hooks.remove(func)
+
+    def reset(self):
+        self._lock.acquire()
+        try:
+            self._commands = {}
+        finally:
+            self._lock.release()
+
+    def dump(self):
+        """
+        {command: {'calls': n, 'errors': n, 'histograms': {name: {...}}}}
+        with total, the phases, bytes_out, bytes_in and results histograms.
+        """
+        self._lock.acquire()
+        try:
+            return dict((command, {'calls': stats['calls'],
+                                   'errors': stats['errors'],
+                                   'histograms': dict((name, h.to_dict())
+                                                      for name, h in stats['histograms'].iteritems())})
+                        for command, stats in self._commands.iteritems())
+        finally:
+            self._lock.release()
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk attribute updates in bounded, pipelined requests.
+
+UpdateAttributes() serializes all documents into a single UPDATE command,
+which breaks searchd's max_packet_size when a re-grade touches thousands
+of submissions. BulkAttributeUpdater consumes (docid, values) pairs from
+any iterable, packs them into UPDATE requests of at most max_request_bytes
+and sends them over one persistent connection, a couple of requests
+ahead of the responses:
+
+    updater = BulkAttributeUpdater(cl, 'submissions', ['hidden'])
+    report = updater.update((sub.id, [1]) for sub in hidden)
+    if report.errors:
+        ...
+    print report.updated
+
+Only plain integer attributes are supported, like UpdateAttributes().
+"""
+
+from collections import deque
+
+from lib.sphinxapi import VER_COMMAND_UPDATE
+from lib.sphinxbatch import SphinxPipeline, BatchError
+
+
+class UpdateReport(object):
+    """
+    Outcome of BulkAttributeUpdater.update(): updated rows over all
+    chunks, chunks sent, errors as (first docid, last docid, documents,
+    message) per failed chunk. complete is False when the connection
+    failed and the rest of the input was not sent.
+    """
+
+    def __init__(self):
+        self.updated = 0
+        self.chunks = 0
+        self.errors = []
+        self.complete = True
+
+    def __repr__(self):
+        return '<UpdateReport updated=%d chunks=%d errors=%d%s>' % (
+            self.updated, self.chunks, len(self.errors),
+            not self.complete and ' incomplete' or '')
+
+
+class BulkAttributeUpdater(object):
+    """
+    Updates attrs of the documents in index through client's connection,
+    keeping up to depth requests in flight. When the client caches
+    results (CachedSphinxClient) the index is invalidated afterwards.
+    """
+
+    def __init__(self, client, index, attrs, max_request_bytes=65536, depth=2):
+        assert len(attrs) > 0 and depth > 0
+        self.client = client
+        self.index = index
+        self.attrs = attrs
+        self.depth = depth
+
+        # index, attribute names and document count
+        overhead = 8 + len(index) + sum(4 + len(attr) for attr in attrs) + 4
+        per_doc = 8 + 4 * len(attrs)
+        self.chunk_docs = max(1, (max_request_bytes - overhead) / per_doc)
+
+    def update(self, pairs):
+        client = self.client
+        report = UpdateReport()
+        pending = deque()
+        pipeline = SphinxPipeline(client)
+        try:
+            try:
+                for chunk in self._chunks(pairs):
+                    header, body = client._UpdateRequest(self.index, self.attrs, chunk)
+                    pending.append(chunk)
+                    pipeline.send(header, body, VER_COMMAND_UPDATE)
+                    report.chunks += 1
+                    if len(pending) >= self.depth:
+                        self._receive(pipeline, pending.popleft(), report)
+                while pending:
+                    self._receive(pipeline, pending.popleft(), report)
+            except BatchError, e:
+                # connection is gone, whatever was in flight is lost
+                report.complete = False
+                while pending:
+                    self._failed(pending.popleft(), str(e), report)
+        finally:
+            pipeline.close()
+            invalidate = getattr(client, 'InvalidateIndex', None)
+            if invalidate is not None:
+                invalidate(self.index)
+        return report
+
+    def _chunks(self, pairs):
+        chunk = {}
+        for docid, values in pairs:
+            chunk[docid] = values
+            if len(chunk) >= self.chunk_docs:
+                yield chunk
+                chunk = {}
+        if chunk:
+            yield chunk
+
+    def _receive(self, pipeline, chunk, report):
+        response = pipeline.receive()
+        if response is None:
+            self._failed(chunk, self.client.GetLastError(), report)
+        else:
+            report.updated += self.client._ParseUpdateResponse(response)
+
+    def _failed(self, chunk, message, report):
+        docids = sorted(chunk)
+        report.errors.append((docids[0], docids[-1], len(docids), message))
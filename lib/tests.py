@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the searchd client stack, mostly against the in-process
+SearchdEmulator.
+"""
+
+import imp
+import os
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from django.test import TestCase
+
+from lib.sphinxapi import SphinxClient, SEARCHD_OK, SEARCHD_COMMAND_PERSIST, \
+    SPH_ATTR_INTEGER, SPH_ATTR_MULTI, SPH_ATTR_BIGINT, SPH_ATTR_FLOAT
+from lib.sphinxasync import AsyncSphinxClient, SphinxReactor
+from lib.sphinxcache import CachedSphinxClient, LRUCache
+from lib.sphinxcoalesce import CoalescingSphinxClient
+from lib.sphinxcursor import SphinxCursor
+from lib.sphinxdelta import DeltaIndexManager
+from lib.sphinxemu import SearchdEmulator, MemoryIndex, encode_result
+from lib.sphinxexcerpts import ExcerptBuilder
+from lib.sphinxhealth import HealthMonitor, OPEN
+from lib.sphinxplanner import ShinglePlanner
+from lib.sphinxreplica import ReplicatedSphinxClient
+from lib.sphinxshard import ShardedSphinxClient
+from lib.sphinxstats import StatsCollector
+from lib.sphinxupdate import BulkAttributeUpdater
+
+MVA = SPH_ATTR_MULTI | SPH_ATTR_INTEGER
+
+# one of each attribute kind, MVAs first, in the middle, last and adjacent
+SCHEMAS = (
+    [('lab_id', SPH_ATTR_INTEGER), ('score', SPH_ATTR_FLOAT), ('size', SPH_ATTR_BIGINT)],
+    [('tags', MVA), ('lab_id', SPH_ATTR_INTEGER), ('score', SPH_ATTR_FLOAT)],
+    [('lab_id', SPH_ATTR_INTEGER), ('tags', MVA), ('size', SPH_ATTR_BIGINT)],
+    [('lab_id', SPH_ATTR_INTEGER), ('size', SPH_ATTR_BIGINT), ('tags', MVA)],
+    [('tags', MVA), ('labs', MVA), ('score', SPH_ATTR_FLOAT)],
+)
+
+
+def sample_matches(attrs, count=4):
+    """
+    (id, weight, values) rows for encode_result(), exact in every type.
+    """
+    matches = []
+    for i in range(count):
+        values = []
+        for name, type_ in attrs:
+            if type_ == MVA:
+                values.append(range(i, 2 * i))
+            elif type_ == SPH_ATTR_FLOAT:
+                values.append(i / 4.0)
+            elif type_ == SPH_ATTR_BIGINT:
+                values.append(-(1 << 40) + i)
+            else:
+                values.append(3 * i + 1)
+        matches.append((1000 + i, 1000 - i, values))
+    return matches
+
+
+def legacy_parse(response, nreqs):
+    """
+    The parser before precompiled structs, kept as the baseline of
+    helpers/bench_sphinx_decode.py.
+    """
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                        'helpers', 'bench_sphinx_decode.py')
+    return imp.load_source('bench_sphinx_decode', path).legacy_parse(response, nreqs)
+
+
+class EmulatorTestCase(TestCase):
+    """
+    Runs an emulator over a 'docs' index with an MVA in the middle of the
+    schema: lab_id, tags (MVA), size (bigint), author_id.
+    """
+    attrs = [('lab_id', SPH_ATTR_INTEGER), ('tags', MVA),
+             ('size', SPH_ATTR_BIGINT), ('author_id', SPH_ATTR_INTEGER)]
+
+    def setUp(self):
+        self.index = MemoryIndex(attrs=self.attrs)
+        self.index.add(1, u'первая работа', lab_id=3, tags=[1, 2], size=1 << 40, author_id=7)
+        self.index.add(2, u'вторая работа', lab_id=4, tags=[], size=5, author_id=8)
+        self.index.add(3, u'третья работа', lab_id=3, tags=[9], size=6, author_id=9)
+        self.server = SearchdEmulator({'docs': self.index}).start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    # not client(): TestCase sets self.client to Django's test client
+    def sphinx_client(self, cls=SphinxClient, *args):
+        cl = cls(*args)
+        cl.SetServer(*self.server.address)
+        return cl
+
+
+class ColumnarResultTest(EmulatorTestCase):
+
+    def test_mva_in_the_middle_of_the_schema(self):
+        cl = self.sphinx_client()
+        rows = cl.Query(u'работа', 'docs')
+        cl.SetColumnarResult(True)
+        columns = cl.Query(u'работа', 'docs')['columns']
+        self.assertEqual(list(columns['id']), [m['id'] for m in rows['matches']])
+        self.assertEqual(list(columns['weight']), [m['weight'] for m in rows['matches']])
+        for name in ('lab_id', 'size', 'author_id'):
+            self.assertEqual(list(columns[name]), [m['attrs'][name] for m in rows['matches']])
+        self.assertEqual([list(tags) for tags in columns['tags']],
+                         [m['attrs']['tags'] for m in rows['matches']])
+
+    def test_stats_count_columnar_matches(self):
+        calls = []
+        stats = StatsCollector()
+        stats.add_hook(calls.append)
+        cl = self.sphinx_client()
+        cl.SetStatsCollector(stats)
+        cl.SetColumnarResult(True)
+        cl.Query(u'работа', 'docs')
+        self.assertEqual([call.results for call in calls], [3])
+
+    def test_cache_keeps_modes_apart(self):
+        cache = LRUCache()
+        columnar = self.sphinx_client(CachedSphinxClient, cache)
+        columnar.SetColumnarResult(True)
+        self.assertTrue('columns' in columnar.Query(u'работа', 'docs'))
+        rows = self.sphinx_client(CachedSphinxClient, cache)
+        self.assertEqual(len(rows.Query(u'работа', 'docs')['matches']), 3)
+
+    def test_async_query_honours_columnar(self):
+        cl = self.sphinx_client(AsyncSphinxClient, SphinxReactor())
+        cl.SetColumnarResult(True)
+        request = cl.QueryAsync(u'работа', 'docs')
+        result = request.result(5)
+        self.assertEqual(len(result['columns']['id']), 3)
+
+
+class CachedSphinxClientTest(EmulatorTestCase):
+
+    def test_update_clears_a_plain_cache(self):
+        cache = LRUCache()
+        cl = self.sphinx_client(CachedSphinxClient, cache)
+        cl.Query(u'работа', 'docs')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cl.UpdateAttributes('docs', ['lab_id'], {1: [5]}), 1)
+        self.assertEqual(len(cache), 0)
+        matches = dict((m['id'], m) for m in cl.Query(u'работа', 'docs')['matches'])
+        self.assertEqual(matches[1]['attrs']['lab_id'], 5)
+
+
+class CountingCoalescingClient(CoalescingSphinxClient):
+
+    def __init__(self, *args):
+        CoalescingSphinxClient.__init__(self, *args)
+        self.built = 0
+
+    def _ExcerptsRequest(self, *args):
+        self.built += 1
+        return CoalescingSphinxClient._ExcerptsRequest(self, *args)
+
+    def _KeywordsRequest(self, *args):
+        self.built += 1
+        return CoalescingSphinxClient._KeywordsRequest(self, *args)
+
+
+class CoalescingSphinxClientTest(EmulatorTestCase):
+
+    def test_requests_are_built_once(self):
+        plain = self.sphinx_client()
+        cl = self.sphinx_client(CountingCoalescingClient)
+        docs = ['первая работа студента']
+        self.assertEqual(cl.BuildExcerpts(docs, 'docs', 'работа'),
+                         plain.BuildExcerpts(docs, 'docs', 'работа'))
+        self.assertEqual(cl.BuildKeywords('работа студента', 'docs', 1),
+                         plain.BuildKeywords('работа студента', 'docs', 1))
+        self.assertEqual(cl.built, 2)
+        self.assertEqual(cl.GetFlight().stats()['in_flight'], 0)
+
+class SphinxCursorTest(EmulatorTestCase):
+
+    def test_columnar_client_walks_in_rows(self):
+        cl = self.sphinx_client()
+        cl.SetColumnarResult(True)
+        cursor = SphinxCursor(cl, u'работа', 'docs', chunk=2)
+        self.assertEqual([match['id'] for match in cursor], [1, 2, 3])
+        self.assertEqual(cursor.queries, 2)
+        self.assertEqual(list(cl.Query(u'работа', 'docs')['columns']['id']), [1, 2, 3])
+
+class ExcerptCacheTest(EmulatorTestCase):
+
+    def test_key_is_words_and_server(self):
+        builder = ExcerptBuilder(cache=LRUCache())
+        builder.client.SetServer(*self.server.address)
+        docs = [u'первая работа студента', u'вторая работа']
+        first = builder.build(docs, 'docs', u'работа студента')
+        self.assertEqual(builder.build(docs, 'docs', u'работа студента'), first)
+        self.assertEqual(builder.requests, 1)
+        # order and repeats of words are part of the request
+        builder.build(docs, 'docs', u'студента работа')
+        builder.build(docs, 'docs', u'работа работа студента')
+        self.assertEqual(builder.requests, 3)
+        other = SearchdEmulator({'docs': self.index}).start()
+        try:
+            builder.client.SetServer(*other.address)
+            builder.build(docs, 'docs', u'работа студента')
+        finally:
+            other.stop()
+        self.assertEqual(builder.requests, 4)
+
+
+def closed_port():
+    """
+    A local TCP address nobody listens on.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    address = sock.getsockname()
+    sock.close()
+    return address
+
+
+class ShinglePlannerTest(EmulatorTestCase):
+
+    def test_word_stats_are_kept_per_server(self):
+        cache = LRUCache()
+        first = ShinglePlanner(self.sphinx_client(), 'docs', max_docs=10, cache=cache)
+        self.assertEqual(first.word_docs(['работа']), {'работа': 3})
+        index = MemoryIndex(attrs=self.attrs)
+        index.add(1, u'одна работа', lab_id=1, tags=[], size=1, author_id=1)
+        other = SearchdEmulator({'docs': index}).start()
+        try:
+            cl = SphinxClient()
+            cl.SetServer(*other.address)
+            second = ShinglePlanner(cl, 'docs', max_docs=10, cache=cache)
+            self.assertEqual(second.word_docs(['работа']), {'работа': 1})
+        finally:
+            other.stop()
+        self.assertEqual(first.word_docs(['работа']), {'работа': 3})
+        self.assertEqual(first.keyword_requests + second.keyword_requests, 2)
+
+class ShardedQueryTest(EmulatorTestCase):
+
+    def test_failed_query_leaves_no_window_behind(self):
+        cl = ShardedSphinxClient()
+        cl.SetServers([closed_port()])
+        self.assertEqual(cl.Query(u'работа', 'docs'), None)
+        cl.SetServers([self.server.address])
+        cl.SetLimits(1, 1)
+        result = cl.Query(u'работа', 'docs')
+        self.assertEqual(result['total'], 3)
+        self.assertEqual(len(result['matches']), 1)
+
+
+class HealthMonitorTest(EmulatorTestCase):
+
+    def test_only_the_chosen_replica_goes_half_open(self):
+        dead, alive = closed_port(), self.server.address
+        monitor = HealthMonitor(failure_threshold=1, reset_timeout=0.05)
+        monitor.record(dead, False, 'refused')
+        monitor.record(alive, False, 'refused')
+        time.sleep(0.1)
+        self.assertEqual(monitor.available([dead, alive]), [dead, alive])
+        self.assertEqual([monitor.state(dead), monitor.state(alive)], [OPEN, OPEN])
+
+        cl = ReplicatedSphinxClient()
+        cl.SetReplicas([alive, dead])
+        cl.SetHealthMonitor(monitor)
+        self.assertEqual(len(cl.Query(u'работа', 'docs')['matches']), 3)
+        self.assertEqual(monitor.state(dead), OPEN)
+        self.assertNotEqual(monitor.state(alive), OPEN)
+        self.assertEqual(monitor.rejected, 0)
+
+    def test_rejected_calls_are_counted(self):
+        monitor = HealthMonitor(failure_threshold=1, reset_timeout=10)
+        endpoint = closed_port()
+        monitor.record(endpoint, False, 'refused')
+        self.assertFalse(monitor.allow(endpoint))
+        self.assertEqual(monitor.available([endpoint]), [])
+        self.assertEqual(monitor.rejected, 1)
+        self.assertEqual(monitor.state(endpoint), OPEN)
+
+
+class ScriptedServer(object):
+    """
+    A searchd serving one connection: it completes the handshake, then
+    hands every command to respond(sock, cmd, ver, body) until that
+    returns False.
+    """
+
+    def __init__(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.address = self.listener.getsockname()
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        sock, address = self.listener.accept()
+        try:
+            sock.sendall(struct.pack('>L', 1))
+            self.recv(sock, 4)
+            while True:
+                header = self.recv(sock, 8)
+                if len(header) < 8:
+                    break
+                cmd, ver, length = struct.unpack('>2HL', header)
+                if not self.respond(sock, cmd, ver, self.recv(sock, length)):
+                    break
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+
+    def recv(self, sock, size):
+        data = ''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def respond(self, sock, cmd, ver, body):
+        return False
+
+    def stop(self):
+        self.thread.join(5)
+        self.listener.close()
+
+
+class ResettingServer(ScriptedServer):
+    """
+    Resets the connection after the persistent connection command.
+    """
+
+    def respond(self, sock, cmd, ver, body):
+        if cmd == SEARCHD_COMMAND_PERSIST:
+            # zero linger: close() sends RST instead of FIN
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            return False
+        return True
+
+
+class TricklingServer(ScriptedServer):
+    """
+    Answers a command with reply, piece bytes per segment; with stall, it
+    sends the first half only and goes silent for stall seconds.
+    """
+
+    def __init__(self, reply, piece=3, stall=None):
+        self.reply = reply
+        self.piece = piece
+        self.stall = stall
+        ScriptedServer.__init__(self)
+
+    def respond(self, sock, cmd, ver, body):
+        if cmd == SEARCHD_COMMAND_PERSIST:
+            return True
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        data = struct.pack('>2HL', SEARCHD_OK, ver, len(self.reply)) + self.reply
+        if self.stall is not None:
+            sock.sendall(data[:len(data) / 2])
+            time.sleep(self.stall)
+            return False
+        for i in xrange(0, len(data), self.piece):
+            sock.sendall(data[i:i + self.piece])
+            time.sleep(0.0005)
+        return False
+
+
+class ProtocolTest(EmulatorTestCase):
+
+    def test_row_decoding_matches_legacy(self):
+        cl = SphinxClient()
+        for attrs in SCHEMAS:
+            for id64 in (0, 1):
+                matches = sample_matches(attrs)
+                response = encode_result(['body'], attrs, matches, [('word', 4, 9)],
+                                         id64=id64) * 2
+                results = cl._ParseSearchResponse(response, 2)
+                self.assertEqual(results, legacy_parse(response, 2))
+                self.assertEqual(results[1]['matches'], [
+                    {'id': doc, 'weight': weight,
+                     'attrs': dict(zip([name for name, type_ in attrs], values))}
+                    for doc, weight, values in matches])
+
+    def test_columns_match_rows_for_every_schema(self):
+        for attrs in SCHEMAS:
+            response = encode_result(['body'], attrs, sample_matches(attrs), [])
+            cl = SphinxClient()
+            rows = cl._ParseSearchResponse(response, 1)[0]['matches']
+            cl.SetColumnarResult(True)
+            columns = cl._ParseSearchResponse(response, 1)[0]['columns']
+            self.assertEqual(list(columns['id']), [m['id'] for m in rows])
+            for name, type_ in attrs:
+                values = [list(value) for value in columns[name]] if type_ == MVA \
+                    else list(columns[name])
+                self.assertEqual(values, [m['attrs'][name] for m in rows])
+
+    def test_mva_schema_through_emulator(self):
+        result = self.sphinx_client().Query(u'работа', 'docs')
+        attrs = dict((m['id'], m['attrs']) for m in result['matches'])
+        self.assertEqual(result['attrs'], [list(attr) for attr in self.attrs])
+        self.assertEqual(attrs[1], {'lab_id': 3, 'tags': [1, 2], 'size': 1 << 40, 'author_id': 7})
+        self.assertEqual(attrs[2], {'lab_id': 4, 'tags': [], 'size': 5, 'author_id': 8})
+
+    def test_split_reads(self):
+        attrs = SCHEMAS[2]
+        response = encode_result(['body'], attrs, sample_matches(attrs, 20), [('word', 20, 20)])
+        server = TricklingServer(response, piece=3)
+        try:
+            cl = SphinxClient()
+            cl.SetServer(*server.address)
+            result = cl.Query('word', 'docs')
+        finally:
+            server.stop()
+        self.assertEqual(cl.GetLastError(), '')
+        self.assertEqual(result['matches'], cl._ParseSearchResponse(response, 1)[0]['matches'])
+
+    def test_timeout_waiting_for_response(self):
+        self.server.delay = 0.5
+        cl = self.sphinx_client()
+        cl.SetTimeout(0.1)
+        cl.Open()
+        started = time.time()
+        self.assertEqual(cl.Query(u'работа', 'docs'), None)
+        self.assertTrue(time.time() - started < 0.4)
+        self.assertTrue('timed out' in cl.GetLastError())
+        # the persistent connection is dropped, the next call reconnects
+        self.server.delay = 0
+        self.assertEqual(len(cl.Query(u'работа', 'docs')['matches']), 3)
+
+    def test_timeout_in_the_middle_of_a_response(self):
+        attrs = SCHEMAS[1]
+        response = encode_result(['body'], attrs, sample_matches(attrs, 50), [])
+        server = TricklingServer(response, stall=0.5)
+        try:
+            cl = SphinxClient()
+            cl.SetServer(*server.address)
+            cl.SetTimeout(0.1)
+            self.assertEqual(cl.Query('word', 'docs'), None)
+        finally:
+            server.stop()
+        self.assertTrue('timed out' in cl.GetLastError())
+
+
+class BrokenPipelineTest(TestCase):
+
+    def test_reset_leaves_report_incomplete(self):
+        server = ResettingServer()
+        try:
+            cl = SphinxClient()
+            cl.SetServer(*server.address)
+            updater = BulkAttributeUpdater(cl, 'docs', ['lab_id'], max_request_bytes=64)
+            pairs = [(docid, [1]) for docid in range(1, 1001)]
+            report = updater.update(pairs)
+        finally:
+            server.stop()
+        self.assertFalse(report.complete)
+        self.assertEqual(report.updated, 0)
+        self.assertTrue(report.errors)
+
+
+class DeltaIndexManagerTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        # stands in for indexer, logs its arguments
+        self.indexer = os.path.join(self.root, 'indexer')
+        f = open(self.indexer, 'w')
+        f.write('#!/bin/sh\necho "$@" >> "%s.log"\n' % self.indexer)
+        f.close()
+        os.chmod(self.indexer, 0755)
+        self.max_id = 10
+        self.manager = DeltaIndexManager(os.path.join(self.root, 'state.json'),
+                                         lambda: self.max_id, indexer=self.indexer,
+                                         merge_every=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def runs(self):
+        return open(self.indexer + '.log').read().splitlines()
+
+    def test_first_update_builds_main(self):
+        self.assertEqual(self.manager.update(), ['rebuild'])
+        self.assertEqual(self.runs(), ['--rotate submissions', '--rotate submissions_delta'])
+        state = self.manager.state()
+        self.assertEqual(state['main_max_id'], 10)
+        self.assertNotEqual(state['main_built'], None)
+
+        self.max_id = 12
+        self.assertEqual(self.manager.update(), ['delta', 'merge'])
+        self.assertEqual(self.manager.state()['main_max_id'], 12)
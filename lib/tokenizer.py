@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming normalization and tokenization of submission texts.
+
+Reports are compared as sequences of normalized words: lower case, ё
+folded into е, numbers and punctuation dropped. The tokenizer reads a
+file-like object chunk bytes at a time through an incremental decoder, so
+a 50 MB thesis never sits in memory as a whole; a word cut by a chunk
+boundary is carried over to the next chunk. Words are mapped to integer
+IDs by a Vocabulary shared by all documents compared with each other:
+
+    vocabulary = Vocabulary()
+    ids = token_ids(submission.open(), vocabulary)     # generator of ints
+    for chunk in token_id_chunks(open(path, 'rb'), vocabulary, encoding='cp1251'):
+        signature.update(chunk)                        # array('I') per chunk
+
+    words(u'Ёлка-2: ЁЖИК!')  ->  [u'елка', u'ежик']
+
+DecodingReader wraps a byte stream into one that reads unicode the same
+way, for consumers that want the text itself rather than its words.
+
+Vocabulary IDs depend on the order words were seen in; HashedVocabulary
+gives the same IDs in every process, for results that are stored.
+"""
+
+import codecs
+import re
+import zlib
+from array import array
+
+
+CHUNK = 65536
+
+# letters only: no digits, no underscore
+_WORD = re.compile(r'[^\W\d_]+', re.UNICODE)
+
+# ё written as е + combining diaeresis
+_DECOMPOSED_YO = u'\u0435\u0308'
+
+# longer letter runs are not words, don't carry them between chunks
+MAX_WORD = 1024
+
+
+def normalize(text):
+    """
+    Lower-cased text with ё folded into е.
+    """
+    text = text.lower().replace(u'ё', u'е')
+    if _DECOMPOSED_YO in text:
+        text = text.replace(_DECOMPOSED_YO, u'е')
+    return text
+
+
+def guess_encoding(head):
+    """
+    'utf-8' if head, the first bytes of a text, decodes as utf-8 (the
+    last character may be cut), else 'cp1251' of older Windows editors.
+    """
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(head, False)
+    except UnicodeDecodeError:
+        return 'cp1251'
+    return 'utf-8'
+
+
+def words(text):
+    """
+    Normalized words of a unicode text.
+    """
+    return _WORD.findall(normalize(text))
+
+
+class Vocabulary(object):
+    """
+    Word <-> integer ID mapping, IDs assigned from 1 in order of first
+    appearance. With frozen=True unknown words map to 0 instead of
+    getting a new ID.
+    """
+
+    def __init__(self, frozen=False):
+        self.frozen = frozen
+        self._ids = {}
+        self._words = [None]
+
+    def __len__(self):
+        return len(self._words) - 1
+
+    def __contains__(self, word):
+        return word in self._ids
+
+    def id(self, word):
+        return self.ids([word])[0]
+
+    def ids(self, words):
+        """
+        IDs of words as array('I').
+        """
+        ids = self._ids
+        get = ids.get
+        result = array('I', [0]) * len(words)
+        for i, word in enumerate(words):
+            wid = get(word)
+            if wid is None:
+                if self.frozen:
+                    continue
+                wid = ids[word] = len(self._words)
+                self._words.append(word)
+            result[i] = wid
+        return result
+
+    def word(self, wid):
+        return self._words[wid]
+
+
+class HashedVocabulary(object):
+    """
+    Vocabulary-like mapping of words to the crc32 of their utf-8 bytes:
+    no state, the same IDs in every process, rare collisions.
+    """
+
+    def id(self, word):
+        return zlib.crc32(word.encode('utf-8')) & 0xFFFFFFFF
+
+    def ids(self, words):
+        crc32 = zlib.crc32
+        return array('I', [crc32(word.encode('utf-8')) & 0xFFFFFFFF for word in words])
+
+
+class DecodingReader(object):
+    """
+    File-like view of stream (bytes in encoding) whose read(size) reads
+    size bytes and returns them decoded, undecodable bytes replaced;
+    u'' at the end.
+    """
+
+    def __init__(self, stream, encoding='utf-8'):
+        self.stream = stream
+        self._decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self._final = False
+
+    def read(self, size=CHUNK):
+        while not self._final:
+            data = self.stream.read(size)
+            self._final = not data
+            text = self._decoder.decode(data, self._final)
+            if text:
+                return text
+        return u''
+
+    def close(self):
+        self.stream.close()
+
+
+def token_chunks(stream, encoding='utf-8', chunk=CHUNK):
+    """
+    Yields lists of normalized words read from stream (bytes in
+    encoding, undecodable bytes replaced) chunk bytes at a time.
+    """
+    decoder = codecs.getincrementaldecoder(encoding)('replace')
+    carry = u''
+    while True:
+        data = stream.read(chunk)
+        final = not data
+        text = carry + decoder.decode(data, final)
+        if not text:
+            if final:
+                break
+            continue
+        text = normalize(text)
+        tokens = _WORD.findall(text)
+        carry = u''
+        if not final and tokens and _WORD.match(text, len(text) - 1):
+            # the last word may go on in the next chunk
+            last = tokens.pop()
+            if len(last) < MAX_WORD:
+                carry = last
+            else:
+                tokens.append(last)
+        if tokens:
+            yield tokens
+        if final:
+            break
+
+
+def token_id_chunks(stream, vocabulary, encoding='utf-8', chunk=CHUNK):
+    """
+    Like token_chunks(), yielding the words' vocabulary IDs as array('I').
+    """
+    for tokens in token_chunks(stream, encoding, chunk):
+        yield vocabulary.ids(tokens)
+
+
+def token_ids(stream, vocabulary, encoding='utf-8', chunk=CHUNK):
+    """
+    Generator of the vocabulary IDs of the words in stream, one by one.
+    """
+    for ids in token_id_chunks(stream, vocabulary, encoding, chunk):
+        for wid in ids:
+            yield wid
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""
+Winnowing fingerprints of source code (the MOSS algorithm).
+
+Word shingles miss copied code that was reformatted or had its variables
+renamed. The winnower works on normalized code tokens instead: comments
+and whitespace are dropped, identifiers, numbers and string literals
+become placeholders, keywords and operators stay. Every k consecutive
+tokens are hashed with a rolling hash, and of every window of
+guarantee - k + 1 consecutive k-gram hashes the minimum (the rightmost
+one on ties) is kept as a fingerprint, found in one pass with a monotonic
+deque. This guarantees:
+
+  * any match of at least guarantee tokens shares a fingerprint;
+  * no match shorter than k tokens (noise) is reported.
+
+    winnower = Winnower(k=5, guarantee=12)
+    a = winnower.fingerprint_source(source_a, language('lab1.c'))
+    b = winnower.fingerprints(code_tokens(source_b))   # any Token sequence
+    for fa, fb in common(a, b):
+        print source_a[fa.start:fa.end], source_b[fb.start:fb.end]
+
+Fingerprints carry their hash and the character offsets of the k-gram in
+the source. Comment syntax depends on the language: C-like by default,
+language() picks it from a file name.
+"""
+
+import os
+import re
+import zlib
+from collections import deque, namedtuple
+
+
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+# odd multiplier of the rolling k-gram hash
+_BASE = 0x100000001B3
+
+_TOKENS = r'''
+    (?P<comment>%s)
+  | (?P<string>"(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*')
+  | (?P<number>\d[\w.]*)
+  | (?P<name>[^\W\d]\w*)
+  | (?P<op>[^\s\w])
+'''
+
+# comment syntax per language; -- and # are operators or preprocessor
+# lines in C-like code, so they only start comments where they should
+COMMENTS = {
+    'c': r'//[^\n]*|/\*.*?\*/',
+    'python': r'\#[^\n]*',
+    'pascal': r'//[^\n]*|\{.*?\}|\(\*.*?\*\)',
+    'sql': r'--[^\n]*|/\*.*?\*/',
+    'php': r'//[^\n]*|\#[^\n]*|/\*.*?\*/',
+    # --[[ ]], --[==[ ]==] long comments before -- line ones
+    'lua': r'--\[(?P<level>=*)\[.*?\](?P=level)\]|--[^\n]*',
+    # nested {- -} are closed by the first -}
+    'haskell': r'\{-.*?-\}|--[^\n]*',
+}
+
+_CODE = dict((language, re.compile(_TOKENS % comment, re.S | re.U | re.X))
+             for language, comment in COMMENTS.items())
+
+EXTENSIONS = {
+    '.c': 'c', '.h': 'c', '.cpp': 'c', '.cc': 'c', '.hpp': 'c', '.java': 'c',
+    '.cs': 'c', '.js': 'c', '.go': 'c', '.php': 'php',
+    '.py': 'python', '.rb': 'python', '.sh': 'python', '.pl': 'python',
+    '.pas': 'pascal', '.dpr': 'pascal', '.pp': 'pascal',
+    '.sql': 'sql', '.lua': 'lua', '.hs': 'haskell',
+}
+
+# kept as they are; other names become one placeholder
+KEYWORDS = frozenset('''
+    and as assert begin break case catch char class const continue def default
+    del do double downto elif else end except finally float for foreach from
+    function if import in int interface is lambda long new not null or pass
+    private procedure program protected public raise repeat return self short
+    signed sizeof static struct super switch then this throw to try type
+    typedef union unsigned until var virtual void while with yield
+'''.split())
+
+
+Token = namedtuple('Token', 'hash start end')
+Fingerprint = namedtuple('Fingerprint', 'hash start end')
+
+
+def _crc(text):
+    return zlib.crc32(text.encode('utf-8')) & 0xFFFFFFFF
+
+
+_PLACEHOLDERS = {'string': _crc(u'"s"'), 'number': _crc(u'0')}
+_NAME = _crc(u'v')
+
+
+def language(filename, default='c'):
+    """
+    Comment syntax (a COMMENTS key) of a file, by its extension.
+    """
+    return EXTENSIONS.get(os.path.splitext(filename)[1].lower(), default)
+
+
+def scan(source, language='c'):
+    """
+    Normalized tokens of source (unicode) in language (a COMMENTS key)
+    as three parallel lists: token hashes, start and end character offsets.
+    """
+    hashes, starts, ends = [], [], []
+    # token text -> hash, None for comments
+    cache = {}
+    get = cache.get
+    for match in _CODE[language].finditer(source):
+        text = match.group()
+        value = get(text, 0)
+        if value == 0:
+            kind = match.lastgroup
+            if kind == 'comment':
+                value = None
+            elif kind in _PLACEHOLDERS:
+                value = _PLACEHOLDERS[kind]
+            elif kind == 'name' and text.lower() not in KEYWORDS:
+                value = _NAME
+            else:
+                value = _crc(text.lower())
+            cache[text] = value
+        if value is not None:
+            hashes.append(value)
+            starts.append(match.start())
+            ends.append(match.end())
+    return hashes, starts, ends
+
+
+def code_tokens(source, language='c'):
+    """
+    Yields the normalized tokens of source (unicode) as Token(hash,
+    start, end), start and end being character offsets.
+    """
+    for token in zip(*scan(source, language)):
+        yield Token(*token)
+
+
+class Winnower(object):
+    """
+    Selects fingerprints from token streams: k is the noise threshold
+    (k-gram length), guarantee the length in tokens of the shortest match
+    sure to be found; the window is guarantee - k + 1 k-grams.
+    """
+
+    def __init__(self, k=5, guarantee=12):
+        assert 0 < k <= guarantee
+        self.k = k
+        self.guarantee = guarantee
+        self.window = guarantee - k + 1
+        self._drop = pow(_BASE, k - 1, 1 << 64)
+
+    def kgram_hashes(self, hashes):
+        """
+        Rolling hashes of every k consecutive token hashes; the i-th
+        covers tokens i to i + k - 1.
+        """
+        k = self.k
+        drop = self._drop
+        grams = []
+        append = grams.append
+        h = 0
+        for i, value in enumerate(hashes):
+            if i >= k:
+                h = (h - hashes[i - k] * drop) & MASK64
+            h = (h * _BASE + value) & MASK64
+            if i >= k - 1:
+                append(h >> 32)
+        return grams
+
+    def kgrams(self, tokens):
+        """
+        Fingerprint(hash, start, end) of every k-gram of tokens.
+        """
+        hashes, starts, ends = self._unzip(tokens)
+        k = self.k
+        return [Fingerprint(h, starts[i], ends[i + k - 1])
+                for i, h in enumerate(self.kgram_hashes(hashes))]
+
+    def fingerprints(self, tokens):
+        """
+        Winnows the k-grams of tokens (Token sequence): the rightmost
+        minimal hash of every window, each selected k-gram once. Returns
+        a list of Fingerprint.
+        """
+        return self.winnow(*self._unzip(tokens))
+
+    def fingerprint_source(self, source, language='c'):
+        return self.winnow(*scan(source, language))
+
+    def winnow(self, hashes, starts, ends):
+        """
+        fingerprints() over the parallel lists scan() returns.
+        """
+        grams = self.kgram_hashes(hashes)
+        w = self.window
+        k1 = self.k - 1
+        selected = []
+        # positions of increasing hashes; the front is the minimum of the
+        # current window
+        window = deque()
+        push, pop, popleft = window.append, window.pop, window.popleft
+        last = -1
+        for i, h in enumerate(grams):
+            while window and grams[window[-1]] >= h:
+                pop()
+            push(i)
+            if window[0] <= i - w:
+                popleft()
+            if i >= w - 1 and window[0] != last:
+                last = window[0]
+                selected.append(Fingerprint(grams[last], starts[last], ends[last + k1]))
+        if not selected and window:
+            # fewer k-grams than a window: the minimum of them all
+            last = window[0]
+            selected.append(Fingerprint(grams[last], starts[last], ends[last + k1]))
+        return selected
+
+    def _unzip(self, tokens):
+        tokens = list(tokens)
+        if not tokens:
+            return [], [], []
+        return [list(column) for column in zip(*tokens)]
+
+
+def common(a, b):
+    """
+    Pairs of fingerprints of a and b with the same hash, in a's order.
+    """
+    index = {}
+    for fingerprint in b:
+        index.setdefault(fingerprint.hash, []).append(fingerprint)
+    for fa in a:
+        for fb in index.get(fa.hash, ()):
+            yield fa, fb
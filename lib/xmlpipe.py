@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming xmlpipe2 writer for the Sphinx indexer.
+
+XmlPipeWriter writes the document set straight to a stream (the
+indexer's pipe), one document at a time; long texts are escaped and
+written in slices, so memory stays bounded by a slice however large the
+documents are:
+
+    writer = XmlPipeWriter(sys.stdout, ['content'],
+                           [('lab', 'int'), ('timestamp', 'timestamp')])
+    writer.start()
+    for sub in submissions:
+        content = sub.open_text()
+        writer.document(sub.id, {'content': content},
+                        {'lab': sub.lab_id, 'timestamp': sub.created})
+        content.close()
+    writer.kill([12, 15])       # optional kill-list, for delta indexes
+    writer.close()
+
+Field values are unicode, utf-8 str or file-like objects read()ing
+either, which are read a slice at a time. Attribute types are xmlpipe2's: int, bigint, bool, float, timestamp (a
+datetime, a date or seconds since the epoch) and str2ordinal.
+"""
+
+import re
+import time
+from datetime import date
+
+
+ATTR_TYPES = ('int', 'bigint', 'bool', 'float', 'timestamp', 'str2ordinal')
+
+# characters XML 1.0 doesn't allow, the indexer rejects the whole set over them
+_INVALID = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_INVALID_BYTES = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+CHUNK = 65536
+
+
+def _escape(text):
+    """
+    Escapes text (unicode or utf-8 str) for XML, returns utf-8.
+    """
+    if isinstance(text, unicode):
+        text = _INVALID.sub(u' ', text).encode('utf-8')
+    else:
+        text = _INVALID_BYTES.sub(' ', text)
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _timestamp(value):
+    if isinstance(value, date):
+        return int(time.mktime(value.timetuple()))
+    return int(value or 0)
+
+
+class XmlPipeWriter(object):
+    """
+    Writes an xmlpipe2 document set with the given full-text fields and
+    (name, type) attributes to stream. documents counts the documents
+    written so far.
+    """
+
+    def __init__(self, stream, fields, attrs=(), chunk=CHUNK):
+        assert len(fields) > 0
+        for name, type in attrs:
+            assert type in ATTR_TYPES, 'unknown attribute type %r' % type
+        self.stream = stream
+        self.fields = list(fields)
+        self.attrs = list(attrs)
+        self.chunk = chunk
+        self.documents = 0
+
+    def start(self):
+        write = self.stream.write
+        write('<?xml version="1.0" encoding="utf-8"?>\n')
+        write('<sphinx:docset>\n<sphinx:schema>\n')
+        for name in self.fields:
+            write('<sphinx:field name="%s"/>\n' % name)
+        for name, type in self.attrs:
+            if type == 'bigint':
+                write('<sphinx:attr name="%s" type="int" bits="64"/>\n' % name)
+            else:
+                write('<sphinx:attr name="%s" type="%s"/>\n' % (name, type))
+        write('</sphinx:schema>\n')
+
+    def document(self, docid, fields, attrs=None):
+        """
+        Writes one document. Missing fields are empty, missing attributes 0.
+        """
+        assert docid > 0, 'document IDs must be positive'
+        attrs = attrs or {}
+        write = self.stream.write
+        write('<sphinx:document id="%d">\n' % docid)
+        for name in self.fields:
+            write('<%s>' % name)
+            self._text(fields.get(name))
+            write('</%s>\n' % name)
+        for name, type in self.attrs:
+            write('<%s>%s</%s>\n' % (name, self._attr(type, attrs.get(name)), name))
+        write('</sphinx:document>\n')
+        self.documents += 1
+
+    def kill(self, docids):
+        """
+        Writes the kill-list: documents to hide in the indexes searched
+        before this one.
+        """
+        write = self.stream.write
+        write('<sphinx:killlist>\n')
+        for docid in docids:
+            write('<id>%d</id>\n' % docid)
+        write('</sphinx:killlist>\n')
+
+    def close(self):
+        self.stream.write('</sphinx:docset>\n')
+        self.stream.flush()
+
+    def _text(self, text):
+        if not text:
+            return
+        write = self.stream.write
+        if hasattr(text, 'read'):
+            # file-like, read a slice at a time
+            while True:
+                data = text.read(self.chunk)
+                if not data:
+                    break
+                write(_escape(data))
+            return
+        # cutting utf-8 bytes mid-character is fine, escaping is bytewise
+        for i in xrange(0, len(text), self.chunk):
+            write(_escape(text[i:i + self.chunk]))
+
+    def _attr(self, type, value):
+        if type == 'timestamp':
+            return _timestamp(value)
+        if type == 'float':
+            return repr(float(value or 0))
+        if type == 'str2ordinal':
+            return _escape(value or '')
+        return int(value or 0)
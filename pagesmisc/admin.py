@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from django.contrib import admin
+
+from pagesmisc.models import Lab, Project, Submission
+
+
+class ProjectInline(admin.TabularInline):
+    model = Project
+    fk_name = 'lab'
+
+
+class LabAdmin(admin.ModelAdmin):
+    list_display = ('title', 'position', 'is_visible')
+    inlines = (ProjectInline,)
+
+
+class SubmissionAdmin(admin.ModelAdmin):
+    list_display = ('filename', 'author', 'lab', 'project', 'created', 'size', 'duplicate_of')
+    list_filter = ('lab',)
+    raw_id_fields = ('duplicate_of',)
+    readonly_fields = ('sha1', 'size')
+
+
+admin.site.register(Lab, LabAdmin)
+admin.site.register(Project)
+admin.site.register(Submission, SubmissionAdmin)
@@ -1,3 +1,218 @@
-from django.db import models
+# -*- coding: utf-8 -*-
 
-# Create your models here.
+from django.contrib.auth.models import User
+from django.db import connection, models, transaction
+
+from lib.blobstore import get_default_store
+from lib.managers import VisibleItems
+from lib.tokenizer import guess_encoding, token_id_chunks, DecodingReader, HashedVocabulary, \
+    CHUNK
+
+
+class Lab(models.Model):
+    title = models.CharField(u'название', max_length=255)
+    position = models.PositiveIntegerField(u'порядок', default=0)
+    is_visible = models.BooleanField(u'показывать', default=True)
+
+    objects = models.Manager()
+    visible = VisibleItems()
+
+    class Meta:
+        ordering = ('position', 'id')
+        verbose_name = u'лабораторная'
+        verbose_name_plural = u'лабораторные'
+
+    def __unicode__(self):
+        return self.title
+
+
+class Project(models.Model):
+    lab = models.ForeignKey(Lab, related_name='projects', verbose_name=u'лабораторная')
+    parent = models.ForeignKey('self', null=True, blank=True, related_name='children',
+                               verbose_name=u'родительский проект')
+    title = models.CharField(u'название', max_length=255)
+    position = models.PositiveIntegerField(u'порядок', default=0)
+    is_visible = models.BooleanField(u'показывать', default=True)
+
+    objects = models.Manager()
+    visible = VisibleItems()
+
+    class Meta:
+        ordering = ('position', 'id')
+        verbose_name = u'проект'
+        verbose_name_plural = u'проекты'
+
+    def __unicode__(self):
+        return self.title
+
+
+class SubmissionManager(models.Manager):
+
+    def store(self, author, lab, data, filename, project=None, store=None):
+        """
+        Saves data (a file or a str) to the blob store and creates its
+        Submission. A byte-identical earlier submission becomes its
+        duplicate_of, so fingerprinting can be skipped.
+        """
+        if store is None:
+            store = get_default_store()
+        sha1, size, created = store.put(data)
+        original = None
+        if not created:
+            originals = self.filter(sha1=sha1, duplicate_of__isnull=True).order_by('id')[:1]
+            if originals:
+                original = originals[0]
+        return self.create(author=author, lab=lab, project=project, filename=filename,
+                           sha1=sha1, size=size, duplicate_of=original)
+
+
+class Submission(models.Model):
+    lab = models.ForeignKey(Lab, related_name='submissions', verbose_name=u'лабораторная')
+    project = models.ForeignKey(Project, null=True, blank=True, related_name='submissions',
+                                verbose_name=u'проект')
+    author = models.ForeignKey(User, related_name='submissions', verbose_name=u'автор')
+    created = models.DateTimeField(u'сдана', auto_now_add=True, db_index=True)
+    filename = models.CharField(u'имя файла', max_length=255)
+    sha1 = models.CharField(max_length=40, db_index=True)
+    size = models.PositiveIntegerField(u'размер')
+    duplicate_of = models.ForeignKey('self', null=True, blank=True, related_name='duplicates',
+                                     verbose_name=u'копия работы')
+
+    objects = SubmissionManager()
+
+    class Meta:
+        ordering = ('-created',)
+        verbose_name = u'работа'
+        verbose_name_plural = u'работы'
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.author, self.filename)
+
+    @property
+    def is_duplicate(self):
+        return self.duplicate_of_id is not None
+
+    def open(self, store=None):
+        if store is None:
+            store = get_default_store()
+        return store.open(self.sha1)
+
+    def text(self, store=None):
+        """
+        The file as unicode; reports come in utf-8 or, from older
+        Windows editors, cp1251. Reads the whole file, see open_text().
+        """
+        if store is None:
+            store = get_default_store()
+        data = store.read(self.sha1)
+        return data.decode(guess_encoding(data[:CHUNK]), 'replace')
+
+    def open_text(self, store=None):
+        """
+        The file as a DecodingReader: read() returns unicode, decoded a
+        chunk at a time. The caller closes it.
+        """
+        f = self.open(store)
+        encoding = guess_encoding(f.read(CHUNK))
+        f.seek(0)
+        return DecodingReader(f, encoding)
+
+    def signature(self, sketcher, store=None):
+        """
+        MinHash signature of the file by sketcher (a MinHashSketcher),
+        computed once per blob and kept as its sidecar, so duplicates
+        share it.
+        """
+        if store is None:
+            store = get_default_store()
+        signature = sketcher.load(store, self.sha1)
+        if signature is None:
+            f = store.open(self.sha1)
+            try:
+                encoding = guess_encoding(f.read(CHUNK))
+                f.seek(0)
+                signature = sketcher.signature(
+                    token_id_chunks(f, HashedVocabulary(), encoding))
+            finally:
+                f.close()
+            sketcher.save(store, self.sha1, signature)
+        return signature
+
+
+class LSHBucketManager(models.Manager):
+
+    @transaction.commit_on_success
+    def add(self, items, lsh, batch=1000):
+        """
+        Puts (submission, signature) pairs into their band buckets by lsh
+        (an LSH), batch rows per INSERT ... executemany. Buckets a
+        submission already has are replaced. Runs in a transaction rolled
+        back on error. Returns the number of rows inserted.
+        """
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        column = qn(opts.get_field('submission').column)
+        sql = 'INSERT INTO %s (%s) VALUES (%%s, %%s, %%s, %%s)' % (
+            table,
+            ', '.join(qn(opts.get_field(name).column)
+                      for name in ('lab', 'band', 'bucket', 'submission')))
+        cursor = connection.cursor()
+        rows = []
+        ids = set()
+        inserted = 0
+
+        def flush():
+            cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                table, column, ', '.join(['%s'] * len(ids))), list(ids))
+            cursor.executemany(sql, rows)
+            transaction.set_dirty()
+            return len(rows)
+
+        for submission, signature in items:
+            if submission.pk in ids:
+                # added twice, the later signature wins
+                inserted += flush()
+                rows, ids = [], set()
+            ids.add(submission.pk)
+            for band, bucket in enumerate(lsh.buckets(signature)):
+                rows.append((submission.lab_id, band, bucket, submission.pk))
+            if len(rows) >= batch:
+                inserted += flush()
+                rows, ids = [], set()
+        if rows:
+            inserted += flush()
+        return inserted
+
+    def candidates(self, lab, signature, lsh, exclude=None):
+        """
+        IDs of the submissions of lab (None for all labs) sharing a
+        bucket with signature, most shared bands first.
+        """
+        buckets = lsh.buckets(signature)
+        wanted = set(enumerate(buckets))
+        rows = self.filter(bucket__in=buckets)
+        if lab is not None:
+            rows = rows.filter(lab=lab)
+        shared = {}
+        for band, bucket, submission_id in rows.values_list('band', 'bucket', 'submission'):
+            if (band, bucket) in wanted and submission_id != exclude:
+                shared[submission_id] = shared.get(submission_id, 0) + 1
+        return sorted(shared, key=lambda submission_id: (-shared[submission_id], submission_id))
+
+
+class LSHBucket(models.Model):
+    """
+    A band bucket of a submission's MinHash signature (see lib/lsh.py);
+    lab is denormalized so candidates are looked up within one lab.
+    """
+    lab = models.ForeignKey(Lab, related_name='+')
+    band = models.PositiveSmallIntegerField()
+    bucket = models.BigIntegerField()
+    submission = models.ForeignKey(Submission, related_name='buckets')
+
+    objects = LSHBucketManager()
+
+    class Meta:
+        # the index serves the (lab, bucket) lookups of candidates()
+        unique_together = (('lab', 'bucket', 'band', 'submission'),)
@@ -1,3 +1,4 @@
+# -*- coding: utf-8 -*-
 """
 This file demonstrates writing tests using the unittest module. These will pass
 when you run "manage.py test".
@@ -5,8 +6,22 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import hashlib
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
 from django.test import TestCase
 
+from lib.blobstore import BlobStore, BlobError
+from lib.lsh import LSH
+from lib.minhash import MinHashSketcher, jaccard
+from lib.winnow import Winnower, scan, common, language
+from lib.xmlpipe import XmlPipeWriter
+from pagesmisc.models import Lab, Submission, LSHBucket
+
 
 class SimpleTest(TestCase):
     def test_basic_addition(self):
@@ -14,3 +29,181 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class BlobStoreTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = BlobStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_is_content_addressed(self):
+        sha1, size, created = self.store.put(StringIO('report'))
+        self.assertEqual(sha1, hashlib.sha1('report').hexdigest())
+        self.assertEqual((size, created), (6, True))
+        self.assertEqual(self.store.path(sha1),
+                         os.path.join(self.root, sha1[:2], sha1[2:4], sha1))
+        self.assertEqual(self.store.read(sha1), 'report')
+
+        self.assertEqual(self.store.put('report'), (sha1, 6, False))
+        self.assertEqual(os.listdir(os.path.join(self.root, 'tmp')), [])
+
+    def test_sidecars(self):
+        sha1 = self.store.put('report')[0]
+        self.assertEqual(self.store.get_sidecar(sha1, 'minhash'), None)
+        self.store.put_sidecar(sha1, 'minhash', '\x01\x02')
+        self.assertEqual(self.store.get_sidecar(sha1, 'minhash'), '\x01\x02')
+        self.assertRaises(BlobError, self.store.sidecar_path, sha1, '../x')
+        self.store.delete(sha1)
+        self.assertFalse(self.store.exists(sha1))
+        self.assertEqual(self.store.get_sidecar(sha1, 'minhash'), None)
+
+
+class SubmissionTest(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = BlobStore(self.root)
+        self.lab = Lab.objects.create(title=u'Лабораторная 1')
+        self.author = User.objects.create_user('student', 'student@example.com', 'x')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_identical_resubmission_is_duplicate(self):
+        first = Submission.objects.store(self.author, self.lab, StringIO('report'),
+                                         'a.txt', store=self.store)
+        other = Submission.objects.store(self.author, self.lab, 'other report',
+                                         'b.txt', store=self.store)
+        copy = Submission.objects.store(self.author, self.lab, StringIO('report'),
+                                        'c.txt', store=self.store)
+        self.assertFalse(first.is_duplicate)
+        self.assertFalse(other.is_duplicate)
+        self.assertEqual(copy.duplicate_of, first)
+        self.assertEqual(copy.sha1, first.sha1)
+
+    def test_signature_is_shared_by_duplicates(self):
+        sketcher = MinHashSketcher(num_perm=16, shingle=2)
+        first = Submission.objects.store(self.author, self.lab, u'Отчёт о работе'.encode('cp1251'),
+                                         'a.txt', store=self.store)
+        copy = Submission.objects.store(self.author, self.lab, u'Отчёт о работе'.encode('cp1251'),
+                                        'b.txt', store=self.store)
+        signature = first.signature(sketcher, self.store)
+        self.assertEqual(list(signature), list(sketcher.load(self.store, copy.sha1)))
+        self.assertEqual(jaccard(signature, copy.signature(sketcher, self.store)), 1.0)
+
+    def test_text_is_streamed_to_xmlpipe(self):
+        text = u'Отчёт <о> работе & выводы ' * 50
+        sub = Submission.objects.store(self.author, self.lab, text.encode('cp1251'),
+                                       'a.txt', store=self.store)
+        streamed, whole = StringIO(), StringIO()
+        # odd slices cut characters and entities apart
+        for out, content in ((streamed, sub.open_text(self.store)), (whole, text)):
+            writer = XmlPipeWriter(out, ['content'], chunk=7)
+            writer.document(sub.pk, {'content': content})
+        self.assertEqual(streamed.getvalue(), whole.getvalue())
+        self.assertTrue(u'&lt;о&gt; работе &amp;'.encode('utf-8') in streamed.getvalue())
+
+    def test_reads_from_the_given_store(self):
+        text = u'Отчёт о работе'
+        sub = Submission.objects.store(self.author, self.lab, text.encode('cp1251'),
+                                       'a.txt', store=self.store)
+        f = sub.open(self.store)
+        try:
+            self.assertEqual(f.read(), text.encode('cp1251'))
+        finally:
+            f.close()
+        self.assertEqual(sub.text(self.store), text)
+
+    def test_lsh_candidates(self):
+        lsh = LSH(num_perm=16, bands=4, rows=4)
+        other_lab = Lab.objects.create(title=u'Лабораторная 2')
+        subs = [Submission.objects.store(self.author, lab, 'report %d' % i, 'r.txt',
+                                         store=self.store)
+                for i, lab in enumerate([self.lab, self.lab, self.lab, other_lab])]
+        base = range(16)
+        signatures = [base,
+                      base[:12] + [99] * 4,         # shares 3 bands
+                      [99] * 16,                    # shares none
+                      base]                         # another lab
+        self.assertEqual(LSHBucket.objects.add(zip(subs, signatures), lsh, batch=5), 16)
+        self.assertEqual(LSHBucket.objects.candidates(self.lab, base, lsh, exclude=subs[0].pk),
+                         [subs[1].pk])
+        self.assertEqual(LSHBucket.objects.candidates(None, base, lsh),
+                         [subs[0].pk, subs[3].pk, subs[1].pk])
+
+
+    def test_lsh_readd_replaces_buckets(self):
+        lsh = LSH(num_perm=16, bands=4, rows=4)
+        sub = Submission.objects.store(self.author, self.lab, 'report', 'r.txt',
+                                       store=self.store)
+        base = range(16)
+        LSHBucket.objects.add([(sub, base)], lsh)
+        self.assertEqual(LSHBucket.objects.add([(sub, base)], lsh), 4)
+        self.assertEqual(LSHBucket.objects.add([(sub, [99] * 16), (sub, base[:12] + [99] * 4)],
+                                               lsh, batch=2), 8)
+        self.assertEqual(LSHBucket.objects.filter(submission=sub).count(), 4)
+        self.assertEqual(sorted(LSHBucket.objects.filter(submission=sub)
+                                .values_list('bucket', flat=True)),
+                         sorted(lsh.buckets(base[:12] + [99] * 4)))
+
+
+class WinnowTest(TestCase):
+    LOOP = u'''int sum(int *a, int n) {
+    int total = 0;
+    for (i = n; i > 0; i--) { total = total + a[i] * 2; }
+    return total;
+}'''
+
+    COPY = u'''/* my own work */
+int   acc_sum(int *values,int count)
+{
+    int acc=0;   // accumulator
+    for (j = count; j > 0; j--)
+    {
+        acc = acc + values[j] * 2;
+    }
+    return acc;
+}'''
+
+    def tokens(self, source, lang='c'):
+        hashes, starts, ends = scan(source, lang)
+        return [source[start:end] for start, end in zip(starts, ends)]
+
+    def test_decrement_is_not_a_comment(self):
+        tokens = self.tokens(self.LOOP)
+        self.assertEqual(tokens[-12:], [u'a', u'[', u'i', u']', u'*', u'2', u';', u'}',
+                                        u'return', u'total', u';', u'}'])
+        self.assertEqual(tokens.count(u'-'), 2)
+
+    def test_comments_by_language(self):
+        self.assertEqual(self.tokens(u'x = 1 # note', language('a.py')), [u'x', u'=', u'1'])
+        self.assertEqual(self.tokens(u'#include <x>', language('a.c'))[:2], [u'#', u'include'])
+        self.assertEqual(self.tokens(u'x := 1; { note } (* note *)', language('a.pas')),
+                         [u'x', u':', u'=', u'1', u';'])
+
+    def test_php_hash_comments(self):
+        self.assertEqual(self.tokens(u'$x = 1; # note\n/* a */ // b', language('a.php')),
+                         [u'$', u'x', u'=', u'1', u';'])
+
+    def test_lua_long_comments(self):
+        source = u'x = 1 --[[ block\nx = 2 ]] --[==[ ]] ]==] y = 3 -- note'
+        self.assertEqual(self.tokens(source, language('a.lua')),
+                         [u'x', u'=', u'1', u'y', u'=', u'3'])
+
+    def test_haskell_block_comments(self):
+        self.assertEqual(self.tokens(u'f x = {- a\nb -} x + 1 -- note', language('a.hs')),
+                         [u'f', u'x', u'=', u'x', u'+', u'1'])
+
+    def test_copy_survives_renaming_and_reformatting(self):
+        winnower = Winnower(k=5, guarantee=10)
+        original = winnower.fingerprint_source(self.LOOP)
+        copy = winnower.fingerprint_source(self.COPY)
+        self.assertEqual(scan(self.LOOP)[0], scan(self.COPY)[0])
+        self.assertEqual([f.hash for f in original], [f.hash for f in copy])
+        pairs = list(common(original, copy))
+        self.assertTrue(pairs)
+        for fa, fb in pairs:
+            self.assertEqual(scan(self.LOOP[fa.start:fa.end])[0],
+                             scan(self.COPY[fb.start:fb.end])[0])